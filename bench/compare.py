@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Compare two bench/run.py reports
+
+Prints the change of every scenario metric between a baseline and a
+candidate report. With --fail-above, exits 1 when a metric regressed by
+more than that percentage (higher latency or RSS, lower throughput), so a
+release pipeline can gate on it:
+
+    python3 bench/compare.py before.json after.json --fail-above 10
+"""
+
+import argparse
+import json
+import sys
+
+# (path in the scenario result, True if higher is better)
+METRICS = (
+    (('latency_seconds', 'p50'), False),
+    (('latency_seconds', 'p99'), False),
+    (('throughput_per_second',), True),
+    (('bytes_per_second',), True),
+    (('peak_rss_bytes',), False),
+)
+
+
+def lookup(result, path):
+    for key in path:
+        if not isinstance(result, dict):
+            return None
+        result = result.get(key)
+    return result
+
+
+def compare(baseline, candidate):
+    """[(scenario, metric, before, after, change %, regression %)] for the scenarios in both reports"""
+    rows = []
+    for scenario, after_result in candidate['scenarios'].items():
+        before_result = baseline['scenarios'].get(scenario)
+        if before_result is None:
+            continue
+        for path, higher_is_better in METRICS:
+            before, after = lookup(before_result, path), lookup(after_result, path)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            regression = -change if higher_is_better else change
+            rows.append((scenario, '.'.join(path), before, after, change, regression))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark reports')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--fail-above', type=float, help='Exit 1 if a metric regressed by more than this percentage')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    print(f"{baseline.get('version')} -> {candidate.get('version')}")
+    regressed = []
+    for scenario, metric, before, after, change, regression in compare(baseline, candidate):
+        flag = ''
+        if args.fail_above is not None and regression > args.fail_above:
+            flag = '  REGRESSION'
+            regressed.append((scenario, metric))
+        print(f"{scenario:14} {metric:22} {before:>16.6g} {after:>16.6g} {change:+8.1f}%{flag}")
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
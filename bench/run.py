@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks of EzInfer and the S3 uploader
+
+Runs reproducible scenarios against local stand-ins, so performance changes
+can be measured without a GPU or a real bucket:
+
+- generate:      concurrent /generate load on EzInfer, backed by the stub
+                 ComfyUI of stub_comfyui.py (and moto for ?return=s3)
+- upload-small:  S3 uploader upload of many small files to a moto server
+- upload-large:  S3 uploader upload of a few large (multipart) files
+- scan:          folder_scan.scan_folder over a large tree
+
+Each scenario reports latency percentiles, throughput and the peak RSS of
+the process under test as one JSON document (stdout or --output), which
+compare.py diffs between releases:
+
+    python3 bench/run.py --output before.json
+    python3 bench/run.py --scenario generate --return-mode binary --concurrency 32
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SERVICES_DIR = os.path.join(REPO_DIR, 'services')
+
+SCENARIOS = ('generate', 'upload-small', 'upload-large', 'scan')
+SCHEMA_VERSION = 1
+MB = 1024 ** 2
+
+BUCKET = 'ezinfer-bench'
+# Static credentials accepted by moto
+AWS_ENV = {'AWS_ACCESS_KEY_ID': 'bench', 'AWS_SECRET_ACCESS_KEY': 'bench', 'AWS_S3_BUCKET': BUCKET,
+           'AWS_REGION': 'us-east-1'}
+
+# Runs EzInfer on a chosen port (ez_infer.py itself always binds 5000)
+EZINFER_BOOT = ("import sys; from aiohttp import web; import ez_infer; "
+                "web.run_app(ez_infer.create_app(), host='127.0.0.1', port=int(sys.argv[1]), "
+                "access_log=None, print=None)")
+
+# Smallest workflow shape EzInfer accepts: a seed to randomize and an output node
+BENCH_WORKFLOW = {
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "bench.safetensors"}},
+    "3": {"class_type": "KSampler", "inputs": {"seed": 0, "steps": 20, "model": ["4", 0]}},
+    "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0], "filename_prefix": "bench"}},
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentiles(values):
+    """p50/p90/p99/max/mean of a list of seconds (nearest-rank)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def rank(p):
+        return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+    return {'p50': round(rank(50), 6), 'p90': round(rank(90), 6), 'p99': round(rank(99), 6),
+            'max': round(ordered[-1], 6), 'mean': round(sum(ordered) / len(ordered), 6)}
+
+
+def peak_rss(pid):
+    """Peak resident set size of a running process in bytes (Linux VmHWM), or None"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def own_peak_rss():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty', '--tags'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Service:
+    """A server started for a scenario, stopped (and its peak RSS read) at the end"""
+
+    def __init__(self, name, cmd, env=None, cwd=None, log_dir=None):
+        self.name = name
+        self.log = open(os.path.join(log_dir, f"{name}.log"), 'w') if log_dir else subprocess.DEVNULL
+        self.process = subprocess.Popen(cmd, env={**os.environ, **(env or {})}, cwd=cwd,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_http(self, url, timeout=60):
+        import urllib.error
+        import urllib.request
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.name} exited with {self.process.returncode}")
+            try:
+                with urllib.request.urlopen(url, timeout=2):
+                    return
+            except urllib.error.HTTPError:
+                # Up, just not happy with this path
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError(f"{self.name} did not come up at {url} within {timeout}s")
+
+    def stop(self):
+        rss = peak_rss(self.process.pid)
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        if self.log is not subprocess.DEVNULL:
+            self.log.close()
+        return rss
+
+
+def start_moto(workdir):
+    """moto S3 server with the benchmark bucket; returns (service, endpoint)"""
+    port = free_port()
+    moto = Service('moto', [sys.executable, '-m', 'moto.server', '-p', str(port)], log_dir=workdir)
+    endpoint = f"http://127.0.0.1:{port}"
+    moto.wait_http(f"{endpoint}/moto-api/")
+    import boto3
+    boto3.client('s3', endpoint_url=endpoint, region_name=AWS_ENV['AWS_REGION'],
+                 aws_access_key_id='bench', aws_secret_access_key='bench').create_bucket(Bucket=BUCKET)
+    return moto, endpoint
+
+
+def make_tree(root, count, size, per_dir=100):
+    """count files of size bytes under root, per_dir per directory"""
+    block = os.urandom(min(size, 8 * MB)) if size else b''
+    for index in range(count):
+        directory = os.path.join(root, f"d{index // per_dir:05d}")
+        if index % per_dir == 0:
+            os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"f{index:07d}.bin"), 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                chunk = block[:remaining]
+                f.write(chunk)
+                remaining -= len(chunk)
+
+
+# Scenarios run in this process (drivers) or in a child (the code under test)
+
+async def drive_generate(url, total, concurrency, warmup):
+    """Send total /generate requests, concurrency at a time; returns (latencies, errors, bytes, seconds)"""
+    import aiohttp
+    latencies, errors, received = [], {}, 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(session, record):
+        nonlocal received
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                async with session.post(url, json=BENCH_WORKFLOW) as response:
+                    body = await response.read()
+                    status = response.status
+            except aiohttp.ClientError as e:
+                status, body = type(e).__name__, b''
+            if not record:
+                return
+            if status == 200:
+                latencies.append(time.monotonic() - started)
+                received += len(body)
+            else:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=0)) as session:
+        await asyncio.gather(*(one(session, False) for _ in range(warmup)))
+        started = time.monotonic()
+        await asyncio.gather(*(one(session, True) for _ in range(total)))
+        seconds = time.monotonic() - started
+    return latencies, errors, received, seconds
+
+
+def scenario_generate(args, workdir):
+    output_dir = os.path.join(workdir, 'output')
+    os.makedirs(output_dir)
+    services = []
+    try:
+        comfy_port = free_port()
+        stub = Service('stub-comfyui', [
+            sys.executable, os.path.join(BENCH_DIR, 'stub_comfyui.py'), '--port', str(comfy_port),
+            '--output-dir', output_dir, '--exec-seconds', str(args.exec_seconds),
+            '--exec-concurrency', str(args.exec_concurrency), '--image-bytes', str(args.image_bytes),
+            '--images-per-prompt', str(args.images_per_prompt)], log_dir=workdir)
+        services.append(stub)
+        stub.wait_http(f"http://127.0.0.1:{comfy_port}/system_stats")
+
+        env = {
+            'EZINFER_COMFYUI_BACKENDS': f"http://127.0.0.1:{comfy_port}={output_dir}",
+            'COMFYUI_OUTPUT_DIR': output_dir,
+            'EZINFER_TEMPLATE_DIR': os.path.join(workdir, 'templates'),
+            'METRICS_TEXTFILE_DIR': os.path.join(workdir, 'metrics'),
+            'EZINFER_MAX_IN_FLIGHT': str(args.max_in_flight),
+            'EZINFER_MAX_QUEUE': str(max(64, args.concurrency)),
+            'EZINFER_DELETE_OUTPUTS': 'true',
+            'PYTHONUNBUFFERED': '1',
+        }
+        if args.return_mode == 's3':
+            moto, endpoint = start_moto(workdir)
+            services.append(moto)
+            env.update(AWS_ENV, AWS_S3_ENDPOINT=endpoint, EZINFER_S3_OUTPUTS='true')
+
+        ezinfer_port = free_port()
+        ezinfer = Service('ezinfer', [sys.executable, '-c', EZINFER_BOOT, str(ezinfer_port)],
+                          env=env, cwd=SERVICES_DIR, log_dir=workdir)
+        services.append(ezinfer)
+        ezinfer.wait_http(f"http://127.0.0.1:{ezinfer_port}/health/live")
+
+        url = f"http://127.0.0.1:{ezinfer_port}/generate?return={args.return_mode}"
+        latencies, errors, received, seconds = asyncio.run(
+            drive_generate(url, args.requests, args.concurrency, args.warmup_requests))
+        rss = ezinfer.stop()
+    finally:
+        for service in services:
+            if service.process.poll() is None:
+                service.stop()
+
+    return {
+        'params': {'requests': args.requests, 'concurrency': args.concurrency, 'return_mode': args.return_mode,
+                   'exec_seconds': args.exec_seconds, 'exec_concurrency': args.exec_concurrency,
+                   'image_bytes': args.image_bytes, 'images_per_prompt': args.images_per_prompt,
+                   'max_in_flight': args.max_in_flight},
+        'count': len(latencies),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'latency_seconds': percentiles(latencies),
+        'throughput_per_second': round(len(latencies) / seconds, 3) if seconds else None,
+        'bytes_per_second': round(received / seconds, 1) if seconds else None,
+        'peak_rss_bytes': rss,
+    }
+
+
+def run_child(kind, params, env):
+    """Run a child scenario in a fresh interpreter so its peak RSS is its own"""
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', kind, json.dumps(params)],
+                            env={**os.environ, **env}, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{kind} child failed:\n{result.stdout[-2000:]}{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def scenario_upload(args, workdir, files, size):
+    source = os.path.join(workdir, 'source')
+    make_tree(os.path.join(source, 'models'), files, size)
+    moto, endpoint = start_moto(workdir)
+    try:
+        env = dict(AWS_ENV, AWS_S3_ENDPOINT=endpoint,
+                   S3UPLOADER_MANIFEST_DIR=os.path.join(workdir, 'manifests'),
+                   S3UPLOADER_JOURNAL=os.path.join(workdir, 'journal.db'))
+        result = run_child('upload', {'source': source, 'mode': args.upload_mode}, env)
+    finally:
+        moto.stop()
+    result['params'] = {'files': files, 'file_bytes': size, 'mode': args.upload_mode,
+                        'concurrency': int(os.getenv('S3UPLOADER_CONCURRENCY', '16')),
+                        'large_file_concurrency': int(os.getenv('S3UPLOADER_LARGE_FILE_CONCURRENCY', '2'))}
+    return result
+
+
+def scenario_scan(args, workdir):
+    source = os.path.join(workdir, 'source')
+    make_tree(source, args.scan_files, 0)
+    result = run_child('scan', {'source': source, 'iterations': args.scan_iterations}, {})
+    result['params'] = {'files': args.scan_files, 'iterations': args.scan_iterations}
+    return result
+
+
+def child_upload(params):
+    """Time s3uploader.upload_folder_to_s3 over params['source'] (in the child process)"""
+    sys.path.insert(0, SERVICES_DIR)
+    import s3uploader
+    from folder_scan import FolderScanner
+
+    s3uploader.SOURCE_FOLDER = params['source']
+    s3uploader.folder_scanner = FolderScanner(params['source'], 0)
+    latencies = []
+    upload_one_file = s3uploader.upload_one_file
+
+    def timed_upload_one_file(*args):
+        started = time.monotonic()
+        upload_one_file(*args)
+        latencies.append(time.monotonic() - started)
+
+    s3uploader.upload_one_file = timed_upload_one_file
+    started = time.monotonic()
+    s3uploader.upload_folder_to_s3('bench', params['mode'])
+    seconds = time.monotonic() - started
+    progress = s3uploader.upload_progress
+    failed = progress['total_files'] - progress['files_processed']
+    return {
+        'count': progress['files_processed'],
+        'errors': {'failed_files': failed} if failed else {},
+        'status': progress['status'],
+        'seconds': round(seconds, 3),
+        'latency_seconds': percentiles(latencies),
+        'throughput_per_second': round(progress['files_processed'] / seconds, 3) if seconds else None,
+        'bytes_per_second': round(progress['bytes_uploaded'] / seconds, 1) if seconds else None,
+        'peak_rss_bytes': own_peak_rss(),
+    }
+
+
+def child_scan(params):
+    """Time folder_scan.scan_folder over params['source'] (in the child process)"""
+    sys.path.insert(0, SERVICES_DIR)
+    from folder_scan import ExclusionRules, scan_folder
+
+    latencies, files = [], 0
+    for _ in range(params['iterations']):
+        started = time.monotonic()
+        snapshot = scan_folder(params['source'], ExclusionRules(''))
+        latencies.append(time.monotonic() - started)
+        files += snapshot.file_count
+    seconds = sum(latencies)
+    return {
+        'count': len(latencies),
+        'errors': {},
+        'seconds': round(seconds, 3),
+        'latency_seconds': percentiles(latencies),
+        'throughput_per_second': round(files / seconds, 1) if seconds else None,
+        'bytes_per_second': None,
+        'peak_rss_bytes': own_peak_rss(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline EzInfer and S3 uploader benchmarks')
+    parser.add_argument('--scenario', default=','.join(SCENARIOS),
+                        help=f"Comma-separated scenarios to run ({', '.join(SCENARIOS)})")
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--keep-workdir', action='store_true', help='Keep datasets and service logs')
+    generate = parser.add_argument_group('generate')
+    generate.add_argument('--requests', type=int, default=200)
+    generate.add_argument('--warmup-requests', type=int, default=10, help='Requests sent before measuring')
+    generate.add_argument('--concurrency', type=int, default=16)
+    generate.add_argument('--return-mode', default='json', choices=('json', 'binary', 'reference', 's3'))
+    generate.add_argument('--exec-seconds', type=float, default=0.05, help='Stub ComfyUI execution time per prompt')
+    generate.add_argument('--exec-concurrency', type=int, default=1, help='Prompts the stub executes at once')
+    generate.add_argument('--image-bytes', type=int, default=MB)
+    generate.add_argument('--images-per-prompt', type=int, default=1)
+    generate.add_argument('--max-in-flight', type=int, default=4, help='EZINFER_MAX_IN_FLIGHT')
+    upload = parser.add_argument_group('upload-small / upload-large')
+    upload.add_argument('--upload-mode', default='full', choices=('full', 'sync', 'dedup'))
+    upload.add_argument('--small-files', type=int, default=2000)
+    upload.add_argument('--small-file-bytes', type=int, default=16 * 1024)
+    upload.add_argument('--large-files', type=int, default=2)
+    upload.add_argument('--large-file-mb', type=int, default=128)
+    scan = parser.add_argument_group('scan')
+    scan.add_argument('--scan-files', type=int, default=20000)
+    scan.add_argument('--scan-iterations', type=int, default=5)
+    parser.add_argument('--child', nargs=2, metavar=('KIND', 'PARAMS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        kind, params = args.child
+        result = {'upload': child_upload, 'scan': child_scan}[kind](json.loads(params))
+        print(json.dumps(result))
+        return 0
+
+    selected = [name.strip() for name in args.scenario.split(',') if name.strip()]
+    unknown = set(selected) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    report = {
+        'schema': SCHEMA_VERSION,
+        'version': git_version(),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'scenarios': {},
+    }
+    for name in selected:
+        workdir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+        print(f"Running {name} (work directory {workdir})...", file=sys.stderr, flush=True)
+        try:
+            if name == 'generate':
+                result = scenario_generate(args, workdir)
+            elif name == 'upload-small':
+                result = scenario_upload(args, workdir, args.small_files, args.small_file_bytes)
+            elif name == 'upload-large':
+                result = scenario_upload(args, workdir, args.large_files, args.large_file_mb * MB)
+            else:
+                result = scenario_scan(args, workdir)
+        except Exception as e:
+            print(f"{name} failed: {e}", file=sys.stderr)
+            result = {'error': str(e)}
+        finally:
+            if not args.keep_workdir:
+                shutil.rmtree(workdir, ignore_errors=True)
+        report['scenarios'][name] = result
+        summary = result.get('latency_seconds') or {}
+        print(f"  {name}: p50={summary.get('p50')}s p99={summary.get('p99')}s "
+              f"throughput={result.get('throughput_per_second')}/s peak_rss={result.get('peak_rss_bytes')}",
+              file=sys.stderr, flush=True)
+
+    document = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(document + '\n')
+    else:
+        print(document)
+    return 1 if any('error' in result for result in report['scenarios'].values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
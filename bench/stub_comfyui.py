@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Stub ComfyUI server for benchmarks
+
+Speaks enough of the ComfyUI API for EzInfer (services/comfy_client.py,
+services/comfy_ws.py): POST/GET /prompt, /ws, /history, /view,
+/system_stats, /queue and /interrupt. Prompts run EXEC_CONCURRENCY at a
+time (1, like ComfyUI), each taking --exec-seconds spread over its nodes,
+and write --images-per-prompt files of --image-bytes random bytes to the
+output directory, served back by /view. No GPU, models or ComfyUI checkout
+is needed, so EzInfer can be load-tested anywhere.
+
+    python3 bench/stub_comfyui.py --port 8188 --exec-seconds 0.5 --image-bytes 4194304
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import tempfile
+import time
+import uuid
+
+from aiohttp import web
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Gap between execution_success and the history entry, as between ComfyUI's executor and task_done()
+HISTORY_DELAY_SECONDS = 0.05
+
+
+class StubComfyUI:
+    """Queue, executor and WebSocket fan-out of the stub"""
+
+    def __init__(self, output_dir, exec_seconds=0.5, image_bytes=1024 ** 2, images_per_prompt=1,
+                 exec_concurrency=1, submit_seconds=0.0):
+        self.output_dir = output_dir
+        self.exec_seconds = exec_seconds
+        self.image_bytes = image_bytes
+        self.images_per_prompt = images_per_prompt
+        self.submit_seconds = submit_seconds
+        self.queue = asyncio.Queue()
+        self.pending = {}
+        self.running = {}
+        self.history = {}
+        self.sockets = {}
+        self.counter = itertools.count(1)
+        self.executors = exec_concurrency
+        # Generated once: outputs differ by name, not content
+        self.payload = PNG_SIGNATURE + os.urandom(max(0, image_bytes - len(PNG_SIGNATURE)))
+        self._tasks = []
+
+    async def start(self, app):
+        self._tasks = [asyncio.create_task(self._executor()) for _ in range(self.executors)]
+
+    async def stop(self, app):
+        for task in self._tasks:
+            task.cancel()
+        for ws in list(self.sockets.values()):
+            await ws.close()
+
+    @property
+    def queue_remaining(self):
+        return len(self.pending) + len(self.running)
+
+    async def send(self, client_id, msg_type, data):
+        ws = self.sockets.get(client_id)
+        if ws is not None and not ws.closed:
+            await ws.send_str(json.dumps({'type': msg_type, 'data': data}))
+
+    async def broadcast_status(self):
+        message = {'status': {'exec_info': {'queue_remaining': self.queue_remaining}}, 'sid': None}
+        for client_id in list(self.sockets):
+            await self.send(client_id, 'status', message)
+
+    async def _executor(self):
+        while True:
+            prompt_id = await self.queue.get()
+            entry = self.pending.pop(prompt_id, None)
+            if entry is None:
+                # Deleted from the queue while pending
+                continue
+            self.running[prompt_id] = entry
+            try:
+                await self._execute(prompt_id, entry)
+            finally:
+                self.running.pop(prompt_id, None)
+                await self.broadcast_status()
+
+    async def _execute(self, prompt_id, entry):
+        client_id, workflow = entry['client_id'], entry['prompt']
+        await self.send(client_id, 'execution_start', {'prompt_id': prompt_id, 'timestamp': time.time()})
+        node_ids = list(workflow) or ['1']
+        per_node = self.exec_seconds / len(node_ids)
+        for node_id in node_ids:
+            if entry.get('interrupted'):
+                await self.send(client_id, 'execution_interrupted', {'prompt_id': prompt_id, 'node_id': node_id})
+                self.history[prompt_id] = {'outputs': {}, 'status': {'status_str': 'error', 'completed': False}}
+                return
+            await self.send(client_id, 'executing', {'node': node_id, 'prompt_id': prompt_id})
+            await asyncio.sleep(per_node)
+            await self.send(client_id, 'executed', {'node': node_id, 'prompt_id': prompt_id, 'output': None})
+
+        images = []
+        for index in range(self.images_per_prompt):
+            filename = f"stub_{prompt_id}_{index:03d}.png"
+            await asyncio.to_thread(self._write, filename)
+            images.append({'filename': filename, 'subfolder': '', 'type': 'output'})
+        # ComfyUI's order: execution_success from the executor, history written by
+        # task_done() afterwards, then executing with no node
+        await self.send(client_id, 'execution_success', {'prompt_id': prompt_id, 'timestamp': time.time()})
+        await asyncio.sleep(HISTORY_DELAY_SECONDS)
+        self.history[prompt_id] = {
+            'prompt': [entry['number'], prompt_id, workflow, {}, []],
+            'outputs': {node_ids[-1]: {'images': images}},
+            'status': {'status_str': 'success', 'completed': True, 'messages': []},
+        }
+        await self.send(client_id, 'executing', {'node': None, 'prompt_id': prompt_id})
+
+    def _write(self, filename):
+        with open(os.path.join(self.output_dir, filename), 'wb') as f:
+            f.write(self.payload)
+
+    # HTTP handlers
+
+    async def post_prompt(self, request):
+        body = await request.json()
+        workflow = body.get('prompt')
+        if not isinstance(workflow, dict) or not workflow:
+            return web.json_response({'error': {'type': 'invalid_prompt', 'message': 'Empty prompt'},
+                                      'node_errors': {}}, status=400)
+        if self.submit_seconds:
+            await asyncio.sleep(self.submit_seconds)
+        prompt_id = str(uuid.uuid4())
+        number = next(self.counter)
+        self.pending[prompt_id] = {'prompt': workflow, 'client_id': body.get('client_id'), 'number': number}
+        await self.queue.put(prompt_id)
+        await self.broadcast_status()
+        return web.json_response({'prompt_id': prompt_id, 'number': number, 'node_errors': {}})
+
+    async def get_prompt(self, request):
+        return web.json_response({'exec_info': {'queue_remaining': self.queue_remaining}})
+
+    async def websocket(self, request):
+        client_id = request.query.get('clientId') or uuid.uuid4().hex
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        self.sockets[client_id] = ws
+        try:
+            await self.send(client_id, 'status', {
+                'status': {'exec_info': {'queue_remaining': self.queue_remaining}}, 'sid': client_id})
+            async for _ in ws:
+                pass
+        finally:
+            if self.sockets.get(client_id) is ws:
+                del self.sockets[client_id]
+        return ws
+
+    async def get_history(self, request):
+        prompt_id = request.match_info.get('prompt_id')
+        if prompt_id is None:
+            return web.json_response(self.history)
+        entry = self.history.get(prompt_id)
+        return web.json_response({prompt_id: entry} if entry is not None else {})
+
+    async def view(self, request):
+        filename = os.path.basename(request.query.get('filename', ''))
+        path = os.path.join(self.output_dir, request.query.get('subfolder', ''), filename)
+        if not filename or not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        return web.FileResponse(path, headers={'Content-Type': 'image/png'})
+
+    async def system_stats(self, request):
+        return web.json_response({
+            'system': {'os': 'stub', 'comfyui_version': 'stub', 'python_version': '', 'embedded_python': False},
+            'devices': [],
+        })
+
+    async def get_queue(self, request):
+        return web.json_response({
+            'queue_running': [[e['number'], pid, e['prompt'], {}, []] for pid, e in self.running.items()],
+            'queue_pending': [[e['number'], pid, e['prompt'], {}, []] for pid, e in self.pending.items()],
+        })
+
+    async def post_queue(self, request):
+        body = await request.json()
+        if body.get('clear'):
+            self.pending.clear()
+        for prompt_id in body.get('delete', []):
+            self.pending.pop(prompt_id, None)
+        await self.broadcast_status()
+        return web.Response()
+
+    async def interrupt(self, request):
+        try:
+            body = await request.json()
+        except ValueError:
+            body = {}
+        for prompt_id, entry in self.running.items():
+            if not body.get('prompt_id') or body['prompt_id'] == prompt_id:
+                entry['interrupted'] = True
+        return web.Response()
+
+
+def create_app(stub):
+    app = web.Application(client_max_size=100 * 1024 ** 2)
+    app.router.add_post('/prompt', stub.post_prompt)
+    app.router.add_get('/prompt', stub.get_prompt)
+    app.router.add_get('/ws', stub.websocket)
+    app.router.add_get('/history', stub.get_history)
+    app.router.add_get('/history/{prompt_id}', stub.get_history)
+    app.router.add_get('/view', stub.view)
+    app.router.add_get('/system_stats', stub.system_stats)
+    app.router.add_get('/queue', stub.get_queue)
+    app.router.add_post('/queue', stub.post_queue)
+    app.router.add_post('/interrupt', stub.interrupt)
+    app.on_startup.append(stub.start)
+    app.on_shutdown.append(stub.stop)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub ComfyUI server for EzInfer benchmarks')
+    parser.add_argument('--port', type=int, default=8188)
+    parser.add_argument('--output-dir', help='Where outputs are written (default: a temporary directory)')
+    parser.add_argument('--exec-seconds', type=float, default=0.5, help='Execution time of one prompt')
+    parser.add_argument('--submit-seconds', type=float, default=0.0, help='Latency added to POST /prompt')
+    parser.add_argument('--exec-concurrency', type=int, default=1, help='Prompts executed at once')
+    parser.add_argument('--image-bytes', type=int, default=1024 ** 2, help='Size of each output file')
+    parser.add_argument('--images-per-prompt', type=int, default=1)
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix='stub-comfyui-')
+    os.makedirs(output_dir, exist_ok=True)
+    stub = StubComfyUI(output_dir, args.exec_seconds, args.image_bytes, args.images_per_prompt,
+                       args.exec_concurrency, args.submit_seconds)
+    print(f"Stub ComfyUI on http://127.0.0.1:{args.port}, outputs in {output_dir}", flush=True)
+    web.run_app(create_app(stub), host='127.0.0.1', port=args.port, access_log=None, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Shared fixtures of the Python checks in script-tests
+
+The checks import the modules of services/ directly, as the services do,
+and talk to an in-memory S3 (moto) instead of a bucket:
+
+    pip install -r script-tests/requirements.txt
+    python -m pytest script-tests
+"""
+
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'services'))
+
+MB = 1024 ** 2
+
+
+@pytest.fixture
+def s3():
+    """(client, bucket) of an empty in-memory bucket"""
+    boto3 = pytest.importorskip('boto3')
+    moto = pytest.importorskip('moto')
+    env = {'AWS_ACCESS_KEY_ID': 'test', 'AWS_SECRET_ACCESS_KEY': 'test', 'AWS_DEFAULT_REGION': 'us-east-1'}
+    with mock.patch.dict(os.environ, env), moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='workbench')
+        yield client, 'workbench'
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """Write {relative_path: bytes} under tmp_path/source, returning the (local, relative, size, mtime_ns) list"""
+    def write(contents):
+        files = []
+        for relative_path, content in contents.items():
+            path = tmp_path / 'source' / relative_path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(content)
+            stat = path.stat()
+            files.append((str(path), relative_path, stat.st_size, stat.st_mtime_ns))
+        return files
+    return write
@@ -9,22 +9,7 @@ python3 build/generate_extensions_config.py --config build-config.yaml --output
 echo "Generated ComfyUI extensions configuration:"
 cat /tmp/comfyui-extensions.json
 
-# Test parsing the configuration with the Python script from start-comfyui.sh
-cat /tmp/comfyui-extensions.json | python3 -c '
-import json
-import sys
-import os
-
-try:
-    extensions = json.load(sys.stdin)
-    print("\nParsed extensions:")
-    for ext in extensions:
-        name = ext.get("name", "")
-        repo = ext.get("repo", "")
-        path = ext.get("path", "")
-        enabled = ext.get("enabled", False)
-        
-        print(f"- {name}: repo={repo}, path={path}, enabled={enabled}")
-except Exception as e:
-    print(f"Error processing extensions configuration: {e}")
-' 
\ No newline at end of file
+# Test parsing the configuration with the extension installer used by start-comfyui.sh
+echo
+echo "Parsed extensions:"
+python3 scripts/install-extensions.py --config /tmp/comfyui-extensions.json --list
@@ -0,0 +1,57 @@
+"""Archive mode: files written through the frame index come back intact"""
+
+import os
+
+import pytest
+
+import s3archive
+from conftest import MB
+
+pytest.importorskip('zstandard')
+
+
+@pytest.fixture
+def contents():
+    return {
+        'custom_nodes/node/__init__.py': b'NODE_CLASS_MAPPINGS = {}\n',
+        'custom_nodes/node/empty.txt': b'',
+        # Spans several frames and parts
+        'models/checkpoints/model.safetensors': os.urandom(11 * MB + 123),
+        'workflows/flow.json': b'{"1": {"class_type": "KSampler"}}' * 1000,
+    }
+
+
+@pytest.fixture(autouse=True)
+def small_frames(monkeypatch):
+    monkeypatch.setattr(s3archive, 'FRAME_SIZE', 256 * 1024)
+    # The S3 minimum for all parts but the last
+    monkeypatch.setattr(s3archive, 'PART_SIZE', 5 * MB)
+
+
+def test_fetch_through_frame_index(s3, tree, contents):
+    client, bucket = s3
+    index = s3archive.upload_archive(client, bucket, 'snapshot', tree(contents))
+
+    assert len(index['frames']) > 1
+    assert index['compressed_size'] == client.head_object(Bucket=bucket, Key=index['archive'])['ContentLength']
+    assert s3archive.load_index(client, bucket, 'snapshot')['files'] == index['files']
+    for relative_path, content in contents.items():
+        assert s3archive.fetch_archived_file(client, bucket, 'snapshot', relative_path, index) == content
+
+
+def test_fetch_unknown_file(s3, tree, contents):
+    client, bucket = s3
+    index = s3archive.upload_archive(client, bucket, 'snapshot', tree(contents))
+    with pytest.raises(KeyError):
+        s3archive.fetch_archived_file(client, bucket, 'snapshot', 'models/missing.safetensors', index)
+
+
+def test_restore_round_trip(s3, tree, contents, tmp_path):
+    client, bucket = s3
+    s3archive.upload_archive(client, bucket, 'snapshot', tree(contents))
+
+    restored = s3archive.restore_archive(client, bucket, 'snapshot', str(tmp_path / 'target'))
+
+    assert restored == len(contents)
+    for relative_path, content in contents.items():
+        assert (tmp_path / 'target' / relative_path).read_bytes() == content
@@ -0,0 +1,43 @@
+"""Incremental sync: local ETags match the ones S3 computes"""
+
+import os
+
+import pytest
+
+from conftest import MB
+from s3sync import file_etag, normalize_etag, s3_etag
+
+boto3_transfer = pytest.importorskip('boto3.s3.transfer')
+
+
+@pytest.fixture
+def config():
+    # 5 MB is the smallest part S3 accepts
+    return boto3_transfer.TransferConfig(multipart_threshold=8 * MB, multipart_chunksize=5 * MB)
+
+
+def remote_etag(client, bucket, key):
+    return normalize_etag(client.head_object(Bucket=bucket, Key=key)['ETag'])
+
+
+@pytest.mark.parametrize('size', [0, 1, 5 * MB])
+def test_single_part(s3, tree, config, size):
+    client, bucket = s3
+    (path, relative_path, _, _), = tree({'file.bin': os.urandom(size)})
+    with open(path, 'rb') as body:
+        response = client.put_object(Bucket=bucket, Key=relative_path, Body=body)
+
+    assert s3_etag(path, config) == normalize_etag(response['ETag']) == remote_etag(client, bucket, relative_path)
+
+
+@pytest.mark.parametrize('size', [8 * MB, 12 * MB + 1, 15 * MB])
+def test_multipart(s3, tree, config, size):
+    client, bucket = s3
+    (path, relative_path, _, _), = tree({'model.safetensors': os.urandom(size)})
+    client.upload_file(path, bucket, relative_path, Config=config)
+
+    etag = remote_etag(client, bucket, relative_path)
+    assert etag.endswith(f"-{-(-size // (5 * MB))}")
+    assert s3_etag(path, config) == etag
+    assert file_etag(path, 5 * MB) == etag
+    assert file_etag(path) != etag
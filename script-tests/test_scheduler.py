@@ -0,0 +1,112 @@
+"""Admission control: 429 when the queue is full, 503 when a deadline cannot be met"""
+
+import asyncio
+import time
+
+import pytest
+
+from scheduler import AdmissionController, DeadlineExceeded, Overloaded
+
+
+async def hold(controller, count, key='shape'):
+    """Enter count admissions and return their context managers, to exit later"""
+    admissions = [controller.admit(key) for _ in range(count)]
+    for admission in admissions:
+        await admission.__aenter__()
+    return admissions
+
+
+async def release(admissions):
+    for admission in admissions:
+        await admission.__aexit__(None, None, None)
+
+
+def test_admits_up_to_max_in_flight():
+    async def scenario():
+        controller = AdmissionController(max_in_flight=2, max_queue=0)
+        admissions = await hold(controller, 2)
+        assert controller.in_flight == 2
+        await release(admissions)
+        assert controller.in_flight == 0
+        assert controller.rejected == 0
+    asyncio.run(scenario())
+
+
+def test_rejects_with_429_when_queue_full():
+    async def scenario():
+        controller = AdmissionController(max_in_flight=1, max_queue=1, default_estimate=10)
+        admissions = await hold(controller, 1)
+        waiter = asyncio.create_task(hold(controller, 1))
+        await asyncio.sleep(0)
+        assert controller.waiting == 1
+
+        with pytest.raises(Overloaded) as rejected:
+            async with controller.admit('shape'):
+                pass
+        assert rejected.value.status == 429
+        # Two workflows of 10s ahead, a slot frees up after about one of them
+        assert rejected.value.retry_after == 10
+        assert controller.rejected == 1
+
+        await release(admissions)
+        await release(await waiter)
+    asyncio.run(scenario())
+
+
+def test_rejects_with_503_when_deadline_cannot_be_met():
+    async def scenario():
+        controller = AdmissionController(max_in_flight=4, max_queue=4, default_estimate=30)
+        admissions = await hold(controller, 1)
+
+        with pytest.raises(Overloaded) as rejected:
+            async with controller.admit('shape', deadline=time.monotonic() + 5):
+                pass
+        assert rejected.value.status == 503
+        assert rejected.value.retry_after == 30
+
+        # Enough time for the work ahead: admitted
+        async with controller.admit('shape', deadline=time.monotonic() + 60):
+            assert controller.in_flight == 2
+        await release(admissions)
+    asyncio.run(scenario())
+
+
+def test_backlog_is_shared_by_available_backends():
+    async def scenario():
+        backends = 3
+        controller = AdmissionController(max_in_flight=3, max_queue=0, default_estimate=30,
+                                         parallelism=lambda: backends)
+        admissions = await hold(controller, 3)
+        assert controller.stats()['estimated_backlog_seconds'] == 30
+
+        # 30s ahead on each of the three backends
+        with pytest.raises(Overloaded) as rejected:
+            async with controller.admit('shape', deadline=time.monotonic() + 20):
+                pass
+        assert rejected.value.status == 503
+        assert rejected.value.retry_after == 30
+        await release(admissions)
+    asyncio.run(scenario())
+
+
+def test_deadline_expires_while_waiting():
+    async def scenario():
+        controller = AdmissionController(max_in_flight=1, max_queue=1, default_estimate=0.01)
+        admissions = await hold(controller, 1)
+
+        with pytest.raises(DeadlineExceeded):
+            async with controller.admit('shape', deadline=time.monotonic() + 0.05):
+                pass
+        assert controller.waiting == 0
+        await release(admissions)
+        assert controller.in_flight == 0
+    asyncio.run(scenario())
+
+
+def test_estimates_follow_measured_times():
+    controller = AdmissionController(max_in_flight=1, max_queue=0, default_estimate=30, smoothing=0.5)
+    controller.record('shape', 10)
+    controller.record('shape', 20)
+    assert controller.estimate('shape') == 15
+    # Unknown shapes fall back to the average of all measurements
+    assert controller.estimate('other') == 15
@@ -18,6 +18,16 @@ if [ ! -f "$STARTUP_COMPLETE_MARKER" ]; then
     exit 0
 fi
 
+# Readiness also waits for EzInfer's model warm-up, liveness does not
+if [ -f /tmp/.warmup_required ] && [ ! -f /tmp/.warmup_complete ]; then
+    case "$REQUEST_URI" in
+        */readyz*)
+            echo "Models are warming up"
+            exit 1
+            ;;
+    esac
+fi
+
 # Startup is complete, check the actual ComfyUI endpoint
 HEALTHCHECK_URL="http://localhost:8188/prompt"
 HTTP_RESPONSE=$(curl -s -o /dev/null -w "%{http_code}" $HEALTHCHECK_URL)
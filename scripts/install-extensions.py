@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Install the ComfyUI extensions listed in comfyui-extensions.json
+
+Replaces the serial full `git clone` of each extension at startup:
+
+- Each extension is checked out at its pinned `version` (a tag, branch or
+  commit; the remote's default branch when empty) with a depth-1 fetch, and
+  the extensions are installed concurrently.
+- Fetched commits are kept in a bare git cache per repository on the
+  workbench volume (EXTENSIONS_CACHE_DIR). A version already in the cache is
+  checked out from it without touching the network, so reinstalling after a
+  restart, or in a sibling pod sharing the volume, is local. Branch versions
+  are cached as well: clear the cache to pick up newer commits.
+- The requirements.txt of all installed extensions are resolved in one pip
+  install, only for the requirements the environment does not satisfy yet,
+  and skipped altogether while the requirements files are unchanged. pip's
+  wheel and HTTP cache is kept on the workbench volume too.
+- pip runs in target mode (pip.conf, see start-comfyui.sh), where it ignores
+  installed packages and would reinstall every transitive dependency into
+  the user site-packages, shadowing the image's torch, numpy and the like.
+  Requirements are therefore installed with --no-deps, and their
+  dependencies are checked against the environment the same way, round
+  after round, so only the missing ones are installed.
+
+Extensions are cloned into a temporary directory and moved into place when
+complete, so an interrupted install is retried on the next start instead of
+being taken for an installed extension.
+"""
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from importlib import metadata
+
+EXTENSIONS_CONFIG = '/opt/app-root/etc/comfyui-extensions.json'
+BASE_DIR = '/opt/app-root/src'
+CACHE_DIR = os.getenv('EXTENSIONS_CACHE_DIR', '/opt/app-root/src/.cache/comfyui-extensions')
+PIP_CACHE_DIR = os.getenv('PIP_CACHE_DIR', '/opt/app-root/src/.cache/pip')
+INSTALL_CONCURRENCY = int(os.getenv('EXTENSIONS_INSTALL_CONCURRENCY', '4'))
+# Levels of transitive dependencies followed before giving up
+MAX_DEPENDENCY_ROUNDS = 10
+# Hash of the requirements files installed last, next to the packages it describes
+REQUIREMENTS_STAMP = f"/opt/app-root/src/.local/lib/python{sys.version_info.major}.{sys.version_info.minor}/site-packages/.extension-requirements.sha256"
+
+try:
+    from packaging.requirements import InvalidRequirement, Requirement
+except ImportError:
+    from pip._vendor.packaging.requirements import InvalidRequirement, Requirement
+
+
+def git(*args, cwd=None):
+    """Run git and return its stripped stdout, raising CalledProcessError on failure"""
+    result = subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, text=True)
+    return result.stdout.strip()
+
+
+def cache_path(repo):
+    """Bare cache repository of a remote repository"""
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', repo.rstrip('/').rsplit('/', 1)[-1])
+    return os.path.join(CACHE_DIR, 'git', f"{hashlib.sha1(repo.encode('utf-8')).hexdigest()[:12]}-{name}")
+
+
+def pinned_ref(version):
+    return f"refs/pinned/{re.sub(r'[^A-Za-z0-9._-]', '_', version or 'HEAD')}"
+
+
+def fetch_to_cache(repo, version):
+    """Make sure the cache holds version of repo and return the ref it is pinned at"""
+    cache = cache_path(repo)
+    ref = pinned_ref(version)
+    os.makedirs(os.path.dirname(cache), exist_ok=True)
+    # Sibling pods may share the cache: one fetch per repository at a time
+    with open(f"{cache}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.isdir(cache):
+            git('init', '-q', '--bare', cache)
+        try:
+            git('--git-dir', cache, 'rev-parse', '--verify', '-q', f"{ref}^{{commit}}")
+            return ref, False
+        except subprocess.CalledProcessError:
+            pass
+        git('--git-dir', cache, 'fetch', '-q', '--depth', '1', repo, version or 'HEAD')
+        git('--git-dir', cache, 'update-ref', ref, 'FETCH_HEAD')
+        return ref, True
+
+
+def install_extension(ext, base_dir):
+    """Check out one extension at its pinned version; True when it was installed"""
+    name = ext['name']
+    repo = ext['repo']
+    version = ext.get('version', '')
+    path = os.path.join(base_dir, ext['path'])
+    print(f"Installing {name} {version or '(default branch)'} from {repo} to {path}...", flush=True)
+
+    try:
+        ref, fetched = fetch_to_cache(repo, version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        staging = f"{path}.installing"
+        shutil.rmtree(staging, ignore_errors=True)
+        git('init', '-q', staging)
+        git('fetch', '-q', '--depth', '1', f"file://{cache_path(repo)}", ref, cwd=staging)
+        git('checkout', '-q', 'FETCH_HEAD', cwd=staging)
+        git('remote', 'add', 'origin', repo, cwd=staging)
+        os.rename(staging, path)
+    except (subprocess.CalledProcessError, OSError) as e:
+        shutil.rmtree(f"{path}.installing", ignore_errors=True)
+        detail = e.stderr.strip() if isinstance(e, subprocess.CalledProcessError) and e.stderr else str(e)
+        print(f"Failed to install {name}: {detail}", flush=True)
+        return False
+    print(f"Successfully installed {name}{'' if fetched else ' (from cache)'}", flush=True)
+    return True
+
+
+def unsatisfied(lines):
+    """Requirement lines the current environment does not satisfy (unparsable lines are kept)"""
+    needed = []
+    for line in lines:
+        line = line.split(' #', 1)[0].strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('-'):
+            # Options (-r, -e, --index-url, ...) only make sense within their own file
+            print(f"Skipping requirements option: {line}", flush=True)
+            continue
+        try:
+            requirement = Requirement(line)
+        except InvalidRequirement:
+            # URLs and other forms packaging does not parse are left to pip
+            needed.append(line)
+            continue
+        if requirement.marker is not None and not requirement.marker.evaluate({'extra': ''}):
+            continue
+        if requirement.url:
+            needed.append(line)
+            continue
+        try:
+            installed = metadata.version(requirement.name)
+        except metadata.PackageNotFoundError:
+            needed.append(line)
+            continue
+        if not requirement.specifier.contains(installed, prereleases=True):
+            needed.append(line)
+    return needed
+
+
+def dependencies(lines):
+    """Requirement lines of the installed distributions named by lines, extras included and markers resolved"""
+    dependency_lines = []
+    for line in lines:
+        try:
+            requirement = Requirement(line)
+            requires = metadata.requires(requirement.name) or []
+        except (InvalidRequirement, metadata.PackageNotFoundError):
+            # e.g. a bare URL: pip only knows its name, its dependencies are not followed
+            continue
+        extras = requirement.extras or {''}
+        for required in requires:
+            try:
+                dependency = Requirement(required)
+            except InvalidRequirement:
+                continue
+            if dependency.marker is not None:
+                if not any(dependency.marker.evaluate({'extra': extra}) for extra in extras):
+                    continue
+                dependency.marker = None
+            dependency_lines.append(str(dependency))
+    return dependency_lines
+
+
+def pip_install(lines):
+    """Install requirement lines without their dependencies, returning pip's exit code"""
+    command = [sys.executable, '-m', 'pip', 'install', '--no-deps', '--cache-dir', PIP_CACHE_DIR, *lines]
+    return subprocess.run(command).returncode
+
+
+def install_requirements(paths):
+    """Resolve the requirements.txt of the installed extensions in one pip install"""
+    files = [os.path.join(path, 'requirements.txt') for path in paths]
+    files = [f for f in files if os.path.isfile(f)]
+    digest = hashlib.sha256()
+    lines = []
+    for requirements_file in sorted(files):
+        with open(requirements_file, 'rb') as f:
+            content = f.read()
+        digest.update(requirements_file.encode('utf-8') + b'\0' + content)
+        lines.extend(content.decode('utf-8', errors='replace').splitlines())
+    stamp = digest.hexdigest()
+
+    try:
+        with open(REQUIREMENTS_STAMP, 'r') as f:
+            if f.read().strip() == stamp:
+                print("Extension requirements unchanged, skipping pip install", flush=True)
+                return True
+    except OSError:
+        pass
+
+    needed = list(dict.fromkeys(unsatisfied(lines)))
+    if not needed:
+        print("Extension requirements already satisfied", flush=True)
+    attempted = set()
+    for _ in range(MAX_DEPENDENCY_ROUNDS):
+        if not needed:
+            break
+        print(f"Installing {len(needed)} extension requirements: {' '.join(needed)}", flush=True)
+        returncode = pip_install(needed)
+        if returncode != 0:
+            print(f"Failed to install extension requirements (pip exited with {returncode})", flush=True)
+            return False
+        attempted.update(needed)
+        # Dependencies of what was just installed, unless the environment (image included) satisfies them
+        needed = [line for line in dict.fromkeys(unsatisfied(dependencies(needed))) if line not in attempted]
+    else:
+        if needed:
+            print(f"Extension requirements still missing after {MAX_DEPENDENCY_ROUNDS} rounds: "
+                  f"{' '.join(needed)}", flush=True)
+            return False
+
+    os.makedirs(os.path.dirname(REQUIREMENTS_STAMP), exist_ok=True)
+    with open(REQUIREMENTS_STAMP, 'w') as f:
+        f.write(stamp)
+    return True
+
+
+def load_extensions(config_file):
+    with open(config_file, 'r') as f:
+        extensions = json.load(f)
+    return [ext for ext in extensions
+            if ext.get('name') and ext.get('repo') and ext.get('path') and ext.get('enabled', False)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Install ComfyUI extensions')
+    parser.add_argument('--config', default=EXTENSIONS_CONFIG, help='Path to the extensions JSON file')
+    parser.add_argument('--base-dir', default=BASE_DIR, help='Directory extension paths are relative to')
+    parser.add_argument('--list', action='store_true', help='Only print the enabled extensions')
+    args = parser.parse_args()
+
+    try:
+        extensions = load_extensions(args.config)
+    except (OSError, ValueError) as e:
+        print(f"Error processing extensions configuration: {e}")
+        return 1
+
+    if args.list:
+        for ext in extensions:
+            print(f"- {ext['name']}: repo={ext['repo']}, version={ext.get('version') or '(default branch)'}, path={ext['path']}")
+        return 0
+
+    to_install = []
+    for ext in extensions:
+        if os.path.exists(os.path.join(args.base_dir, ext['path'])):
+            print(f"Extension {ext['name']} already installed at {ext['path']}, skipping...")
+        else:
+            to_install.append(ext)
+
+    ok = True
+    if to_install:
+        with ThreadPoolExecutor(max_workers=INSTALL_CONCURRENCY) as executor:
+            ok = all(executor.map(lambda ext: install_extension(ext, args.base_dir), to_install))
+
+    installed = [os.path.join(args.base_dir, ext['path']) for ext in extensions
+                 if os.path.isdir(os.path.join(args.base_dir, ext['path']))]
+    ok = install_requirements(installed) and ok
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
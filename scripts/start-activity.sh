@@ -0,0 +1,12 @@
+#!/bin/bash
+
+set -e
+
+# Activity service answering /api/kernels for the notebook idle culler.
+# It only needs the packages installed in the image, so it starts right away.
+echo "[activity] Starting activity service..."
+
+# Change to the services directory
+cd /opt/app-root/services/
+
+exec python3 activity.py
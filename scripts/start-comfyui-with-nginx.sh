@@ -32,17 +32,95 @@ if [ "$API_MODE" = "true" ]; then
     echo "  gligen: /mnt/models/models/gligen/" >> /tmp/comfyui/extra_model_paths.yaml
 
     # API mode flags
-    ADDITIONAL_FLAGS="--base-directory /tmp/comfyui --database-url sqlite:///:memory: --extra-model-paths-config /tmp/comfyui/extra_model_paths.yaml"
+    ADDITIONAL_FLAGS="--base-directory /tmp/comfyui --extra-model-paths-config /tmp/comfyui/extra_model_paths.yaml"
+    # Flags of the primary ComfyUI only, workers use their own database
+    PRIMARY_FLAGS="--database-url sqlite:///:memory:"
 else
     # Non-API mode flags (default)
-    ADDITIONAL_FLAGS="--base-directory /opt/app-root/src --database-url sqlite:////opt/app-root/src/user/comfyui.db --multi-user"
+    ADDITIONAL_FLAGS="--base-directory /opt/app-root/src"
+    PRIMARY_FLAGS="--database-url sqlite:////opt/app-root/src/user/comfyui.db --multi-user"
 fi
 
-# Set RUNTIME_FLAGS from command-line arguments and additional flags
+# Set RUNTIME_FLAGS (primary ComfyUI) and WORKER_RUNTIME_FLAGS (COMFYUI_WORKERS > 1)
+# from command-line arguments and additional flags
 if [ $# -gt 0 ]; then
-    export RUNTIME_FLAGS="$@ $ADDITIONAL_FLAGS"
+    export WORKER_RUNTIME_FLAGS="$@ $ADDITIONAL_FLAGS"
 else
-    export RUNTIME_FLAGS="$ADDITIONAL_FLAGS"
+    export WORKER_RUNTIME_FLAGS="$ADDITIONAL_FLAGS"
+fi
+export RUNTIME_FLAGS="$WORKER_RUNTIME_FLAGS $PRIMARY_FLAGS"
+
+# Device flags and cores of the primary ComfyUI, set below when COMFYUI_WORKERS > 1
+export COMFYUI_PRIMARY_DEVICE_FLAGS=""
+export COMFYUI_PRIMARY_CPUSET=""
+
+# ComfyUI input/output directories, for the janitor and EzInfer
+if [ "$API_MODE" = "true" ]; then
+    COMFYUI_BASE_DIR="/tmp/comfyui"
+else
+    COMFYUI_BASE_DIR="/opt/app-root/src"
+fi
+export COMFYUI_INPUT_DIR="${COMFYUI_INPUT_DIR:-$COMFYUI_BASE_DIR/input}"
+export COMFYUI_OUTPUT_DIR="${COMFYUI_OUTPUT_DIR:-$COMFYUI_BASE_DIR/output}"
+
+# Additional ComfyUI processes (COMFYUI_WORKERS > 1), e.g. one per GPU or per group of
+# cores on large CPU nodes. EzInfer load-balances workflows over all of them.
+COMFYUI_WORKERS=${COMFYUI_WORKERS:-1}
+WORKERS_CONF="/tmp/supervisord/comfyui-workers.conf"
+mkdir -p "$(dirname "$WORKERS_CONF")"
+rm -f "$WORKERS_CONF"
+if [ "$COMFYUI_WORKERS" -gt 1 ]; then
+    # Pin each process to one GPU (gpu), to its share of the cores (cpu), or not at all (none)
+    PINNING="${COMFYUI_WORKER_PINNING:-}"
+    if [ -z "$PINNING" ]; then
+        case " $EXTRA_FLAGS $RUNTIME_FLAGS " in
+            *" --cpu "*) PINNING="cpu" ;;
+            *) PINNING="gpu" ;;
+        esac
+    fi
+    CORES_PER_WORKER=$(( $(nproc) / COMFYUI_WORKERS ))
+    [ "$CORES_PER_WORKER" -lt 1 ] && CORES_PER_WORKER=1
+
+    BACKENDS="http://127.0.0.1:8188=$COMFYUI_OUTPUT_DIR"
+    for i in $(seq 1 $((COMFYUI_WORKERS - 1))); do
+        PORT=$((8188 + i))
+        WORKER_FLAGS="--listen 127.0.0.1 --port $PORT --output-directory $COMFYUI_OUTPUT_DIR/worker-$i --temp-directory /tmp/comfyui-worker-$i --database-url sqlite:///:memory:"
+        WORKER_ENV="COMFYUI_WORKER_INDEX=\"$i\""
+        if [ "$PINNING" = "gpu" ]; then
+            WORKER_FLAGS="$WORKER_FLAGS --cuda-device $i"
+        elif [ "$PINNING" = "cpu" ]; then
+            FIRST_CORE=$(( (i * CORES_PER_WORKER) % $(nproc) ))
+            WORKER_ENV="$WORKER_ENV,COMFYUI_CPUSET=\"$FIRST_CORE-$((FIRST_CORE + CORES_PER_WORKER - 1))\""
+        fi
+        cat >> "$WORKERS_CONF" << EOF
+[program:comfyui-worker-$i]
+command=/opt/app-root/scripts/start-comfyui-worker.sh --disable-auto-launch %(ENV_EXTRA_FLAGS)s %(ENV_WORKER_RUNTIME_FLAGS)s $WORKER_FLAGS
+environment=$WORKER_ENV
+autostart=true
+autorestart=true
+redirect_stderr=true
+stdout_logfile=/dev/stdout
+stdout_logfile_maxbytes=0
+
+EOF
+        BACKENDS="$BACKENDS,http://127.0.0.1:$PORT=$COMFYUI_OUTPUT_DIR/worker-$i"
+    done
+
+    # The primary ComfyUI takes the first device or cores, passed to supervisord program
+    # comfyui only (command and environment in supervisord.conf)
+    if [ "$PINNING" = "gpu" ]; then
+        export COMFYUI_PRIMARY_DEVICE_FLAGS="--cuda-device 0"
+    elif [ "$PINNING" = "cpu" ]; then
+        export COMFYUI_PRIMARY_CPUSET="0-$((CORES_PER_WORKER - 1))"
+    fi
+    export EZINFER_COMFYUI_BACKENDS="${EZINFER_COMFYUI_BACKENDS:-$BACKENDS}"
+    echo "Starting $COMFYUI_WORKERS ComfyUI processes ($PINNING pinning): $EZINFER_COMFYUI_BACKENDS"
+fi
+
+# Readiness waits for EzInfer's model warm-up when one is configured (see services/warmup.py)
+rm -f /tmp/.warmup_required /tmp/.warmup_complete
+if [ "${ENABLE_EZ_INFER}" = "true" ] && [ -n "${EZINFER_WARMUP}" ]; then
+    touch /tmp/.warmup_required
 fi
 
 # Start nginx and supervisord
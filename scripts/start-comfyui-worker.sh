@@ -0,0 +1,22 @@
+#!/bin/bash
+
+set -e
+
+# Additional ComfyUI process, started when COMFYUI_WORKERS > 1 (see start-comfyui-with-nginx.sh).
+# The primary ComfyUI (start-comfyui.sh) prepares packages, models and extensions,
+# so workers only start once it is ready.
+echo "[comfyui-worker-${COMFYUI_WORKER_INDEX}] Waiting for the primary ComfyUI to be ready..."
+while [ ! -f /tmp/.startup_complete ]; do
+    sleep 5
+done
+
+export PYTHONPATH="/opt/app-root/src/.local/lib/python3.11/site-packages:$PYTHONPATH"
+
+echo "[comfyui-worker-${COMFYUI_WORKER_INDEX}] Starting ComfyUI..."
+cd /opt/app-root/ComfyUI
+if [ -n "$COMFYUI_CPUSET" ]; then
+    # One OpenMP thread per pinned core
+    export OMP_NUM_THREADS="${OMP_NUM_THREADS:-$(taskset -c "$COMFYUI_CPUSET" nproc)}"
+    exec taskset -c "$COMFYUI_CPUSET" python main.py "$@"
+fi
+exec python main.py "$@"
@@ -12,21 +12,10 @@ if [ ! -f "$UUID_FILE" ]; then
     echo "$(uuidgen)" > "$UUID_FILE"
 fi
 
-# Copy existing packages from system site-packages to user site-packages if not already done
-COPY_MARKER="/opt/app-root/src/.packages_copied"
-if [ ! -f "$COPY_MARKER" ]; then
-    echo "Copying system packages to user site-packages..."
-    # Copy all packages from system site-packages to user site-packages
-    if [ -d "/opt/app-root/lib64/python3.11/site-packages" ]; then
-        cp -r /opt/app-root/lib64/python3.11/site-packages/* "$USER_SITE_PACKAGES/" 2>/dev/null || true
-    fi
-    # Also copy from lib (without 64) if it exists
-    if [ -d "/opt/app-root/lib/python3.11/site-packages" ]; then
-        cp -r /opt/app-root/lib/python3.11/site-packages/* "$USER_SITE_PACKAGES/" 2>/dev/null || true
-    fi
-    touch "$COPY_MARKER"
-    echo "Package copying completed."
-fi
+# Sync the image packages into user site-packages: only distributions that changed
+# since the last sync are (re)placed, by hardlink/reflink where possible.
+# Other services run the same script and block until this sync is done.
+python3 /opt/app-root/scripts/sync-site-packages.py || echo "WARNING: site-packages sync failed, continuing startup"
 
 # Configure Python to use user site-packages
 export PYTHONPATH="$USER_SITE_PACKAGES:$PYTHONPATH"
@@ -79,6 +68,21 @@ for dir in "${MODEL_DIRS[@]}"; do
     fi
 done
 
+# Restore models and custom nodes saved to S3 (before ComfyUI starts, so before
+# the startup complete marker is written). Files already present are skipped.
+if [ -n "${S3UPLOADER_RESTORE_PREFIX}" ]; then
+    echo "Restoring ${S3UPLOADER_RESTORE_PREFIX} from S3..."
+    S3RESTORE="python3 /opt/app-root/services/s3restore.py"
+    if [ "${S3UPLOADER_RESTORE_WAIT}" = "priority" ]; then
+        # Wait only for the models the target workflows reference, fetch the rest in the background
+        $S3RESTORE --priority-only || echo "WARNING: S3 restore of referenced models failed, continuing startup"
+        $S3RESTORE >> /tmp/s3restore.log 2>&1 &
+        echo "Remaining files are restored in the background, see /tmp/s3restore.log"
+    else
+        $S3RESTORE || echo "WARNING: S3 restore failed or was incomplete, continuing startup"
+    fi
+fi
+
 # Change to the ComfyUI directory
 cd /opt/app-root/src
 
@@ -87,42 +91,9 @@ EXTENSIONS_CONFIG="/opt/app-root/etc/comfyui-extensions.json"
 if [ -f "$EXTENSIONS_CONFIG" ]; then
     echo "Installing ComfyUI extensions from configuration..."
     
-    # Parse the JSON file and process each extension
-    cat "$EXTENSIONS_CONFIG" | python3 -c '
-import json
-import sys
-import os
-import subprocess
-
-try:
-    extensions = json.load(sys.stdin)
-    for ext in extensions:
-        name = ext.get("name", "")
-        repo = ext.get("repo", "")
-        path = ext.get("path", "")
-        enabled = ext.get("enabled", False)
-        
-        if not (name and repo and path and enabled):
-            continue
-            
-        # Skip if already installed
-        if os.path.exists(path):
-            print(f"Extension {name} already installed at {path}, skipping...")
-            continue
-            
-        print(f"Installing {name} from {repo} to {path}...")
-        # Create parent directory if needed
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        
-        # Clone the repository
-        try:
-            subprocess.run(["git", "clone", repo, path], check=True)
-            print(f"Successfully installed {name}")
-        except subprocess.CalledProcessError as e:
-            print(f"Failed to install {name}: {e}")
-except Exception as e:
-    print(f"Error processing extensions configuration: {e}")
-'
+    # Shallow checkouts at the pinned versions, in parallel, then one pip install of their requirements
+    python3 /opt/app-root/scripts/install-extensions.py --config "$EXTENSIONS_CONFIG" \
+        || echo "WARNING: some extensions or their requirements failed to install, continuing startup"
 else
     echo "No extensions configuration found at $EXTENSIONS_CONFIG"
     
@@ -184,6 +155,11 @@ chmod 644 "$STARTUP_LOG"
 echo "Startup progress is being logged to $STARTUP_LOG"
 echo "You can monitor the progress with: tail -f $STARTUP_LOG"
 
-# Start ComfyUI
+# Start ComfyUI (pinned to its share of the cores when COMFYUI_WORKERS > 1 on CPU nodes)
 cd /opt/app-root/ComfyUI
+if [ -n "$COMFYUI_CPUSET" ]; then
+    # One OpenMP thread per pinned core
+    export OMP_NUM_THREADS="${OMP_NUM_THREADS:-$(taskset -c "$COMFYUI_CPUSET" nproc)}"
+    exec taskset -c "$COMFYUI_CPUSET" python main.py "$@"
+fi
 exec python main.py "$@" 
\ No newline at end of file
@@ -5,12 +5,9 @@ set -e
 # Check if ENABLE_EZ_INFER environment variable is set to true
 if [ "${ENABLE_EZ_INFER}" = "true" ]; then
 
-    # Wait for the Python packages directory to exist
+    # Sync (or wait for the sync of) the Python packages directory; returns at once if up to date
     echo "[ezinfer] Waiting for Python packages directory to be ready..."
-    while [ ! -d "/opt/app-root/src/.local/lib/python3.11/site-packages/" ]; do
-        echo "[ezinfer] Waiting for /opt/app-root/src/.local/lib/python3.11/site-packages/ to exist..."
-        sleep 2
-    done
+    python3 /opt/app-root/scripts/sync-site-packages.py
     echo "[ezinfer] Python packages directory is ready!"
 
     echo "[ezinfer] Starting EzInfer service..."
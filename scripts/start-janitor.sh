@@ -0,0 +1,12 @@
+#!/bin/bash
+
+set -e
+
+# Janitor deleting old ComfyUI input/output files (CLEANUP_USER_INPUT_OUTPUT=true).
+# It only needs the Python standard library, so it starts right away.
+echo "[janitor] Starting input/output janitor..."
+
+# Change to the services directory
+cd /opt/app-root/services/
+
+exec python3 janitor.py
@@ -4,13 +4,9 @@ set -e
 
 # Check if ENABLE_S3UPLOADER environment variable is set to true
 if [ "${ENABLE_S3UPLOADER}" = "true" ]; then
-    # Wait for the Python packages directory to exist
-    COPY_MARKER="/opt/app-root/src/.packages_copied"
+    # Sync (or wait for the sync of) the Python packages directory; returns at once if up to date
     echo "[s3uploader] Waiting for Python packages directory to be ready..."
-    while [ ! -f "$COPY_MARKER" ]; do
-        echo "[s3uploader] Waiting for $COPY_MARKER to exist..."
-        sleep 5
-    done
+    python3 /opt/app-root/scripts/sync-site-packages.py
     echo "[s3uploader] Python packages directory is ready!"
     
     echo "[s3uploader] Starting S3Uploader service..."
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+Sync the image's Python packages into the persistent user site-packages
+
+Replaces the one-off `cp -r` of the whole system site-packages on first start:
+
+- The image's package set is summarized by a manifest hash (one entry per
+  distribution, keyed by the content of its RECORD). When the hash stored in
+  the user site-packages matches, nothing is done, so later starts are
+  instant. After an image upgrade only the distributions that changed are
+  replaced, and those the image no longer ships are removed.
+- Files are hardlinked when source and target share a filesystem, reflinked
+  when the filesystem supports it, and copied otherwise, with a pool of
+  threads.
+- Distributions the user installed or upgraded in the user site-packages are
+  left alone.
+- The manifest is only saved when every file was placed, so a failed sync is
+  retried on the next start.
+- Every service that needs the packages runs this script. It holds an
+  exclusive lock while syncing: the first caller does the work, the others
+  block on the lock (no polling) and return as soon as the sync is done.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PYTHON_VERSION = f"python{sys.version_info.major}.{sys.version_info.minor}"
+SOURCE_DIRS = [
+    f"/opt/app-root/lib64/{PYTHON_VERSION}/site-packages",
+    f"/opt/app-root/lib/{PYTHON_VERSION}/site-packages",
+]
+TARGET_DIR = f"/opt/app-root/src/.local/lib/{PYTHON_VERSION}/site-packages"
+MANIFEST_NAME = '.image-packages.json'
+# Marker of the former full copy, used to tell stale copies from user installs
+LEGACY_MARKER = '/opt/app-root/src/.packages_copied'
+LOCK_FILE = '/tmp/.site-packages-sync.lock'
+
+MANIFEST_VERSION = 1
+COPY_THREADS = int(os.getenv('SITE_PACKAGES_SYNC_THREADS', '16'))
+
+# ioctl request number of FICLONE (Linux reflink)
+FICLONE = 0x40049409
+
+
+def log(message):
+    print(f"[site-packages] {message}", flush=True)
+
+
+def read_record(dist_info):
+    """Relative paths listed in a dist-info RECORD, [] if there is none"""
+    try:
+        with open(os.path.join(dist_info, 'RECORD'), 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+    paths = []
+    for line in lines:
+        # RECORD is CSV: path,hash,size (paths with commas are quoted)
+        path = line.rsplit(',', 2)[0].strip('"')
+        # Console scripts and data files live outside site-packages
+        if path and not path.startswith('..') and not os.path.isabs(path):
+            paths.append(path)
+    return paths
+
+
+def scan_distributions(site_dir):
+    """{name: {'dist_info', 'key', 'version'}} for every *.dist-info in site_dir"""
+    distributions = {}
+    try:
+        entries = os.listdir(site_dir)
+    except OSError:
+        return distributions
+    for entry in entries:
+        if not entry.endswith('.dist-info'):
+            continue
+        name, _, version = entry[:-len('.dist-info')].partition('-')
+        dist_info = os.path.join(site_dir, entry)
+        digest = hashlib.sha256(entry.encode('utf-8'))
+        try:
+            with open(os.path.join(dist_info, 'RECORD'), 'rb') as f:
+                digest.update(f.read())
+        except OSError:
+            pass
+        distributions[name.lower().replace('_', '-')] = {
+            'dist_info': entry,
+            'version': version,
+            'key': digest.hexdigest(),
+        }
+    return distributions
+
+
+def image_manifest(source_dirs):
+    """Distributions of the image (first source dir wins) and the manifest hash"""
+    distributions = {}
+    for source_dir in source_dirs:
+        for name, dist in scan_distributions(source_dir).items():
+            if name not in distributions:
+                distributions[name] = dict(dist, source=source_dir)
+    digest = hashlib.sha256(PYTHON_VERSION.encode('utf-8'))
+    for name in sorted(distributions):
+        digest.update(f"{name}:{distributions[name]['key']}\n".encode('utf-8'))
+    return distributions, digest.hexdigest()
+
+
+def load_manifest(target_dir):
+    try:
+        with open(os.path.join(target_dir, MANIFEST_NAME), 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def save_manifest(target_dir, manifest_hash, distributions):
+    path = os.path.join(target_dir, MANIFEST_NAME)
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump({
+            'version': MANIFEST_VERSION,
+            'hash': manifest_hash,
+            'updated': time.time(),
+            'distributions': {name: {'dist_info': d['dist_info'], 'key': d['key']} for name, d in distributions.items()},
+        }, f)
+    os.replace(f"{path}.tmp", path)
+
+
+class FileLinker:
+    """Places files by hardlink, reflink or copy, remembering what the filesystems allow"""
+
+    def __init__(self):
+        self.can_link = True
+        self.can_reflink = True
+        self.counts = {'linked': 0, 'reflinked': 0, 'copied': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, how):
+        with self._lock:
+            self.counts[how] += 1
+
+    def place(self, source, target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.lexists(target):
+            os.unlink(target)
+        if os.path.islink(source):
+            os.symlink(os.readlink(source), target)
+            return
+        if self.can_link:
+            try:
+                os.link(source, target)
+                self._count('linked')
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                    raise
+                self.can_link = False
+        if self.can_reflink:
+            try:
+                with open(source, 'rb') as src, open(target, 'wb') as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                shutil.copystat(source, target)
+                self._count('reflinked')
+                return
+            except OSError:
+                self.can_reflink = False
+        shutil.copy2(source, target)
+        self._count('copied')
+
+
+def remove_distribution(target_dir, dist_info):
+    """Delete the files of an installed distribution, the directories they leave empty and its dist-info"""
+    directories = set()
+    for path in read_record(os.path.join(target_dir, dist_info)):
+        try:
+            os.unlink(os.path.join(target_dir, path))
+        except OSError:
+            pass
+        parent = os.path.dirname(path)
+        while parent and not parent.startswith('..'):
+            directories.add(parent)
+            parent = os.path.dirname(parent)
+    # Deepest first; directories still holding other files are kept
+    for directory in sorted(directories, key=lambda d: d.count('/'), reverse=True):
+        try:
+            os.rmdir(os.path.join(target_dir, directory))
+        except OSError:
+            pass
+    shutil.rmtree(os.path.join(target_dir, dist_info), ignore_errors=True)
+
+
+def plan(target_dir, distributions, installed, previous, legacy_copy_time):
+    """Names of image distributions to (re)place in the target, with their stale dist-info to remove"""
+    owned = (previous or {}).get('distributions', {})
+    to_sync = []
+    for name, dist in distributions.items():
+        current = installed.get(name)
+        if current is None:
+            to_sync.append((name, None))
+            continue
+        if current['key'] == dist['key']:
+            continue
+        # Only replace what this sync (or the legacy full copy) put there, never a user install
+        ours = name in owned and owned[name]['key'] == current['key']
+        if not ours and previous is None and legacy_copy_time is not None:
+            dist_info_mtime = os.stat(os.path.join(target_dir, current['dist_info'])).st_mtime
+            ours = dist_info_mtime <= legacy_copy_time
+        if ours:
+            to_sync.append((name, current['dist_info']))
+    return to_sync
+
+
+def dropped(distributions, installed, previous):
+    """Dist-info of distributions a previous sync placed that the image no longer ships, unless changed since"""
+    owned = (previous or {}).get('distributions', {})
+    return [installed[name]['dist_info'] for name, dist in owned.items()
+            if name not in distributions and name in installed and installed[name]['key'] == dist['key']]
+
+
+def unowned_entries(source_dir, distributions):
+    """Top-level entries of a source dir that no RECORD claims (e.g. .pth files of old installs)"""
+    claimed = set()
+    for dist in distributions.values():
+        if dist['source'] != source_dir:
+            continue
+        claimed.add(dist['dist_info'])
+        for path in read_record(os.path.join(source_dir, dist['dist_info'])):
+            claimed.add(path.split('/', 1)[0])
+    try:
+        entries = os.listdir(source_dir)
+    except OSError:
+        return []
+    return [entry for entry in entries if entry not in claimed and entry != '__pycache__'
+            and not entry.endswith('.dist-info')]
+
+
+def sync(source_dirs, target_dir):
+    os.makedirs(target_dir, exist_ok=True)
+    source_dirs = list(dict.fromkeys(os.path.realpath(d) for d in source_dirs if os.path.isdir(d)))
+    distributions, manifest_hash = image_manifest(source_dirs)
+    previous = load_manifest(target_dir)
+    if previous is not None and previous.get('hash') == manifest_hash:
+        log("User site-packages already match the image packages")
+        return
+
+    started = time.monotonic()
+    legacy_copy_time = os.stat(LEGACY_MARKER).st_mtime if os.path.exists(LEGACY_MARKER) else None
+    installed = scan_distributions(target_dir)
+    to_sync = plan(target_dir, distributions, installed, previous, legacy_copy_time)
+    to_remove = dropped(distributions, installed, previous)
+    log(f"Syncing {len(to_sync)} of {len(distributions)} distributions into {target_dir}, "
+        f"removing {len(to_remove)} no longer in the image")
+    for dist_info in to_remove:
+        remove_distribution(target_dir, dist_info)
+
+    # (distribution name or None, source dir, relative path)
+    files = []
+    for name, stale_dist_info in to_sync:
+        if stale_dist_info is not None:
+            remove_distribution(target_dir, stale_dist_info)
+        dist = distributions[name]
+        source_dir = dist['source']
+        dist_files = read_record(os.path.join(source_dir, dist['dist_info']))
+        if not dist_files:
+            # No RECORD: the dist-info is all we know about
+            dist_files = [os.path.relpath(os.path.join(root, f), source_dir)
+                          for root, _, names in os.walk(os.path.join(source_dir, dist['dist_info'])) for f in names]
+        files.extend((name, source_dir, path) for path in dist_files)
+
+    # Entries no distribution owns are only added when missing, never overwritten
+    for source_dir in source_dirs:
+        for entry in unowned_entries(source_dir, distributions):
+            if os.path.lexists(os.path.join(target_dir, entry)):
+                continue
+            entry_path = os.path.join(source_dir, entry)
+            if os.path.isdir(entry_path) and not os.path.islink(entry_path):
+                files.extend((None, source_dir, os.path.relpath(os.path.join(root, f), source_dir))
+                             for root, _, names in os.walk(entry_path) for f in names)
+            else:
+                files.append((None, source_dir, entry))
+
+    linker = FileLinker()
+    failed = set()
+
+    def place(item):
+        name, source_dir, path = item
+        source = os.path.join(source_dir, path)
+        if not os.path.lexists(source):
+            # RECORD lists .pyc files that may never have been written
+            return
+        try:
+            linker.place(source, os.path.join(target_dir, path))
+        except OSError as e:
+            log(f"Warning: cannot sync {path}: {e}")
+            failed.add(name)
+
+    with ThreadPoolExecutor(max_workers=COPY_THREADS) as executor:
+        list(executor.map(place, files, chunksize=64))
+
+    if failed:
+        # Without their dist-info the incomplete distributions are synced again on the next start
+        for name in failed - {None}:
+            shutil.rmtree(os.path.join(target_dir, distributions[name]['dist_info']), ignore_errors=True)
+        log("Warning: some files were not synced, the sync will be retried on the next start")
+    else:
+        save_manifest(target_dir, manifest_hash, distributions)
+    counts = linker.counts
+    log(f"Synced {len(files)} files in {time.monotonic() - started:.1f}s "
+        f"({counts['linked']} hardlinked, {counts['reflinked']} reflinked, {counts['copied']} copied)")
+
+
+def main():
+    # The first caller syncs; concurrent callers block here until it is done
+    with open(LOCK_FILE, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        sync(SOURCE_DIRS, TARGET_DIR)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Activity Service
+
+Answers the ODH notebook culler's /api/kernels polls and the pod probes
+(/healthz, /livez, /readyz, see health.py) from memory. The last activity
+and the execution state are kept up to date in the background:
+
+- the ComfyUI nginx access log is followed (a cheap stat every second, the
+  new bytes are read only when it grew) and the timestamp of its last line
+  becomes the last activity;
+- the ComfyUI WebSocket broadcasts a status event with queue_remaining on
+  every queue change, so generations queued without going through nginx
+  (e.g. by EzInfer) also count as activity while the queue is not empty,
+  and "busy" needs no HTTP call to /prompt. Execution events are only sent
+  to the client that queued the prompt, never to this service.
+
+The response has the same shape as nginx/api/kernels/access.cgi, which nginx
+keeps as a fallback when this service is not running.
+
+/metrics re-exports the Prometheus text files of METRICS_TEXTFILE_DIR (see
+metrics.py) for nginx to fall back on when EzInfer is not running.
+"""
+
+import asyncio
+import json
+import os
+import re
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+from comfy_client import ComfyUIClient
+from comfy_ws import ComfyUIEventHub
+from health import HealthMonitor
+from metrics import register_textfile_collector, render_metrics
+
+COMFYUI_API_ADDRESS = "http://127.0.0.1:8188"
+ACCESS_LOG = os.getenv('ACTIVITY_ACCESS_LOG', '/tmp/log/nginx/comfyui.access.log')
+STARTUP_COMPLETE_MARKER = "/tmp/.startup_complete"
+UUID_FILE = "/tmp/comfyui_uuid"
+DEFAULT_ID = "00000000-0000-0000-0000-000000000000"
+
+# How often the access log is checked for new lines
+LOG_POLL_INTERVAL = 1.0
+# Bytes read from the end of the log to find its last line at startup
+LOG_TAIL_BYTES = 64 * 1024
+
+LOG_TIMESTAMP = re.compile(rb'\[(\d{2}/\w{3}/\d{4}:\d{2}:\d{2}:\d{2}) ([+-]\d{4})\]')
+
+def read_comfyui_id():
+    """ComfyUI UUID written by start-comfyui.sh, or the all-zeros UUID"""
+    try:
+        with open(UUID_FILE, 'r') as f:
+            return f.read().strip() or DEFAULT_ID
+    except OSError:
+        return DEFAULT_ID
+
+
+def parse_log_timestamp(line):
+    """UTC datetime of an nginx access log line, or None"""
+    match = LOG_TIMESTAMP.search(line)
+    if match is None:
+        return None
+    try:
+        local = datetime.strptime(f"{match.group(1).decode()} {match.group(2).decode()}", '%d/%b/%Y:%H:%M:%S %z')
+    except ValueError:
+        return None
+    return local.astimezone(timezone.utc)
+
+
+class ActivityTracker:
+    """Last activity and execution state of the workbench, kept in memory"""
+
+    def __init__(self, hub=None):
+        self.hub = hub
+        self.comfyui_id = read_comfyui_id()
+        self.last_activity = None
+        self._started = False
+
+    def touch(self, when=None):
+        """Record activity at when (UTC datetime, default now) if it is the most recent"""
+        when = when or datetime.now(timezone.utc)
+        if self.last_activity is None or when > self.last_activity:
+            self.last_activity = when
+
+    def on_comfyui_event(self, msg_type, data):
+        # Only status events are broadcast: queue_remaining > 0 means a prompt is queued or running
+        if msg_type == 'status':
+            if (data.get('status', {}).get('exec_info', {}).get('queue_remaining') or 0) > 0:
+                self.touch()
+
+    @property
+    def execution_state(self):
+        if not self._started:
+            # The marker is never removed: stop checking once it exists
+            if not os.path.exists(STARTUP_COMPLETE_MARKER):
+                return "starting"
+            self._started = True
+        if self.hub is not None and self.hub.connected and (self.hub.queue_remaining or 0) > 0:
+            return "busy"
+        return "idle"
+
+    def kernels(self):
+        """The /api/kernels payload"""
+        last_activity = ""
+        if self.last_activity is not None:
+            last_activity = self.last_activity.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        return [{
+            "id": self.comfyui_id,
+            "name": "python3",
+            "last_activity": last_activity,
+            "execution_state": self.execution_state,
+            "connections": 1
+        }]
+
+
+class AccessLogFollower:
+    """Follows the nginx access log and reports the timestamp of each new last line"""
+
+    def __init__(self, path, on_timestamp):
+        self.path = path
+        self.on_timestamp = on_timestamp
+        self._inode = None
+        self._offset = 0
+
+    def _read_from(self, f, offset):
+        f.seek(offset)
+        data = f.read()
+        # Only complete lines: nginx may be halfway through writing the last one
+        end = data.rfind(b'\n')
+        if end < 0:
+            return offset
+        start = data.rfind(b'\n', 0, end) + 1
+        timestamp = parse_log_timestamp(data[start:end])
+        if timestamp is not None:
+            self.on_timestamp(timestamp)
+        return offset + end + 1
+
+    def check(self):
+        """Read what was appended since the last check (one stat when nothing changed)"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        if stat.st_ino != self._inode:
+            # New or rotated log: only its last line matters
+            self._inode = stat.st_ino
+            self._offset = max(0, stat.st_size - LOG_TAIL_BYTES)
+        elif stat.st_size < self._offset:
+            # Truncated in place
+            self._offset = 0
+        if stat.st_size == self._offset:
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                self._offset = self._read_from(f, self._offset)
+        except OSError:
+            return
+
+    async def run(self):
+        while True:
+            self.check()
+            await asyncio.sleep(LOG_POLL_INTERVAL)
+
+
+routes = web.RouteTableDef()
+
+
+@routes.get('/api/kernels')
+async def kernels(request):
+    return web.Response(text=json.dumps(request.app['activity'].kernels()), content_type='application/json')
+
+
+@routes.get('/healthz')
+@routes.get('/livez')
+async def liveness(request):
+    """Liveness: succeeds while starting and unless ComfyUI has been failing for HEALTH_LIVENESS_TIMEOUT"""
+    health = request.app['health'].snapshot()
+    return web.json_response(health, status=200 if health['live'] else 503)
+
+
+@routes.get('/readyz')
+async def readiness(request):
+    """Readiness: started, ComfyUI reachable and its queue not saturated"""
+    health = request.app['health'].snapshot()
+    return web.json_response(health, status=200 if health['ready'] else 503)
+
+
+@routes.get('/metrics')
+async def metrics(request):
+    """Prometheus metrics written by the janitor and other processes without an endpoint"""
+    body, content_type = render_metrics()
+    return web.Response(body=body, headers={"Content-Type": content_type})
+
+
+async def activity_ctx(app):
+    """Start the ComfyUI WebSocket hub, the health monitor and the access log follower"""
+    client = ComfyUIClient(COMFYUI_API_ADDRESS, pool_size=4)
+    await client.start()
+    hub = ComfyUIEventHub(client)
+    tracker = ActivityTracker(hub)
+    hub.on_event = tracker.on_comfyui_event
+    follower = AccessLogFollower(ACCESS_LOG, tracker.touch)
+    follower.check()
+    await hub.start()
+    health = HealthMonitor(client, hub)
+    await health.start()
+    follow_task = asyncio.create_task(follower.run())
+    app['activity'] = tracker
+    app['health'] = health
+    yield
+    follow_task.cancel()
+    await asyncio.gather(follow_task, return_exceptions=True)
+    await health.close()
+    await hub.close()
+    await client.close()
+
+
+def create_app():
+    """Build the activity aiohttp application"""
+    app = web.Application()
+    app.cleanup_ctx.append(activity_ctx)
+    app.add_routes(routes)
+    register_textfile_collector()
+    return app
+
+
+if __name__ == '__main__':
+    print("Starting activity service on http://127.0.0.1:5002")
+    web.run_app(create_app(), host='127.0.0.1', port=5002, access_log=None)
@@ -0,0 +1,254 @@
+"""
+EzInfer ComfyUI backends
+
+EzInfer can spread workflows over several ComfyUI processes, e.g. one per
+GPU or one per group of cores on large CPU nodes (COMFYUI_WORKERS, see
+start-comfyui-with-nginx.sh). Backends are listed in
+EZINFER_COMFYUI_BACKENDS as comma-separated URLs, each optionally followed
+by `=<output directory>` when the process writes its outputs locally:
+
+    http://127.0.0.1:8188=/opt/app-root/src/output,http://127.0.0.1:8189=/opt/app-root/src/output/worker-1
+
+Each backend has its own pooled client, WebSocket hub and health monitor.
+A workflow goes to the available backend with the least outstanding work
+(estimated seconds admitted to it), preferring a backend that recently ran
+the same model files when it is not much busier, so checkpoints are not
+loaded on every process. Backends whose health checks fail (degraded or
+down, see health.py) receive no new work until they recover.
+
+Outputs are tagged with the name of the backend that produced them, and the
+pool routes /view requests for them to that backend.
+"""
+
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from comfy_client import ComfyUIClient, ComfyUIError
+from comfy_ws import ComfyUIEventHub
+from health import HealthMonitor
+
+# Seconds of extra outstanding work accepted to reuse a backend that has the models loaded
+AFFINITY_SLACK_SECONDS = float(os.getenv('EZINFER_AFFINITY_SLACK_SECONDS', '60'))
+# Model files remembered per backend (roughly what fits in its memory)
+AFFINITY_MODELS = int(os.getenv('EZINFER_AFFINITY_MODELS', '4'))
+
+MODEL_EXTENSIONS = ('.safetensors', '.ckpt', '.pt', '.pth', '.bin', '.gguf', '.sft', '.onnx')
+
+# Best state first: the pool is as healthy as its best backend
+STATE_RANK = ('ready', 'saturated', 'starting', 'degraded', 'down')
+
+
+def workflow_models(workflow):
+    """Model files a workflow loads (the *_name inputs of its loader nodes)"""
+    models = set()
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        for name, value in (node.get('inputs') or {}).items():
+            if name.endswith('_name') and isinstance(value, str) and value.lower().endswith(MODEL_EXTENSIONS):
+                models.add(value)
+    return models
+
+
+def parse_backends(spec, default_url, default_output_dir=None):
+    """[(url, output_dir)] from EZINFER_COMFYUI_BACKENDS; the default backend when empty"""
+    backends = []
+    for entry in (spec or '').split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        url, _, output_dir = entry.partition('=')
+        backends.append((url.strip().rstrip('/'), output_dir.strip() or None))
+    return backends or [(default_url, default_output_dir)]
+
+
+class ComfyUIBackend:
+    """One ComfyUI process and the work EzInfer has outstanding on it"""
+
+    def __init__(self, name, url, output_dir=None, pool_size=100, timeout=3600):
+        self.name = name
+        self.url = url
+        self.output_dir = output_dir
+        self.client = ComfyUIClient(url, pool_size=pool_size, timeout=timeout)
+        self.hub = None
+        self.health = None
+        self.in_flight = 0
+        self.pending_work = 0.0
+        self.completed = 0
+        self.models = OrderedDict()
+        # Monotonic time the last workflow (or warm-up, see warmup.py) finished
+        self.last_used = time.monotonic()
+
+    async def start(self, on_node_executed=None):
+        await self.client.start()
+        self.hub = ComfyUIEventHub(self.client)
+        self.hub.on_node_executed = on_node_executed
+        await self.hub.start()
+        self.health = HealthMonitor(self.client, self.hub)
+        await self.health.start()
+
+    async def close(self):
+        if self.health is not None:
+            await self.health.close()
+        if self.hub is not None:
+            await self.hub.close()
+        await self.client.close()
+
+    @property
+    def available(self):
+        """False while health checks fail (ejected from routing)"""
+        return self.health is None or self.health.state not in ('degraded', 'down')
+
+    def remember_models(self, models):
+        for model in models:
+            self.models.pop(model, None)
+            self.models[model] = True
+        while len(self.models) > AFFINITY_MODELS:
+            self.models.popitem(last=False)
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'url': self.url,
+            'state': self.health.state if self.health is not None else None,
+            'in_flight': self.in_flight,
+            'outstanding_seconds': round(self.pending_work, 2),
+            'completed': self.completed,
+            'idle_seconds': round(time.monotonic() - self.last_used, 2) if self.in_flight == 0 else 0,
+            'queue_remaining': self.hub.queue_remaining if self.hub is not None else None,
+            'models': list(self.models),
+        }
+
+
+class BackendPool:
+    """Routes workflows to backends and output requests back to their backend.
+
+    Exposes open_view/fetch_view like ComfyUIClient, so the output helpers
+    in ezinfer_outputs.py work with the pool in place of a single client.
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+        self._by_name = {backend.name: backend for backend in backends}
+
+    @classmethod
+    def from_spec(cls, spec, default_url, default_output_dir=None, pool_size=100, timeout=3600):
+        backends = [
+            ComfyUIBackend(str(index), url, output_dir, pool_size=pool_size, timeout=timeout)
+            for index, (url, output_dir) in enumerate(parse_backends(spec, default_url, default_output_dir))
+        ]
+        return cls(backends)
+
+    async def start(self, on_node_executed=None):
+        for backend in self.backends:
+            await backend.start(on_node_executed)
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.close()
+
+    @property
+    def queue_remaining(self):
+        return sum(backend.hub.queue_remaining or 0 for backend in self.backends if backend.hub is not None)
+
+    @property
+    def available_count(self):
+        """Backends receiving work, at least 1 (all are used when none is available)"""
+        return sum(1 for backend in self.backends if backend.available) or len(self.backends)
+
+    @property
+    def connected(self):
+        return all(backend.hub is not None and backend.hub.connected for backend in self.backends)
+
+    def pick(self, models=None):
+        """Backend for the next workflow: least outstanding work, with model affinity"""
+        candidates = [backend for backend in self.backends if backend.available] or self.backends
+        least = min(backend.pending_work for backend in candidates)
+        if models:
+            warm = [backend for backend in candidates
+                    if backend.pending_work <= least + AFFINITY_SLACK_SECONDS and models & backend.models.keys()]
+            if warm:
+                return min(warm, key=lambda b: (-len(models & b.models.keys()), b.pending_work, b.in_flight))
+        return min(candidates, key=lambda b: (b.pending_work, b.in_flight))
+
+    @asynccontextmanager
+    async def lease(self, models=None, work=0.0, backend=None):
+        """Pick a backend (or use the given one) and count work as outstanding on it for the duration of the block"""
+        backend = backend or self.pick(models)
+        backend.in_flight += 1
+        backend.pending_work += work
+        try:
+            yield backend
+        finally:
+            backend.in_flight -= 1
+            backend.pending_work -= work
+            backend.last_used = time.monotonic()
+
+    def backend_for(self, image_info):
+        """Backend that produced an output (the first one for untagged outputs)"""
+        name = image_info.get('backend')
+        if name is None:
+            return self.backends[0]
+        backend = self._by_name.get(name)
+        if backend is None:
+            raise ComfyUIError(f"Unknown ComfyUI backend '{name}'")
+        return backend
+
+    def open_view(self, image_info):
+        return self.backend_for(image_info).client.open_view(image_info)
+
+    async def fetch_view(self, image_info):
+        return await self.backend_for(image_info).client.fetch_view(image_info)
+
+    def stats(self):
+        return [backend.stats() for backend in self.backends]
+
+
+class PoolHealth:
+    """HealthMonitor-like view over the backends: as healthy as the best one.
+
+    saturated is an optional callable returning True when the caller itself
+    cannot take more work (e.g. EzInfer's admission queue is full).
+    """
+
+    def __init__(self, pool, saturated=None):
+        self.pool = pool
+        self.saturated = saturated
+
+    @property
+    def state(self):
+        state = min((backend.health.state for backend in self.pool.backends), key=STATE_RANK.index)
+        if state == 'ready' and self.saturated is not None and self.saturated():
+            return 'saturated'
+        return state
+
+    @property
+    def live(self):
+        return self.state != 'down'
+
+    @property
+    def ready(self):
+        return self.state == 'ready'
+
+    def snapshot(self):
+        """Cached state for probe responses, with the state of each backend"""
+        snapshots = [backend.health.snapshot() for backend in self.pool.backends]
+        state = self.state
+        errors = [s['comfyui']['error'] for s in snapshots if s['comfyui']['error']]
+        return {
+            'state': state,
+            'live': state != 'down',
+            'ready': state == 'ready',
+            'comfyui': {
+                'reachable': any(s['comfyui']['reachable'] for s in snapshots),
+                'queue_remaining': sum(s['comfyui']['queue_remaining'] or 0 for s in snapshots),
+                'error': errors[0] if errors else None,
+            },
+            'backends': [
+                dict(s, name=backend.name, url=backend.url)
+                for backend, s in zip(self.pool.backends, snapshots)
+            ],
+            'checked_at': max((s['checked_at'] or 0 for s in snapshots), default=None) or None,
+        }
@@ -0,0 +1,120 @@
+"""
+ComfyUI API client
+
+Asyncio wrapper around the ComfyUI HTTP/WebSocket API. A single pooled
+aiohttp session is shared by every EzInfer request so TCP connections to
+ComfyUI are reused instead of being re-established on each call.
+"""
+
+import urllib.parse
+
+import aiohttp
+
+
+class ComfyUIError(Exception):
+    """Raised when ComfyUI rejects a request or returns an unexpected payload"""
+
+
+class ComfyUIClient:
+    """Pooled client for a single ComfyUI instance"""
+
+    def __init__(self, base_url, pool_size=100, timeout=3600):
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.request_timeout = aiohttp.ClientTimeout(total=timeout)
+        self.session = None
+
+    async def start(self):
+        """Open the shared HTTP session"""
+        connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+        # No session-wide total timeout: it would also cap long-lived WebSockets.
+        # HTTP calls pass request_timeout explicitly.
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30),
+        )
+
+    async def close(self):
+        """Close the shared HTTP session and all pooled connections"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def ws_url(self, client_id):
+        """WebSocket address for the given client id"""
+        return f"{self.base_url.replace('http', 'ws', 1)}/ws?clientId={client_id}"
+
+    def view_url(self, image_info):
+        """Build the /view URL for an output entry taken from the history"""
+        query = {
+            'filename': image_info['filename'],
+            'type': image_info.get('type', 'output'),
+        }
+        if image_info.get('subfolder'):
+            query['subfolder'] = image_info['subfolder']
+        return f"{self.base_url}/view?{urllib.parse.urlencode(query)}"
+
+    async def connect_ws(self, client_id):
+        """Open a WebSocket to ComfyUI reusing the pooled session"""
+        return await self.session.ws_connect(self.ws_url(client_id), heartbeat=30)
+
+    async def submit_prompt(self, workflow, client_id):
+        """Queue a workflow and return the ComfyUI response payload"""
+        payload = {'prompt': workflow, 'client_id': client_id}
+        async with self.session.post(f"{self.base_url}/prompt", json=payload,
+                                     timeout=self.request_timeout) as response:
+            result = await response.json(content_type=None)
+            if response.status >= 400 or 'error' in result:
+                raise ComfyUIError(f"ComfyUI prompt error: {result.get('error', result)}")
+        if not result.get('prompt_id'):
+            raise ComfyUIError("ComfyUI did not return a prompt_id")
+        return result
+
+    async def get_history(self, prompt_id):
+        """Return the history entry of a prompt, or None if not (yet) available"""
+        async with self.session.get(f"{self.base_url}/history/{prompt_id}",
+                                    timeout=self.request_timeout) as response:
+            response.raise_for_status()
+            history = await response.json(content_type=None)
+        return history.get(prompt_id)
+
+    def open_view(self, image_info):
+        """Open a streaming /view response (use as an async context manager)"""
+        return self.session.get(self.view_url(image_info), timeout=self.request_timeout)
+
+    async def fetch_view(self, image_info):
+        """Download an output file through /view"""
+        async with self.session.get(self.view_url(image_info), timeout=self.request_timeout) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    async def delete_from_queue(self, prompt_ids):
+        """Remove pending prompts from the ComfyUI queue"""
+        async with self.session.post(f"{self.base_url}/queue", json={'delete': list(prompt_ids)},
+                                     timeout=self.request_timeout) as response:
+            response.raise_for_status()
+
+    async def interrupt(self, prompt_id=None):
+        """Interrupt the running prompt (only the given one on ComfyUI versions that support it)"""
+        payload = {'prompt_id': prompt_id} if prompt_id else {}
+        async with self.session.post(f"{self.base_url}/interrupt", json=payload,
+                                     timeout=self.request_timeout) as response:
+            response.raise_for_status()
+
+    async def system_stats(self, timeout=10):
+        """Return ComfyUI /system_stats, raising on HTTP or network errors"""
+        async with self.session.get(
+            f"{self.base_url}/system_stats",
+            timeout=aiohttp.ClientTimeout(total=timeout),
+        ) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def prompt_status(self, timeout=5):
+        """Return ComfyUI GET /prompt (exec_info.queue_remaining), raising on HTTP or network errors"""
+        async with self.session.get(
+            f"{self.base_url}/prompt",
+            timeout=aiohttp.ClientTimeout(total=timeout),
+        ) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
@@ -0,0 +1,290 @@
+"""
+ComfyUI WebSocket multiplexer
+
+One long-lived WebSocket per EzInfer process. Every prompt is queued with the
+hub's client id, so ComfyUI sends all execution events to this single socket.
+Each message is decoded once and handed to the request waiting on its
+prompt_id. If the socket drops, the hub reconnects in the background and
+polls /history for the pending prompts so no completion is missed.
+"""
+
+import asyncio
+import base64
+import json
+import struct
+import time
+import uuid
+from collections import OrderedDict
+
+import aiohttp
+
+from comfy_client import ComfyUIError
+
+# Number of finished prompt ids remembered for watchers registered late
+FINISHED_BUFFER_SIZE = 1024
+
+# ComfyUI binary WebSocket event types
+BINARY_PREVIEW_IMAGE = 1
+BINARY_PREVIEW_IMAGE_WITH_METADATA = 4
+PREVIEW_MEDIA_TYPES = {1: 'image/jpeg', 2: 'image/png'}
+
+
+class PromptWatch:
+    """Completion handle for one queued prompt"""
+
+    def __init__(self, prompt_id, node_types=None, events=None):
+        self.prompt_id = prompt_id
+        # node id -> class_type, used to label per-node timings
+        self.node_types = node_types or {}
+        # Optional bounded asyncio.Queue receiving (event, data) progress tuples
+        self.events = events
+        self.done = asyncio.get_running_loop().create_future()
+        # Monotonic timestamps of execution start/end as reported by ComfyUI
+        self.started_at = None
+        self.finished_at = None
+
+    def emit(self, event, data):
+        """Forward a progress event to the consumer; dropped if it falls behind"""
+        if self.events is None:
+            return
+        try:
+            self.events.put_nowait((event, data))
+        except asyncio.QueueFull:
+            pass
+
+    def finish(self, error=None):
+        """Resolve the watch, with an exception if the prompt failed"""
+        if self.done.done():
+            return
+        self.finished_at = time.monotonic()
+        if error is None:
+            self.done.set_result(None)
+        else:
+            self.done.set_exception(error)
+
+
+class ComfyUIEventHub:
+    """Shared WebSocket connection dispatching ComfyUI events by prompt_id"""
+
+    def __init__(self, client, poll_interval=2.0, max_reconnect_delay=30.0):
+        self.client = client
+        self.client_id = str(uuid.uuid4())
+        self.poll_interval = poll_interval
+        self.max_reconnect_delay = max_reconnect_delay
+        self.connected = False
+        self.queue_remaining = None
+        self.executing_prompt_id = None
+        # Optional callback(class_type, seconds) invoked when a node finishes
+        self.on_node_executed = None
+        # Optional callback(msg_type, data) invoked for every decoded text message
+        self.on_event = None
+        self._watches = {}
+        # prompt_id -> (node_id, monotonic start) of the node currently executing
+        self._node_clock = {}
+        self._finished = OrderedDict()
+        self._tasks = []
+
+    async def start(self):
+        """Start the reader and history-poll background tasks"""
+        self._tasks = [
+            asyncio.create_task(self._run()),
+            asyncio.create_task(self._poll_while_disconnected()),
+        ]
+
+    async def close(self):
+        """Stop background tasks and fail every pending watch"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for watch in list(self._watches.values()):
+            watch.finish(ComfyUIError("EzInfer is shutting down"))
+        self._watches.clear()
+
+    def watch(self, prompt_id, node_types=None, events=None):
+        """Register interest in a prompt; resolves immediately if it already finished"""
+        watch = PromptWatch(prompt_id, node_types, events)
+        if prompt_id in self._finished:
+            watch.finish(self._finished.pop(prompt_id))
+        else:
+            self._watches[prompt_id] = watch
+        return watch
+
+    def unwatch(self, prompt_id):
+        """Forget a prompt (e.g. after a timeout)"""
+        self._watches.pop(prompt_id, None)
+
+    async def wait(self, prompt_id, timeout=None, node_types=None, events=None):
+        """Wait until ComfyUI reports the prompt as finished and return its watch.
+
+        If events is an asyncio.Queue, progress events are pushed into it.
+        """
+        watch = self.watch(prompt_id, node_types, events)
+        try:
+            await asyncio.wait_for(watch.done, timeout)
+        finally:
+            self.unwatch(prompt_id)
+        return watch
+
+    def _complete(self, prompt_id, error=None):
+        if self.executing_prompt_id == prompt_id:
+            self.executing_prompt_id = None
+        if error is None:
+            self._node_transition(prompt_id, None)
+        else:
+            self._node_clock.pop(prompt_id, None)
+        watch = self._watches.pop(prompt_id, None)
+        if watch is not None:
+            watch.finish(error)
+            return
+        # Completion arrived before the watcher registered: remember it briefly
+        self._finished[prompt_id] = error
+        while len(self._finished) > FINISHED_BUFFER_SIZE:
+            self._finished.popitem(last=False)
+
+    def _node_transition(self, prompt_id, node_id):
+        """Close the timing of the previous node of a prompt and start the next one"""
+        now = time.monotonic()
+        previous = self._node_clock.pop(prompt_id, None)
+        if previous is not None and self.on_node_executed is not None:
+            previous_node, started = previous
+            watch = self._watches.get(prompt_id)
+            class_type = watch.node_types.get(previous_node, 'unknown') if watch else 'unknown'
+            self.on_node_executed(class_type, now - started)
+        if node_id is not None:
+            self._node_clock[prompt_id] = (node_id, now)
+
+    def _started(self, prompt_id):
+        self.executing_prompt_id = prompt_id
+        watch = self._watches.get(prompt_id)
+        if watch is not None and watch.started_at is None:
+            watch.started_at = time.monotonic()
+
+    def _dispatch(self, raw):
+        try:
+            message = json.loads(raw)
+        except ValueError:
+            return
+        msg_type = message.get("type")
+        data = message.get("data") or {}
+        if self.on_event is not None:
+            self.on_event(msg_type, data)
+
+        if msg_type == "status":
+            exec_info = data.get("status", {}).get("exec_info", {})
+            self.queue_remaining = exec_info.get("queue_remaining", self.queue_remaining)
+            for watch in self._watches.values():
+                if watch.started_at is None:
+                    watch.emit("queue", {"queue_remaining": self.queue_remaining})
+            return
+
+        prompt_id = data.get("prompt_id")
+        if prompt_id is None:
+            return
+
+        watch = self._watches.get(prompt_id)
+        if watch is not None and watch.events is not None:
+            node_id = data.get("node")
+            if msg_type == "progress":
+                watch.emit("progress", {"node": node_id, "value": data.get("value"), "max": data.get("max")})
+            elif msg_type == "executing" and node_id is not None:
+                watch.emit("executing", {"node": node_id, "class_type": watch.node_types.get(node_id)})
+            elif msg_type == "executed":
+                watch.emit("executed", {"node": node_id})
+
+        if msg_type == "execution_start":
+            self._started(prompt_id)
+        elif msg_type == "executing":
+            # Not execution_success: ComfyUI sends it before the prompt is in /history,
+            # and executing with no node only once it is
+            if data.get("node") is None:
+                self._complete(prompt_id)
+            else:
+                self._started(prompt_id)
+                self._node_transition(prompt_id, data["node"])
+        elif msg_type == "execution_error":
+            self._complete(prompt_id, ComfyUIError(
+                f"Execution error in node {data.get('node_id')}: {data.get('exception_message')}"))
+        elif msg_type == "execution_interrupted":
+            self._complete(prompt_id, ComfyUIError("Execution interrupted"))
+
+    def _dispatch_binary(self, raw):
+        """Forward latent preview frames to the prompt that produced them"""
+        if len(raw) < 8:
+            return
+        event_type, = struct.unpack('>I', raw[:4])
+        if event_type == BINARY_PREVIEW_IMAGE:
+            # Legacy frames carry no prompt id: ComfyUI runs one prompt at a time
+            prompt_id = self.executing_prompt_id
+            format_id, = struct.unpack('>I', raw[4:8])
+            media_type = PREVIEW_MEDIA_TYPES.get(format_id, 'image/jpeg')
+            image = raw[8:]
+        elif event_type == BINARY_PREVIEW_IMAGE_WITH_METADATA:
+            metadata_length, = struct.unpack('>I', raw[4:8])
+            try:
+                metadata = json.loads(raw[8:8 + metadata_length])
+            except ValueError:
+                return
+            prompt_id = metadata.get('prompt_id') or self.executing_prompt_id
+            media_type = metadata.get('image_type', 'image/jpeg')
+            image = raw[8 + metadata_length:]
+        else:
+            return
+
+        watch = self._watches.get(prompt_id)
+        if watch is not None and watch.events is not None:
+            watch.emit("preview", {
+                "media_type": media_type,
+                "data_base64": base64.b64encode(image).decode('utf-8'),
+            })
+
+    async def _run(self):
+        delay = 1.0
+        while True:
+            try:
+                async with await self.client.connect_ws(self.client_id) as ws:
+                    self.connected = True
+                    delay = 1.0
+                    print("INFO: Connected to ComfyUI WebSocket")
+                    # Catch completions that happened while we were disconnected
+                    await self._recover_from_history()
+                    async for message in ws:
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            self._dispatch(message.data)
+                        elif message.type == aiohttp.WSMsgType.BINARY:
+                            self._dispatch_binary(message.data)
+                        elif message.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+            except asyncio.CancelledError:
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                print(f"WARN: ComfyUI WebSocket unavailable: {e}")
+            except Exception as e:
+                print(f"ERROR: ComfyUI WebSocket reader failed: {e}")
+            finally:
+                self.connected = False
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    async def _poll_while_disconnected(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if not self.connected and self._watches:
+                await self._recover_from_history()
+
+    async def _recover_from_history(self):
+        prompt_ids = list(self._watches)
+        if not prompt_ids:
+            return
+        results = await asyncio.gather(
+            *(self.client.get_history(prompt_id) for prompt_id in prompt_ids),
+            return_exceptions=True,
+        )
+        for prompt_id, entry in zip(prompt_ids, results):
+            if isinstance(entry, BaseException) or not entry:
+                continue
+            status = entry.get("status", {})
+            if status.get("status_str") == "error":
+                self._complete(prompt_id, ComfyUIError("Execution error (recovered from history)"))
+            elif status.get("completed") or entry.get("outputs"):
+                self._complete(prompt_id)
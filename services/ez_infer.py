@@ -1,269 +1,1012 @@
-import requests
+#!/usr/bin/env python3
+"""
+EzInfer Service
+
+Simple synchronous inference endpoint for ComfyUI: a workflow JSON is posted
+to /generate, queued on ComfyUI and the resulting images are returned in the
+response (base64 JSON, raw/multipart binary or signed URLs, see
+ezinfer_outputs.py). The service runs on a single asyncio event loop and shares one
+pooled HTTP session and a single multiplexed WebSocket per ComfyUI backend, so many
+generations can be in flight at the same time without pinning a thread each.
+Several ComfyUI processes can serve as backends (backends.py).
+"""
+
+import asyncio
+import copy
 import json
-import uuid
-import websocket
-from flask import Flask, request, jsonify
-import base64
-import urllib.parse
+import os
 import random
-import os # Importa il modulo os per accedere alle variabili d'ambiente
-import time # For tracking uptime
+import time
 
-app = Flask(__name__)
+import aiohttp
+from aiohttp import web
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+
+from backends import BackendPool, PoolHealth, workflow_models
+from comfy_client import ComfyUIError
+from ezinfer_outputs import (
+    CACHE_OUTPUT_TYPE,
+    RETURN_BINARY,
+    RETURN_REFERENCE,
+    RETURN_S3,
+    STREAM_NDJSON,
+    BatchArchive,
+    EventStreamWriter,
+    COMFYUI_OUTPUT_DIR,
+    URL_TTL_SECONDS,
+    cached_file_response,
+    delete_output_files,
+    fetch_image_base64,
+    negotiate_return_mode,
+    negotiate_stream_format,
+    output_media_type,
+    respond_from_cache,
+    signed_view_url,
+    stream_multipart,
+    stream_single,
+    verify_view_request,
+    wants_archive,
+)
+from metrics import FunctionCounter, register_textfile_collector, render_metrics
+from result_cache import ResultCache, workflow_cache_key
+from s3outputs import S3_OUTPUTS_ENABLED, S3OutputSink
+from scheduler import AdmissionController, DeadlineExceeded, Overloaded, workflow_shape_key
+from templates import TemplateError, TemplateRegistry
+from warmup import Warmup
 
 COMFYUI_API_ADDRESS = "http://127.0.0.1:8188"
 REQUEST_TIMEOUT = 3600
 
+# ComfyUI processes to spread workflows over (see backends.py), the local one by default
+COMFYUI_BACKENDS = os.getenv('EZINFER_COMFYUI_BACKENDS', '')
+
+# Maximum number of pooled connections to each ComfyUI backend
+COMFYUI_POOL_SIZE = int(os.getenv('EZINFER_COMFYUI_POOL_SIZE', '100'))
+
+# Maximum request body size (workflows can be large, nginx allows 100M)
+MAX_REQUEST_SIZE = 100 * 1024 ** 2
+
+# Admission control: workflows in flight per ComfyUI backend and requests allowed to wait
+MAX_IN_FLIGHT = int(os.getenv('EZINFER_MAX_IN_FLIGHT', '4'))
+MAX_QUEUE = int(os.getenv('EZINFER_MAX_QUEUE', '64'))
+
+# Progress streaming (?stream=sse|ndjson): buffered events per request and keep-alive interval
+STREAM_EVENT_BUFFER = 256
+STREAM_HEARTBEAT_SECONDS = 15
+
+# Maximum number of workflow variants accepted by /generate/batch
+MAX_BATCH_SIZE = int(os.getenv('EZINFER_MAX_BATCH_SIZE', '64'))
+
+# Registered workflow templates (kept on the persistent volume)
+TEMPLATE_DIR = os.getenv('EZINFER_TEMPLATE_DIR', '/opt/app-root/src/.ezinfer/templates')
+
+# Result cache for deterministic workflows (INFERENCE_RANDOM_SEED_NODES=false)
+RESULT_CACHE_ENABLED = os.getenv('EZINFER_RESULT_CACHE', 'false').lower() == 'true'
+RESULT_CACHE_DIR = os.getenv('EZINFER_RESULT_CACHE_DIR', '/tmp/ezinfer-cache')
+RESULT_CACHE_MAX_BYTES = int(os.getenv('EZINFER_RESULT_CACHE_MAX_MB', '2048')) * 1024 ** 2
+
+# Delete ComfyUI output files once they have been returned (reference mode keeps them for /view)
+DELETE_RETURNED_OUTPUTS = os.getenv('EZINFER_DELETE_OUTPUTS', 'false').lower() == 'true'
+
+INFERENCE_DEBUG = os.getenv("INFERENCE_DEBUG", "false").lower() == "true"
+
 # Track when the application started
 APP_START_TIME = time.time()
 
-@app.route('/health', methods=['GET'])
-def health_check():
+routes = web.RouteTableDef()
+
+# Prometheus metrics
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+REQUEST_SECONDS = Histogram(
+    'ezinfer_request_duration_seconds', 'EzInfer HTTP request latency',
+    ['route', 'status'], buckets=LATENCY_BUCKETS)
+PHASE_SECONDS = Histogram(
+    'ezinfer_phase_duration_seconds',
+    'Time spent per /generate phase (submit, queue_wait, execution, history_fetch, image_fetch)',
+    ['phase'], buckets=LATENCY_BUCKETS)
+NODE_SECONDS = Histogram(
+    'ezinfer_node_execution_seconds', 'ComfyUI node execution time by class type',
+    ['class_type'], buckets=LATENCY_BUCKETS)
+CACHE_LOOKUPS = Counter(
+    'ezinfer_result_cache_lookups_total', 'Result cache lookups', ['result'])
+COMFYUI_QUEUE_REMAINING = Gauge(
+    'comfyui_queue_remaining', 'Prompts remaining in the ComfyUI queue (from WebSocket status events)')
+COMFYUI_WS_CONNECTED = Gauge(
+    'ezinfer_comfyui_websocket_connected', 'Whether the WebSockets to all ComfyUI backends are connected')
+BACKEND_IN_FLIGHT = Gauge(
+    'ezinfer_backend_in_flight', 'Workflows in flight per ComfyUI backend', ['backend'])
+BACKEND_AVAILABLE = Gauge(
+    'ezinfer_backend_available', 'Whether a ComfyUI backend receives work (0 while ejected)', ['backend'])
+WARMUP_SECONDS = Gauge(
+    'ezinfer_warmup_duration_seconds', 'Duration of the last model warm-up per ComfyUI backend (startup or keep_warm)',
+    ['backend', 'phase'])
+OUTPUTS_DELETED = Counter(
+    'ezinfer_outputs_deleted_total', 'ComfyUI output files deleted after being returned')
+S3_OFFLOADED_FILES = Counter(
+    'ezinfer_s3_offloaded_files_total', 'Outputs uploaded to S3 in the s3 return mode')
+S3_OFFLOADED_BYTES = Counter(
+    'ezinfer_s3_offloaded_bytes_total', 'Bytes of outputs uploaded to S3 in the s3 return mode')
+RESULT_CACHE_BYTES = Gauge('ezinfer_result_cache_bytes', 'Bytes stored in the result cache')
+SCHEDULER_IN_FLIGHT = Gauge('ezinfer_in_flight', 'Workflows in flight on ComfyUI')
+SCHEDULER_WAITING = Gauge('ezinfer_waiting', 'Requests waiting for an in-flight slot')
+
+
+def debug(message):
+    """Print a debug message when INFERENCE_DEBUG is enabled"""
+    if INFERENCE_DEBUG:
+        print(f"DEBUG: {message}")
+
+
+def randomize_seeds(workflow):
+    """Replace every seed/noise_seed input with a random value.
+
+    Returns True if at least one seed was updated.
+    """
+    seed_found_and_updated = False
+    for node_id, node_data in workflow.items():
+        if not isinstance(node_data, dict) or "inputs" not in node_data:
+            continue
+        inputs = node_data["inputs"]
+
+        for seed_key in ("seed", "noise_seed"):
+            if seed_key in inputs:
+                inputs[seed_key] = random.randint(0, 0xFFFFFFFFFFFFFFFF)
+                seed_found_and_updated = True
+                debug(f"Updated {seed_key} in node {node_id} to: {inputs[seed_key]}")
+
+        if "control_after_generate" in inputs:
+            inputs["control_after_generate"] = "randomize"
+
+    return seed_found_and_updated
+
+
+@routes.get('/health')
+@routes.get('/health/ready')
+async def health_check(request):
     """
-    Endpoint per verificare lo stato del servizio e la connessione a ComfyUI.
-    Restituisce l'uptime corrente e lo stato della connessione a ComfyUI.
+    Health endpoint (readiness): reports the service uptime and the cached
+    ComfyUI status (see health.py); 503 unless ComfyUI is reachable and
+    neither its queue nor the admission queue is saturated.
     """
     current_time = time.time()
     uptime_seconds = current_time - APP_START_TIME
-    
+
     # Convert uptime to human readable format
     hours = int(uptime_seconds // 3600)
     minutes = int((uptime_seconds % 3600) // 60)
     seconds = int(uptime_seconds % 60)
     uptime_formatted = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
-    
-    # Test ComfyUI connection
-    comfyui_status = "unknown"
-    comfyui_error = None
-    
-    try:
-        # Try to reach ComfyUI's system stats endpoint or queue endpoint
-        test_endpoint = f"{COMFYUI_API_ADDRESS}/system_stats"
-        response = requests.get(test_endpoint, timeout=10)
-        if response.status_code == 200:
-            comfyui_status = "connected"
-        else:
-            comfyui_status = "error"
-            comfyui_error = f"HTTP {response.status_code}"
-    except requests.exceptions.ConnectionError:
-        comfyui_status = "disconnected"
-        comfyui_error = "Connection refused"
-    except requests.exceptions.Timeout:
-        comfyui_status = "timeout"
-        comfyui_error = "Request timeout"
-    except Exception as e:
-        comfyui_status = "error"
-        comfyui_error = str(e)
-    
+
+    health = request.app['health'].snapshot()
+    comfyui_status = "connected" if health['comfyui']['reachable'] else "disconnected"
+
     health_data = {
-        "status": "healthy",
+        "status": "healthy" if health['ready'] else health['state'],
         "uptime": {
             "seconds": round(uptime_seconds, 2),
             "formatted": uptime_formatted
         },
         "comfyui": {
             "status": comfyui_status,
-            "error": comfyui_error
+            "error": health['comfyui']['error'],
+            "queue_remaining": health['comfyui']['queue_remaining']
         },
+        "health": health,
+        "scheduler": request.app['scheduler'].stats(),
+        "backends": request.app['comfy'].stats(),
+        "warmup": request.app['warmup'].stats(),
         "service": "ez_infer",
         "timestamp": current_time
     }
-    
-    # Return appropriate HTTP status based on ComfyUI connection
-    status_code = 200 if comfyui_status == "connected" else 503
-    
-    return jsonify(health_data), status_code
-
-@app.route('/generate', methods=['POST'])
-def generate_image():
+
+    return web.json_response(health_data, status=200 if health['ready'] else 503)
+
+
+@routes.get('/health/live')
+async def liveness_check(request):
+    """Liveness: fails only once ComfyUI has been unreachable for HEALTH_LIVENESS_TIMEOUT"""
+    health = request.app['health'].snapshot()
+    return web.json_response(health, status=200 if health['live'] else 503)
+
+
+async def cancel_prompt(backend, prompt_id):
+    """Drop a prompt from its backend's queue, interrupting it if already running"""
+    client = backend.client
+    hub = backend.hub
+    try:
+        await client.delete_from_queue([prompt_id])
+        if hub.executing_prompt_id == prompt_id:
+            await client.interrupt(prompt_id)
+        print(f"INFO: Cancelled prompt {prompt_id}")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"WARN: Failed to cancel prompt {prompt_id}: {e}")
+
+
+async def execute_workflow(app, workflow, deadline=None, events=None):
+    """Queue a workflow on ComfyUI and wait for it, under admission control.
+
+    deadline is an optional time.monotonic() value; past it the prompt is
+    cancelled on ComfyUI and DeadlineExceeded is raised. events is an
+    optional asyncio.Queue receiving (event, data) progress tuples.
+    Returns (prompt_id, history_entry), the outputs of the history entry
+    being tagged with the name of the backend that ran the workflow.
+    """
+    pool = app['comfy']
+    scheduler = app['scheduler']
+    shape_key = workflow_shape_key(workflow)
+    models = workflow_models(workflow)
+
+    arrived_at = time.monotonic()
+    async with scheduler.admit(shape_key, deadline), pool.lease(models, scheduler.estimate(shape_key)) as backend:
+        client = backend.client
+        hub = backend.hub
+        admitted_at = time.monotonic()
+        try:
+            with PHASE_SECONDS.labels('submit').time():
+                prompt_result = await client.submit_prompt(workflow, hub.client_id)
+        except aiohttp.ClientConnectionError as e:
+            # Eject the backend now rather than at its next health check
+            backend.health.report_failure(str(e))
+            raise
+        submitted_at = time.monotonic()
+        prompt_id = prompt_result["prompt_id"]
+        debug(f"Prompt queued with ID: {prompt_id} on backend {backend.name}")
+        if events is not None:
+            events.put_nowait(("queued", {
+                "prompt_id": prompt_id,
+                "number": prompt_result.get("number"),
+                "queue_remaining": hub.queue_remaining
+            }))
+
+        timeout = REQUEST_TIMEOUT
+        if deadline is not None:
+            timeout = min(timeout, max(0.0, deadline - time.monotonic()))
+        try:
+            watch = await hub.wait(prompt_id, timeout=timeout,
+                                   node_types=node_class_types(workflow), events=events)
+        except asyncio.TimeoutError:
+            await cancel_prompt(backend, prompt_id)
+            raise DeadlineExceeded(f"Deadline exceeded while executing prompt {prompt_id}")
+        except asyncio.CancelledError:
+            # The caller went away (e.g. a streaming client disconnected)
+            await asyncio.shield(cancel_prompt(backend, prompt_id))
+            raise
+
+        started_at = watch.started_at or submitted_at
+        PHASE_SECONDS.labels('queue_wait').observe((admitted_at - arrived_at) + (started_at - submitted_at))
+        PHASE_SECONDS.labels('execution').observe(watch.finished_at - started_at)
+        scheduler.record(shape_key, watch.finished_at - started_at)
+        backend.remember_models(models)
+        backend.completed += 1
+
+    with PHASE_SECONDS.labels('history_fetch').time():
+        history_entry = await client.get_history(prompt_id)
+    if history_entry is None:
+        raise ComfyUIError("Prompt ID not found in history")
+    for node_output in history_entry.get("outputs", {}).values():
+        for image_info in node_output.get("images", []):
+            image_info["backend"] = backend.name
+    return prompt_id, history_entry
+
+
+def parse_deadline(request):
+    """Read the optional per-request timeout (seconds) from ?timeout= or X-EzInfer-Timeout.
+
+    Returns a time.monotonic() deadline or None; raises ValueError if malformed.
+    """
+    value = request.query.get('timeout') or request.headers.get('X-EzInfer-Timeout')
+    if not value:
+        return None
+    seconds = float(value)
+    if seconds <= 0:
+        raise ValueError("timeout must be positive")
+    return time.monotonic() + seconds
+
+
+def node_class_types(workflow):
+    """Map node id -> class_type, used to label per-node execution metrics"""
+    return {
+        str(node_id): node.get('class_type', 'unknown')
+        for node_id, node in workflow.items()
+        if isinstance(node, dict)
+    }
+
+
+def collect_outputs(history_entry):
+    """List the output files (image_info dicts) of a history entry"""
+    return [
+        image_info
+        for node_output in history_entry.get("outputs", {}).values()
+        for image_info in node_output.get("images", [])
+    ]
+
+
+def release_outputs(pool, image_infos):
+    """Delete returned outputs from their backend's output directory if EZINFER_DELETE_OUTPUTS is set"""
+    if not DELETE_RETURNED_OUTPUTS:
+        return
+    for image_info in image_infos:
+        output_dir = pool.backend_for(image_info).output_dir
+        # Backends without a local output directory (e.g. in another pod) keep their files
+        if output_dir is not None:
+            OUTPUTS_DELETED.inc(delete_output_files([image_info], output_dir))
+
+
+async def offload_outputs(app, prompt_id, image_infos):
+    """Upload outputs to S3 in parallel (see s3outputs.py) and return their presigned references.
+
+    An output that fails to upload is reported as {"filename", "error"} in
+    place of its reference, and raises only when no output was uploaded.
     """
-    Endpoint per generare un'immagine inviando un workflow JSON a ComfyUI.
-    Il workflow viene passato nel corpo della richiesta POST.
+    sink = app['s3_outputs']
+    expires = int(time.time()) + URL_TTL_SECONDS
+    results = await asyncio.gather(*(
+        sink.upload_output(app['comfy'], prompt_id, info, output_media_type(info), expires)
+        for info in image_infos), return_exceptions=True)
+    images = []
+    uploaded = []
+    errors = []
+    for info, result in zip(image_infos, results):
+        if isinstance(result, BaseException):
+            print(f"ERROR: S3 offload of output '{info['filename']}' failed: {result}")
+            images.append({"filename": info['filename'], "error": f"S3 offload failed: {result}"})
+            errors.append(result)
+        else:
+            images.append(result[0])
+            uploaded.append(result)
+    if not uploaded and errors:
+        raise errors[0]
+
+    S3_OFFLOADED_FILES.inc(len(uploaded))
+    S3_OFFLOADED_BYTES.inc(sum(reference['size'] for reference, _ in uploaded))
+    if not errors:
+        # Only once every output is in the bucket: after a failure the outputs stay for a retry
+        paths = [path for _, path in uploaded if path is not None]
+        OUTPUTS_DELETED.inc(await asyncio.to_thread(delete_local_outputs, paths))
+    return images
+
+
+def delete_local_outputs(paths):
+    """Remove uploaded outputs from the output directory, returning how many were deleted"""
+    deleted = 0
+    for path in paths:
+        try:
+            os.unlink(path)
+            deleted += 1
+        except OSError as e:
+            print(f"WARN: Failed to delete uploaded output '{path}': {e}")
+    return deleted
+
+
+def s3_unavailable_response(request):
+    """400 response if the s3 return mode is requested without S3 offload configured, else None"""
+    if negotiate_return_mode(request) == RETURN_S3 and request.app['s3_outputs'] is None:
+        return web.json_response(
+            {"error": "The s3 return mode requires EZINFER_S3_OUTPUTS=true and the AWS_* variables"}, status=400)
+    return None
+
+
+def no_outputs_response(prompt_id, history_entry):
+    """200 response for workflows that ran but produced nothing to return"""
+    if not history_entry.get("outputs"):
+        message = "Workflow processed, but no outputs found in history."
+    else:
+        message = "Workflow processed, but no images were retrieved from outputs."
+    return web.json_response({"message": message, "history_raw": {prompt_id: history_entry}})
+
+
+async def respond_with_outputs(request, prompt_id, history_entry, image_infos, headers):
+    """Build the /generate response for fresh ComfyUI outputs in the requested mode"""
+    client = request.app['comfy']
+    return_mode = negotiate_return_mode(request)
+    print(f"INFO: Generation completed. Returning {len(image_infos)} images ({return_mode}).")
+
+    if return_mode == RETURN_BINARY:
+        if len(image_infos) == 1:
+            return await stream_single(request, client, image_infos[0], headers)
+        return await stream_multipart(request, client, image_infos, headers)
+
+    if return_mode == RETURN_S3:
+        references = await offload_outputs(request.app, prompt_id, image_infos)
+        return web.json_response(
+            {"status": "success", "images": references, "prompt_id": prompt_id}, headers=headers)
+
+    if return_mode == RETURN_REFERENCE:
+        references = []
+        for image_info in image_infos:
+            url, expires = signed_view_url(request, image_info)
+            references.append({
+                "filename": image_info["filename"],
+                "url": url,
+                "expires": expires
+            })
+        return web.json_response(
+            {"status": "success", "images": references, "prompt_id": prompt_id}, headers=headers)
+
+    results = await asyncio.gather(*(fetch_image_base64(client, info) for info in image_infos))
+    final_images = [image for image in results if image is not None]
+    if not final_images:
+        return no_outputs_response(prompt_id, history_entry)
+
+    return web.json_response(
+        {"status": "success", "images": final_images, "prompt_id": prompt_id}, headers=headers)
+
+
+async def generate_cached(request, cache, workflow, deadline=None):
+    """Serve a deterministic workflow from the result cache, running it on a miss"""
+    key = workflow_cache_key(workflow)
+    return_mode = negotiate_return_mode(request)
+
+    # Identical concurrent requests wait here and are then served by the first one
+    async with cache.lock(key):
+        entry = cache.get(key)
+        CACHE_LOOKUPS.labels('hit' if entry is not None else 'miss').inc()
+        if entry is not None:
+            debug(f"Result cache hit for {key}")
+            headers = {"X-EzInfer-Cache": "HIT", "X-EzInfer-Cache-Key": key,
+                       "X-EzInfer-Prompt-Id": entry.prompt_id or ""}
+            try:
+                return await respond_from_cache(request, entry, return_mode, headers, request.app['s3_outputs'])
+            except FileNotFoundError:
+                # Evicted or purged while being served: run the workflow as on a miss
+                print(f"WARN: Result cache entry {key} vanished while being served, running the workflow")
+                cache.forget(key, entry)
+
+        prompt_id, history_entry = await execute_workflow(request.app, workflow, deadline)
+        image_infos = collect_outputs(history_entry)
+        if not image_infos:
+            return no_outputs_response(prompt_id, history_entry)
+
+        client = request.app['comfy']
+        with PHASE_SECONDS.labels('image_fetch').time():
+            contents = await asyncio.gather(*(client.fetch_view(info) for info in image_infos))
+        outputs = [
+            (info, output_media_type(info), content)
+            for info, content in zip(image_infos, contents)
+        ]
+        entry = await cache.put(key, prompt_id, outputs)
+        # The cache holds its own copies, also for reference mode
+        release_outputs(client, image_infos)
+
+    headers = {"X-EzInfer-Cache": "MISS", "X-EzInfer-Cache-Key": key, "X-EzInfer-Prompt-Id": prompt_id}
+    print(f"INFO: Generation completed. Cached and returning {len(entry.files)} images ({return_mode}).")
+    return await respond_from_cache(request, entry, return_mode, headers, request.app['s3_outputs'])
+
+
+async def generate_stream(request, workflow, deadline, stream_format):
+    """Run a workflow while streaming queue position, progress and previews.
+
+    The final "complete" event carries the same payload as the json (or
+    reference) return mode. If the client disconnects, the prompt is
+    cancelled on ComfyUI.
     """
-    if not request.is_json:
-        return jsonify({"error": "Content-Type must be application/json"}), 400
+    events = asyncio.Queue(maxsize=STREAM_EVENT_BUFFER)
+    writer = EventStreamWriter(request, stream_format)
+    await writer.start()
 
-    workflow = request.get_json()
+    task = asyncio.create_task(execute_workflow(request.app, workflow, deadline, events))
+    try:
+        while not (task.done() and events.empty()):
+            getter = asyncio.ensure_future(events.get())
+            done, _ = await asyncio.wait({getter, task}, timeout=STREAM_HEARTBEAT_SECONDS,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                event, data = getter.result()
+                await writer.send(event, data)
+            else:
+                getter.cancel()
+                if not done:
+                    await writer.heartbeat()
+
+        try:
+            prompt_id, history_entry = task.result()
+        except Overloaded as e:
+            await writer.send("error", {"error": str(e), "status": e.status, "retry_after": e.retry_after})
+            return await writer.close()
+        except DeadlineExceeded as e:
+            await writer.send("error", {"error": str(e), "status": 504})
+            return await writer.close()
+        except Exception as e:
+            print(f"ERROR: Streaming generation failed: {e}")
+            await writer.send("error", {"error": str(e), "status": 500})
+            return await writer.close()
+
+        image_infos = collect_outputs(history_entry)
+        if negotiate_return_mode(request) == RETURN_S3:
+            try:
+                with PHASE_SECONDS.labels('image_fetch').time():
+                    images = await offload_outputs(request.app, prompt_id, image_infos)
+            except Exception as e:
+                print(f"ERROR: S3 offload of outputs failed: {e}")
+                await writer.send("error", {"error": f"S3 offload failed: {e}", "status": 500})
+                return await writer.close()
+        elif negotiate_return_mode(request) == RETURN_REFERENCE:
+            images = []
+            for image_info in image_infos:
+                url, expires = signed_view_url(request, image_info)
+                images.append({"filename": image_info["filename"], "url": url, "expires": expires})
+        else:
+            with PHASE_SECONDS.labels('image_fetch').time():
+                results = await asyncio.gather(*(fetch_image_base64(request.app['comfy'], info)
+                                                 for info in image_infos))
+            images = [image for image in results if image is not None]
+
+        print(f"INFO: Generation completed. Streaming {len(images)} images.")
+        await writer.send("complete", {"status": "success", "images": images, "prompt_id": prompt_id})
+        if negotiate_return_mode(request) != RETURN_REFERENCE:
+            release_outputs(request.app['comfy'], image_infos)
+        return await writer.close()
+
+    except (ConnectionResetError, asyncio.CancelledError):
+        print("INFO: Streaming client disconnected, cancelling its prompt")
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        raise
+
+
+@routes.post('/generate')
+async def generate_image(request):
+    """
+    Run the workflow posted in the request body on ComfyUI and return its images.
+    """
+    if request.content_type != 'application/json':
+        return web.json_response({"error": "Content-Type must be application/json"}, status=400)
+
+    try:
+        workflow = await request.json()
+    except json.JSONDecodeError as e:
+        return web.json_response({"error": f"JSON decoding error: {str(e)}"}, status=400)
 
     if not workflow:
-        return jsonify({"error": "Workflow JSON cannot be empty"}), 400
+        return web.json_response({"error": "Workflow JSON cannot be empty"}, status=400)
+
+    try:
+        deadline = parse_deadline(request)
+    except ValueError:
+        return web.json_response({"error": "timeout must be a positive number of seconds"}, status=400)
 
-    # Controlla la variabile d'ambiente RANDOM_SEED_NODES
     random_seed_enabled = os.getenv("INFERENCE_RANDOM_SEED_NODES", "true").lower() == "true"
-    print(f"DEBUG: RANDOM_SEED_NODES è impostato a: {random_seed_enabled}")
-
-    if random_seed_enabled:
-        seed_found_and_updated = False
-        for node_id, node_data in workflow.items():
-            if isinstance(node_data, dict) and "inputs" in node_data:
-                inputs = node_data["inputs"]
-                
-                # Controlla e aggiorna il campo "seed"
-                if "seed" in inputs:
-                    new_seed = random.randint(0, 0xFFFFFFFFFFFFFFFF) # Un grande numero per seed
-                    inputs["seed"] = new_seed
-                    seed_found_and_updated = True
-                    print(f"DEBUG: Aggiornato seed nel nodo {node_id} a: {new_seed}")
-  
-                # Controlla e aggiorna il campo "noise_seed"
-                if "noise_seed" in inputs:
-                    new_noise_seed = random.randint(0, 0xFFFFFFFFFFFFFFFF) # Un grande numero per noise_seed
-                    inputs["noise_seed"] = new_noise_seed
-                    seed_found_and_updated = True
-                    print(f"DEBUG: Aggiornato noise_seed nel nodo {node_id} a: {new_noise_seed}")
-
-                # Se c'è anche un campo 'control_after_generate' nel KSampler, impostalo su 'randomize' o 'increment'
-                if "control_after_generate" in inputs:
-                    inputs["control_after_generate"] = "randomize"
-                    print(f"DEBUG: Impostato control_after_generate nel nodo {node_id} a 'randomize'")
-               
-        if not seed_found_and_updated:
-            print("WARN: RANDOM_SEED_NODES è TRUE ma nessun campo 'seed' o 'noise_seed' valido trovato nel workflow. ComfyUI potrebbe servire dalla cache.")
-    else:
-        print("DEBUG: RANDOM_SEED_NODES non è TRUE. Il seed nel workflow non verrà modificato automaticamente.")
-    
-    client_id = str(uuid.uuid4())
-    prompt_endpoint = f"{COMFYUI_API_ADDRESS}/prompt"
-    websocket_address = f"{COMFYUI_API_ADDRESS.replace('http', 'ws')}/ws?clientId={client_id}"
+    if random_seed_enabled and not randomize_seeds(workflow):
+        print("WARN: RANDOM_SEED_NODES is TRUE but no 'seed' or 'noise_seed' found in the workflow. ComfyUI may serve cached results.")
+
+    return await run_generation(request, workflow, deadline, deterministic=not random_seed_enabled)
+
+
+async def run_generation(request, workflow, deadline, deterministic):
+    """Execute a prepared workflow and build the /generate response (stream, cache or direct)"""
+    unavailable = s3_unavailable_response(request)
+    if unavailable is not None:
+        return unavailable
+
+    stream_format = negotiate_stream_format(request)
+    if stream_format is not None:
+        return await generate_stream(request, workflow, deadline, stream_format)
 
     try:
-        payload = {
-            "prompt": workflow,
-            "client_id": client_id
-        }
-        print(f"DEBUG: Invio workflow a ComfyUI: {prompt_endpoint}")
-        response = requests.post(prompt_endpoint, json=payload, timeout=REQUEST_TIMEOUT)
-        response.raise_for_status()
-        prompt_result = response.json()
-        print(f"DEBUG: Prompt Result from ComfyUI: {json.dumps(prompt_result, indent=2)}")
+        # Only deterministic workflows can be replayed from the result cache
+        cache = request.app['result_cache']
+        if cache is not None and deterministic:
+            return await generate_cached(request, cache, workflow, deadline)
+
+        prompt_id, history_entry = await execute_workflow(request.app, workflow, deadline)
+        image_infos = collect_outputs(history_entry)
+        if not image_infos:
+            return no_outputs_response(prompt_id, history_entry)
+
+        headers = {"X-EzInfer-Prompt-Id": prompt_id}
+        if cache is not None:
+            headers["X-EzInfer-Cache"] = "BYPASS"
+        with PHASE_SECONDS.labels('image_fetch').time():
+            response = await respond_with_outputs(request, prompt_id, history_entry, image_infos, headers)
+        if negotiate_return_mode(request) != RETURN_REFERENCE:
+            release_outputs(request.app['comfy'], image_infos)
+        return response
+
+    except Overloaded as e:
+        print(f"WARN: Request rejected by admission control: {e}")
+        return web.json_response({"error": str(e)}, status=e.status,
+                                 headers={"Retry-After": str(e.retry_after)})
+    except DeadlineExceeded as e:
+        print(f"WARN: {e}")
+        return web.json_response({"error": str(e)}, status=504)
+    except ComfyUIError as e:
+        print(f"ERROR: {e}")
+        return web.json_response({"error": str(e)}, status=500)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"ERROR: Network or HTTP error: {e}")
+        return web.json_response({"error": f"Network or HTTP error: {str(e)}"}, status=500)
+    except Exception as e:
+        print(f"FATAL: Unexpected error: {e}")
+        return web.json_response({"error": f"An unexpected error occurred: {str(e)}"}, status=500)
+
+
+def apply_overrides(workflow, overrides):
+    """Return a copy of workflow with {node_id: {input_name: value}} overrides applied.
+
+    Raises ValueError if an override references a node that does not exist.
+    """
+    if not isinstance(overrides, dict):
+        raise ValueError("each item must be an object mapping node ids to input overrides")
+    variant = copy.deepcopy(workflow)
+    for node_id, inputs in overrides.items():
+        node = variant.get(str(node_id))
+        if not isinstance(node, dict):
+            raise ValueError(f"node '{node_id}' not found in workflow")
+        if not isinstance(inputs, dict):
+            raise ValueError(f"overrides for node '{node_id}' must be an object")
+        node.setdefault("inputs", {}).update(inputs)
+    return variant
+
+
+async def run_batch_item(app, index, workflow, deadline):
+    """Execute one batch variant, returning (result, image_infos) instead of raising"""
+    started = time.monotonic()
+    result = {"index": index}
+    image_infos = []
+    try:
+        prompt_id, history_entry = await execute_workflow(app, workflow, deadline)
+        image_infos = collect_outputs(history_entry)
+        result.update({"status": "success", "prompt_id": prompt_id})
+    except Overloaded as e:
+        result.update({"status": "error", "error": str(e), "http_status": e.status,
+                       "retry_after": e.retry_after})
+    except DeadlineExceeded as e:
+        result.update({"status": "error", "error": str(e), "http_status": 504})
+    except Exception as e:
+        print(f"ERROR: Batch item {index} failed: {e}")
+        result.update({"status": "error", "error": str(e), "http_status": 500})
+    result["seconds"] = round(time.monotonic() - started, 3)
+    return result, image_infos
+
+
+@routes.post('/generate/batch')
+async def generate_batch(request):
+    """
+    Run many variants of one workflow, given as per-node input overrides.
+
+    Body: {"workflow": {...}, "items": [{"<node_id>": {"<input>": value}}, ...]}.
+    Results are streamed as NDJSON (or SSE) as items finish, or returned as a
+    zip archive with ?return=zip.
+    """
+    if request.content_type != 'application/json':
+        return web.json_response({"error": "Content-Type must be application/json"}, status=400)
 
-        if "error" in prompt_result:
-            print(f"ERROR: Errore da ComfyUI durante l'invio del prompt: {prompt_result}")
-            return jsonify({"error": f"ComfyUI prompt error: {prompt_result['error']}"}), 500
+    try:
+        body = await request.json()
+    except json.JSONDecodeError as e:
+        return web.json_response({"error": f"JSON decoding error: {str(e)}"}, status=400)
 
-        prompt_id = prompt_result.get("prompt_id")
-        if not prompt_id:
-            return jsonify({"error": "ComfyUI did not return a prompt_id"}), 500
+    workflow = body.get("workflow") if isinstance(body, dict) else None
+    items = body.get("items") if isinstance(body, dict) else None
+    if not workflow or not isinstance(workflow, dict):
+        return web.json_response({"error": "'workflow' must be a non-empty workflow object"}, status=400)
+    if not items or not isinstance(items, list):
+        return web.json_response({"error": "'items' must be a non-empty list of overrides"}, status=400)
+    if len(items) > MAX_BATCH_SIZE:
+        return web.json_response({"error": f"Batch too large: at most {MAX_BATCH_SIZE} items"}, status=413)
 
-        print(f"DEBUG: Prompt inviato con successo, ID: {prompt_id}. Connessione al websocket...")
+    try:
+        deadline = parse_deadline(request)
+    except ValueError:
+        return web.json_response({"error": "timeout must be a positive number of seconds"}, status=400)
 
-        ws_connection = None
+    unavailable = s3_unavailable_response(request)
+    if unavailable is not None:
+        return unavailable
+
+    random_seed_enabled = os.getenv("INFERENCE_RANDOM_SEED_NODES", "true").lower() == "true"
+    variants = []
+    for index, overrides in enumerate(items):
+        base = copy.deepcopy(workflow)
+        # Randomize first so explicit seed overrides win
+        if random_seed_enabled:
+            randomize_seeds(base)
         try:
-            ws_connection = websocket.create_connection(websocket_address, timeout=REQUEST_TIMEOUT)
-            print("DEBUG: Connesso al websocket.")
-
-            final_images = []
-            
-            while True:
-                try:
-                    message = ws_connection.recv()
-                except websocket.WebSocketTimeoutException:
-                    print("WARN: WebSocket recv timed out. Re-attempting recv.")
-                    continue
-                except websocket.WebSocketConnectionClosedException:
-                    print("ERROR: WebSocket connection closed unexpectedly during recv.")
-                    break
-
-                if isinstance(message, str):
-                    json_message = json.loads(message)
-                    msg_type = json_message.get("type")
-                    data = json_message.get("data", {})
-                    prompt_id_in_msg = data.get("prompt_id")
-
-                    print(f"DEBUG: Raw WS message: {json.dumps(json_message, indent=2)}")
-
-                    if msg_type == "executing" and data.get("node") is None and prompt_id_in_msg == prompt_id:
-                        print("DEBUG: Generazione completata (executing: null). Uscita dal loop WebSocket.")
-                        break
-                    
-                    if prompt_id_in_msg == prompt_id:
-                        if msg_type == "progress":
-                            print(f"DEBUG: Progresso: {data.get('value')}/{data.get('max')} (node: {data.get('node')})")
-                        elif msg_type == "executed":
-                            node_id = data.get("node")
-                            output_data = data.get("output", {})
-                            print(f"DEBUG: Nodo '{node_id}' eseguito. Output keys: {output_data.keys()}")
-                    elif prompt_id_in_msg is not None:
-                        print(f"DEBUG: Ignorando messaggio WS di un altro prompt (type: {msg_type}, prompt_id: {prompt_id_in_msg}).")
-                    else:
-                        print(f"DEBUG: Messaggio WS globale/senza prompt_id (type: {msg_type}).")
-
-                elif isinstance(message, bytes):
-                    print(f"DEBUG: Received binary data of length {len(message)}. Ignoring as we rely on history API for final output.")
-
-            history_endpoint = f"{COMFYUI_API_ADDRESS}/history/{prompt_id}"
-            print(f"DEBUG: Recupero history da ComfyUI: {history_endpoint}")
-            history_response = requests.get(history_endpoint, timeout=REQUEST_TIMEOUT)
-            history_response.raise_for_status()
-            history_data = history_response.json()
-            print(f"DEBUG: History Data for {prompt_id}: {json.dumps(history_data, indent=2)}")
-
-            if prompt_id not in history_data:
-                print(f"ERROR: Prompt ID {prompt_id} not found in history.")
-                return jsonify({"error": "Prompt ID not found in history"}), 500
-
-            outputs = history_data[prompt_id].get("outputs", {})
-            if not outputs:
-                print(f"WARN: Nessun output trovato per il prompt ID {prompt_id} nella history.")
-                return jsonify({"message": "Workflow processed, but no outputs found in history.", "history_raw": history_data}), 200
-
-            for node_id, node_output in outputs.items():
-                print(f"DEBUG: Processing output for node: {node_id}")
-                if "images" in node_output:
-                    for image_info in node_output["images"]:
-                        filename = image_info["filename"]
-                        file_type = image_info["type"]
-                        subfolder = image_info.get("subfolder", "")
-
-                        image_url = f"{COMFYUI_API_ADDRESS}/view?filename={urllib.parse.quote(filename)}&type={file_type}"
-                        if subfolder:
-                             image_url += f"&subfolder={urllib.parse.quote(subfolder)}"
-                        
-                        print(f"DEBUG: Recupero immagine: {image_url}")
-                        try:
-                            image_response = requests.get(image_url, timeout=REQUEST_TIMEOUT)
-                            image_response.raise_for_status()
-
-                            final_images.append({
-                                "filename": filename,
-                                "data_base64": base64.b64encode(image_response.content).decode('utf-8'),
-                                "type": image_info.get("format", "image/jpeg")
-                            })
-                            print(f"DEBUG: Immagine '{filename}' aggiunta ai risultati.")
-                        except requests.exceptions.RequestException as img_ex:
-                            print(f"ERROR: Errore nel recupero dell'immagine '{filename}' da {image_url}: {img_ex}")
-                            
-            if not final_images:
-                print("WARN: Nessuna immagine finale recuperata.")
-                return jsonify({"message": "Workflow processed, but no images were retrieved from outputs.", "history_raw": history_data}), 200
-
-            print(f"INFO: Generazione completata. Restituzione {len(final_images)} immagini.")
-            return jsonify({"status": "success", "images": final_images, "prompt_id": prompt_id}), 200
-
-        except websocket.WebSocketConnectionClosedException as ws_closed_ex:
-            print(f"ERROR: WebSocket connection closed unexpectedly: {ws_closed_ex}")
-            return jsonify({"error": f"WebSocket connection closed: {str(ws_closed_ex)}"}), 500
-        except Exception as ws_ex:
-            print(f"ERROR: Errore durante la comunicazione WebSocket: {ws_ex}")
-            return jsonify({"error": f"WebSocket communication error: {str(ws_ex)}"}), 500
-        finally:
-            if ws_connection:
-                print("DEBUG: Chiusura connessione WebSocket.")
-                ws_connection.close()
-
-
-    except requests.exceptions.RequestException as e:
-        print(f"ERROR: Errore di rete o HTTP: {e}")
-        return jsonify({"error": f"Network or HTTP error: {str(e)}"}), 500
+            variants.append(apply_overrides(base, overrides))
+        except ValueError as e:
+            return web.json_response({"error": f"items[{index}]: {e}"}, status=400)
+
+    print(f"INFO: Batch of {len(variants)} workflow variants received")
+    app = request.app
+    client = app['comfy']
+    return_mode = negotiate_return_mode(request)
+    archive = BatchArchive() if wants_archive(request) else None
+    results = asyncio.Queue()
+    started = time.monotonic()
+
+    async def run(index, variant):
+        result, image_infos = await run_batch_item(app, index, variant, deadline)
+        try:
+            if archive is not None:
+                result["files"] = []
+                for image_info in image_infos:
+                    content = await client.fetch_view(image_info)
+                    name = f"{index:04d}/{image_info['filename']}"
+                    await archive.add(name, content)
+                    result["files"].append(name)
+            elif return_mode == RETURN_S3:
+                result["images"] = await offload_outputs(app, result.get("prompt_id"), image_infos)
+            elif return_mode == RETURN_REFERENCE:
+                result["images"] = []
+                for image_info in image_infos:
+                    url, expires = signed_view_url(request, image_info)
+                    result["images"].append({"filename": image_info["filename"], "url": url, "expires": expires})
+            elif image_infos:
+                images = await asyncio.gather(*(fetch_image_base64(client, info) for info in image_infos))
+                result["images"] = [image for image in images if image is not None]
+            if return_mode != RETURN_REFERENCE or archive is not None:
+                release_outputs(client, image_infos)
+        except Exception as e:
+            print(f"ERROR: Failed to retrieve outputs of batch item {index}: {e}")
+            result.update({"status": "error", "error": str(e), "http_status": 500})
+        await results.put(result)
+
+    tasks = [asyncio.create_task(run(index, variant)) for index, variant in enumerate(variants)]
+    writer = None
+    try:
+        if archive is None:
+            writer = EventStreamWriter(request, negotiate_stream_format(request) or STREAM_NDJSON)
+            await writer.start()
+
+        collected = []
+        while len(collected) < len(tasks):
+            try:
+                result = await asyncio.wait_for(results.get(), timeout=STREAM_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                if writer is not None:
+                    await writer.heartbeat()
+                continue
+            collected.append(result)
+            if writer is not None:
+                await writer.send("item", result)
+
+        succeeded = sum(1 for result in collected if result["status"] == "success")
+        summary = {
+            "total": len(collected),
+            "succeeded": succeeded,
+            "failed": len(collected) - succeeded,
+            "seconds": round(time.monotonic() - started, 3)
+        }
+        print(f"INFO: Batch completed: {succeeded}/{len(collected)} items succeeded")
+        if archive is not None:
+            manifest = dict(summary, items=sorted(collected, key=lambda result: result["index"]))
+            return await archive.respond(request, manifest)
+        await writer.send("complete", summary)
+        return await writer.close()
+
+    except (ConnectionResetError, asyncio.CancelledError):
+        print("INFO: Batch client disconnected, cancelling remaining prompts")
+        raise
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if archive is not None:
+            archive.close()
+
+
+@routes.get('/templates')
+async def list_templates(request):
+    """List registered workflow templates"""
+    return web.json_response({"templates": request.app['templates'].list()})
+
+
+@routes.post('/templates')
+async def register_template(request):
+    """
+    Register a workflow template.
+
+    Body: {"workflow": {...}, "name": "optional alias", "parameters": {"prompt": "6.text"}}.
+    """
+    try:
+        body = await request.json()
     except json.JSONDecodeError as e:
-        print(f"ERROR: Errore di decodifica JSON: {e}")
-        return jsonify({"error": f"JSON decoding error: {str(e)}"}), 400
-    except Exception as e:
-        print(f"FATAL: Errore inatteso: {e}")
-        return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
+        return web.json_response({"error": f"JSON decoding error: {str(e)}"}, status=400)
+    if not isinstance(body, dict):
+        return web.json_response({"error": "Request body must be an object"}, status=400)
+
+    try:
+        template = await request.app['templates'].register(
+            body.get("workflow"), body.get("name"), body.get("parameters"))
+    except TemplateError as e:
+        return web.json_response({"error": str(e)}, status=400)
+    except OSError as e:
+        print(f"ERROR: Failed to store template: {e}")
+        return web.json_response({"error": f"Failed to store template: {e}"}, status=500)
+
+    print(f"INFO: Registered workflow template {template.id} ({len(template.workflow)} nodes)")
+    return web.json_response(template.describe(), status=201)
+
+
+@routes.get('/templates/{template_id}')
+async def get_template(request):
+    """Return a template, including its workflow graph"""
+    template = request.app['templates'].get(request.match_info['template_id'])
+    if template is None:
+        return web.json_response({"error": "Template not found"}, status=404)
+    return web.json_response(dict(template.describe(), workflow=template.workflow))
+
+
+@routes.delete('/templates/{template_id}')
+async def delete_template(request):
+    """Remove a template"""
+    if not request.app['templates'].delete(request.match_info['template_id']):
+        return web.json_response({"error": "Template not found"}, status=404)
+    return web.json_response({"deleted": request.match_info['template_id']})
+
+
+@routes.post('/templates/{template_id}/generate')
+async def generate_from_template(request):
+    """
+    Run a registered template. The body maps parameter names or "node_id.input"
+    paths to values; an empty body runs the template unchanged.
+    """
+    template = request.app['templates'].get(request.match_info['template_id'])
+    if template is None:
+        return web.json_response({"error": "Template not found"}, status=404)
+
+    try:
+        body = await request.text()
+        params = json.loads(body) if body.strip() else {}
+    except json.JSONDecodeError as e:
+        return web.json_response({"error": f"JSON decoding error: {str(e)}"}, status=400)
+
+    try:
+        deadline = parse_deadline(request)
+    except ValueError:
+        return web.json_response({"error": "timeout must be a positive number of seconds"}, status=400)
+
+    random_seed_enabled = os.getenv("INFERENCE_RANDOM_SEED_NODES", "true").lower() == "true"
+    if random_seed_enabled and not template.seed_slots:
+        print("WARN: RANDOM_SEED_NODES is TRUE but no 'seed' or 'noise_seed' found in the workflow. ComfyUI may serve cached results.")
+    try:
+        workflow = template.instantiate(params, random_seed_enabled)
+    except TemplateError as e:
+        return web.json_response({"error": str(e)}, status=400)
+
+    return await run_generation(request, workflow, deadline, deterministic=not random_seed_enabled)
+
+
+@routes.get('/cache')
+async def cache_stats(request):
+    """
+    Result cache statistics.
+    """
+    cache = request.app['result_cache']
+    if cache is None:
+        return web.json_response({"enabled": False})
+    return web.json_response({"enabled": True, **cache.stats()})
+
+
+@routes.delete('/cache')
+@routes.delete('/cache/{key}')
+async def cache_purge(request):
+    """
+    Purge the whole result cache, or a single entry by key.
+    """
+    cache = request.app['result_cache']
+    if cache is None:
+        return web.json_response({"error": "Result cache is disabled"}, status=404)
+    removed = await cache.purge(request.match_info.get('key'))
+    return web.json_response({"status": "success", "removed": removed})
+
+
+@routes.get('/view')
+async def view_output(request):
+    """
+    Stream an output file referenced by a signed URL returned in reference mode.
+    """
+    image_info = verify_view_request(request.query)
+    if image_info is None:
+        return web.json_response({"error": "Invalid or expired URL"}, status=403)
+
+    if image_info['type'] == CACHE_OUTPUT_TYPE:
+        cache = request.app['result_cache']
+        entry = cache.peek(image_info['subfolder']) if cache is not None else None
+        file_entry = entry.find(image_info['filename']) if entry is not None else None
+        try:
+            if file_entry is not None:
+                return await cached_file_response(entry, file_entry)
+        except FileNotFoundError:
+            pass
+        return web.json_response({"error": "Output no longer cached"}, status=404)
+
+    try:
+        return await stream_single(request, request.app['comfy'], image_info)
+    except aiohttp.ClientResponseError as e:
+        return web.json_response({"error": f"Output not available: HTTP {e.status}"}, status=e.status)
+    except ComfyUIError as e:
+        return web.json_response({"error": str(e)}, status=404)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return web.json_response({"error": f"Network or HTTP error: {str(e)}"}, status=502)
+
+
+@routes.get('/metrics')
+async def metrics(request):
+    """
+    Prometheus metrics. Values are kept in memory, a scrape never calls ComfyUI.
+    """
+    body, content_type = render_metrics()
+    return web.Response(body=body, headers={"Content-Type": content_type})
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Record latency and status of every request"""
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else 'unmatched'
+    start = time.monotonic()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        if route != '/metrics':
+            REQUEST_SECONDS.labels(route, str(status)).observe(time.monotonic() - start)
+
+
+def register_app_metrics(app):
+    """Bind gauges to in-memory state so scrapes stay cheap"""
+    scheduler = app['scheduler']
+    SCHEDULER_IN_FLIGHT.set_function(lambda: scheduler.in_flight)
+    SCHEDULER_WAITING.set_function(lambda: scheduler.waiting)
+    REGISTRY.register(FunctionCounter(
+        'ezinfer_rejected', 'Requests rejected by admission control', lambda: scheduler.rejected))
+    cache = app['result_cache']
+    if cache is not None:
+        RESULT_CACHE_BYTES.set_function(lambda: cache.total_bytes)
+    register_textfile_collector()
+
+
+async def comfy_client_ctx(app):
+    """Start the ComfyUI backends (client, WebSocket hub and health monitor each) for the lifetime of the app"""
+    pool = app['comfy']
+    await pool.start(on_node_executed=lambda class_type, seconds: NODE_SECONDS.labels(class_type).observe(seconds))
+    COMFYUI_QUEUE_REMAINING.set_function(lambda: pool.queue_remaining)
+    COMFYUI_WS_CONNECTED.set_function(lambda: 1 if pool.connected else 0)
+    for backend in pool.backends:
+        BACKEND_IN_FLIGHT.labels(backend.name).set_function(lambda backend=backend: backend.in_flight)
+        BACKEND_AVAILABLE.labels(backend.name).set_function(lambda backend=backend: 1 if backend.available else 0)
+    scheduler = app['scheduler']
+    # Saturated when the next request would be rejected by admission control
+    app['health'] = PoolHealth(pool, saturated=lambda: (
+        scheduler.in_flight >= scheduler.max_in_flight and scheduler.waiting >= scheduler.max_queue))
+    # Readiness waits for the warm-up (see warmup.py), which needs the backends started
+    app['warmup'] = Warmup(pool, app['templates'], app['scheduler'], cancel_prompt,
+                           on_duration=lambda backend, phase, seconds: (
+                               WARMUP_SECONDS.labels(backend, phase).set(seconds)))
+    await app['warmup'].start()
+    yield
+    await app['warmup'].close()
+    await pool.close()
+
+
+def create_app():
+    """Build the EzInfer aiohttp application"""
+    app = web.Application(client_max_size=MAX_REQUEST_SIZE, middlewares=[metrics_middleware])
+    pool = BackendPool.from_spec(COMFYUI_BACKENDS, COMFYUI_API_ADDRESS, COMFYUI_OUTPUT_DIR,
+                                 pool_size=COMFYUI_POOL_SIZE, timeout=REQUEST_TIMEOUT)
+    app['comfy'] = pool
+    app['scheduler'] = AdmissionController(MAX_IN_FLIGHT * len(pool.backends), MAX_QUEUE,
+                                           parallelism=lambda: pool.available_count)
+    app['templates'] = TemplateRegistry(TEMPLATE_DIR)
+    app['templates'].load()
+    app['s3_outputs'] = S3OutputSink.from_env(URL_TTL_SECONDS) if S3_OUTPUTS_ENABLED else None
+    app['result_cache'] = None
+    if RESULT_CACHE_ENABLED:
+        app['result_cache'] = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+        app['result_cache'].load()
+    register_app_metrics(app)
+    app.cleanup_ctx.append(comfy_client_ctx)
+    app.add_routes(routes)
+    return app
+
 
 if __name__ == '__main__':
-    print(f"Avvio del server Flask. Ascolto su http://127.0.0.1:5000")
-    print(f"Assicurati che ComfyUI sia in esecuzione e accessibile all'indirizzo: {COMFYUI_API_ADDRESS}")
-    inference_debug = os.getenv("INFERENCE_DEBUG", "false").lower() == "true"
-    app.run(host='127.0.0.1', port=5000, debug=inference_debug)
\ No newline at end of file
+    print("Starting EzInfer server on http://127.0.0.1:5000")
+    print(f"Make sure ComfyUI is running and reachable at: {COMFYUI_BACKENDS or COMFYUI_API_ADDRESS}")
+    web.run_app(create_app(), host='127.0.0.1', port=5000, access_log=None)
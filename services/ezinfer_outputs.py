@@ -0,0 +1,432 @@
+"""
+EzInfer output delivery
+
+Return modes for generated outputs, selected with the `return` query
+parameter or the Accept header:
+
+- json:      base64 images inside a JSON document (default, original contract)
+- binary:    raw image/* body for a single output, multipart/mixed for several
+- reference: JSON with signed, expiring URLs served by EzInfer's /view
+- s3:        JSON with presigned URLs to copies uploaded to the bucket
+             (s3outputs.py, EZINFER_S3_OUTPUTS)
+
+Independently of the return mode, progress can be streamed (?stream=sse or
+?stream=ndjson, or the matching Accept header) with EventStreamWriter, the
+final event carrying the json/reference payload. Batch results can also be
+collected into a zip archive (?return=zip) with BatchArchive.
+
+Binary and reference modes stream bytes from ComfyUI /view in fixed-size
+chunks, so an output is never held in memory as a whole. Outputs replayed
+from the result cache (result_cache.py) are served from local disk. Once
+returned, outputs can be deleted from the ComfyUI output directory
+(delete_output_files, EZINFER_DELETE_OUTPUTS).
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import hmac
+import mimetypes
+import os
+import secrets
+import tempfile
+import time
+import urllib.parse
+import uuid
+import zipfile
+
+import aiohttp
+from aiohttp import web
+
+RETURN_JSON = 'json'
+RETURN_BINARY = 'binary'
+RETURN_REFERENCE = 'reference'
+RETURN_S3 = 's3'
+RETURN_MODES = (RETURN_JSON, RETURN_BINARY, RETURN_REFERENCE, RETURN_S3)
+
+# image_info 'type' of outputs served from the result cache (subfolder = cache key)
+CACHE_OUTPUT_TYPE = 'ezinfer_cache'
+
+# Media type clients can put in Accept to ask for signed URLs
+REFERENCE_MEDIA_TYPE = 'application/vnd.ezinfer.ref+json'
+# Media type clients can put in Accept to ask for presigned S3 URLs
+S3_REFERENCE_MEDIA_TYPE = 'application/vnd.ezinfer.s3+json'
+
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Progress stream formats
+STREAM_SSE = 'sse'
+STREAM_NDJSON = 'ndjson'
+STREAM_MEDIA_TYPES = {STREAM_SSE: 'text/event-stream', STREAM_NDJSON: 'application/x-ndjson'}
+
+# Batch results as a single zip archive
+ARCHIVE_MEDIA_TYPE = 'application/zip'
+
+# Key used to sign /view URLs; a random key means URLs expire on restart
+URL_SIGNING_KEY = (os.getenv('EZINFER_URL_SIGNING_KEY') or secrets.token_hex(32)).encode()
+URL_TTL_SECONDS = int(os.getenv('EZINFER_URL_TTL_SECONDS', '3600'))
+
+# ComfyUI output directory, for deleting outputs once they have been returned
+COMFYUI_OUTPUT_DIR = os.getenv('COMFYUI_OUTPUT_DIR', '/opt/app-root/src/output')
+
+
+def negotiate_return_mode(request):
+    """Pick the return mode from ?return= or the Accept header"""
+    mode = request.query.get('return', '').lower()
+    if mode in RETURN_MODES:
+        return mode
+
+    accept = request.headers.get('Accept', '')
+    if S3_REFERENCE_MEDIA_TYPE in accept:
+        return RETURN_S3
+    if REFERENCE_MEDIA_TYPE in accept:
+        return RETURN_REFERENCE
+    if 'image/' in accept or 'multipart/mixed' in accept:
+        return RETURN_BINARY
+    return RETURN_JSON
+
+
+def negotiate_stream_format(request):
+    """Return 'sse', 'ndjson' or None (no progress streaming)"""
+    stream = request.query.get('stream', '').lower()
+    if stream in STREAM_MEDIA_TYPES:
+        return stream
+
+    accept = request.headers.get('Accept', '')
+    for stream_format, media_type in STREAM_MEDIA_TYPES.items():
+        if media_type in accept:
+            return stream_format
+    return None
+
+
+class EventStreamWriter:
+    """Write progress events as Server-Sent Events or newline-delimited JSON"""
+
+    def __init__(self, request, stream_format, headers=None):
+        self.request = request
+        self.stream_format = stream_format
+        self.response = web.StreamResponse(headers=headers or {})
+        self.response.headers['Content-Type'] = STREAM_MEDIA_TYPES[stream_format]
+        self.response.headers['Cache-Control'] = 'no-cache'
+        # Tell nginx not to buffer this response
+        self.response.headers['X-Accel-Buffering'] = 'no'
+
+    async def start(self):
+        await self.response.prepare(self.request)
+
+    async def send(self, event, data):
+        """Send one event; raises ConnectionResetError if the client went away"""
+        if self.stream_format == STREAM_SSE:
+            payload = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        else:
+            payload = json.dumps({"event": event, "data": data}) + "\n"
+        await self.response.write(payload.encode('utf-8'))
+
+    async def heartbeat(self):
+        """Keep idle connections open and detect disconnected clients"""
+        if self.stream_format == STREAM_SSE:
+            await self.response.write(b": keep-alive\n\n")
+        else:
+            await self.send("heartbeat", {})
+
+    async def close(self):
+        await self.response.write_eof()
+        return self.response
+
+
+def wants_archive(request):
+    """True if a batch should be returned as a zip archive (?return=zip or Accept)"""
+    return (request.query.get('return', '').lower() == 'zip'
+            or ARCHIVE_MEDIA_TYPE in request.headers.get('Accept', ''))
+
+
+class BatchArchive:
+    """Zip archive of batch outputs, spooled to a temporary file as items complete"""
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        # Outputs are already compressed images: store them as-is
+        self._zip = zipfile.ZipFile(self._file, 'w', compression=zipfile.ZIP_STORED)
+        self._lock = asyncio.Lock()
+
+    async def add(self, name, content):
+        async with self._lock:
+            await asyncio.to_thread(self._zip.writestr, name, content)
+
+    async def respond(self, request, manifest, headers=None):
+        """Add manifest.json, then stream the archive as the response body"""
+        try:
+            async with self._lock:
+                await asyncio.to_thread(self._zip.writestr, 'manifest.json', json.dumps(manifest, indent=2))
+                await asyncio.to_thread(self._zip.close)
+
+            response = web.StreamResponse(headers=headers or {})
+            response.content_type = ARCHIVE_MEDIA_TYPE
+            response.headers['Content-Disposition'] = 'attachment; filename="batch.zip"'
+            response.content_length = self._file.tell()
+            await response.prepare(request)
+            self._file.seek(0)
+            while True:
+                chunk = await asyncio.to_thread(self._file.read, STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+        finally:
+            self.close()
+
+    def close(self):
+        self._zip.close()
+        self._file.close()
+
+
+def output_media_type(image_info, default='application/octet-stream'):
+    """Best-effort media type of a ComfyUI output file"""
+    media_type, _ = mimetypes.guess_type(image_info['filename'])
+    return media_type or default
+
+
+def _signature(filename, subfolder, file_type, expires, backend=None):
+    message = f"{filename}\n{subfolder}\n{file_type}\n{expires}"
+    if backend is not None:
+        message += f"\n{backend}"
+    message = message.encode()
+    return hmac.new(URL_SIGNING_KEY, message, hashlib.sha256).hexdigest()
+
+
+def signed_view_url(request, image_info):
+    """Absolute, expiring URL to an output file served by EzInfer /view"""
+    expires = int(time.time()) + URL_TTL_SECONDS
+    filename = image_info['filename']
+    subfolder = image_info.get('subfolder', '')
+    file_type = image_info.get('type', 'output')
+    backend = image_info.get('backend')
+    query = {
+        'filename': filename,
+        'subfolder': subfolder,
+        'type': file_type,
+        'expires': expires,
+        'sig': _signature(filename, subfolder, file_type, expires, backend),
+    }
+    # ComfyUI backend that holds the file (see backends.py)
+    if backend is not None:
+        query['backend'] = backend
+    query = urllib.parse.urlencode(query)
+    # EzInfer sits behind nginx: rebuild the public address from forwarded headers
+    scheme = request.headers.get('X-Forwarded-Proto', request.scheme)
+    host = request.headers.get('X-Forwarded-Host', request.host)
+    return f"{scheme}://{host}/ezinfer/view?{query}", expires
+
+
+def verify_view_request(query):
+    """Validate signature and expiry of a /view request.
+
+    Returns the image_info dict to stream, or None if the URL is invalid.
+    """
+    try:
+        expires = int(query.get('expires', ''))
+    except ValueError:
+        return None
+    if expires < time.time():
+        return None
+
+    image_info = {
+        'filename': query.get('filename', ''),
+        'subfolder': query.get('subfolder', ''),
+        'type': query.get('type', 'output'),
+    }
+    if 'backend' in query:
+        image_info['backend'] = query['backend']
+    expected = _signature(image_info['filename'], image_info['subfolder'], image_info['type'], expires,
+                          image_info.get('backend'))
+    if not image_info['filename'] or not hmac.compare_digest(expected, query.get('sig', '')):
+        return None
+    return image_info
+
+
+async def fetch_image_base64(client, image_info):
+    """Download one output and encode it for the JSON response"""
+    filename = image_info["filename"]
+    try:
+        content = await client.fetch_view(image_info)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as img_ex:
+        print(f"ERROR: Failed to retrieve image '{filename}': {img_ex}")
+        return None
+    return {
+        "filename": filename,
+        "data_base64": base64.b64encode(content).decode('utf-8'),
+        "type": image_info.get("format", "image/jpeg")
+    }
+
+
+async def stream_single(request, client, image_info, headers=None):
+    """Stream one output from ComfyUI /view as the raw response body"""
+    async with client.open_view(image_info) as upstream:
+        upstream.raise_for_status()
+        response = web.StreamResponse(headers=headers or {})
+        response.content_type = output_media_type(image_info, upstream.content_type)
+        response.headers['Content-Disposition'] = f'inline; filename="{image_info["filename"]}"'
+        if upstream.content_length is not None:
+            response.content_length = upstream.content_length
+        await response.prepare(request)
+        async for chunk in upstream.content.iter_chunked(STREAM_CHUNK_SIZE):
+            await response.write(chunk)
+    await response.write_eof()
+    return response
+
+
+async def stream_multipart(request, client, image_infos, headers=None):
+    """Stream several outputs as a multipart/mixed body, one part per file"""
+    boundary = uuid.uuid4().hex
+    response = web.StreamResponse(headers=headers or {})
+    response.headers['Content-Type'] = f'multipart/mixed; boundary={boundary}'
+    await response.prepare(request)
+
+    for image_info in image_infos:
+        filename = image_info['filename']
+        part_started = False
+        try:
+            async with client.open_view(image_info) as upstream:
+                upstream.raise_for_status()
+                part_headers = [
+                    f"--{boundary}",
+                    f"Content-Type: {output_media_type(image_info, upstream.content_type)}",
+                    f'Content-Disposition: attachment; filename="{filename}"',
+                ]
+                if upstream.content_length is not None:
+                    part_headers.append(f"Content-Length: {upstream.content_length}")
+                part_started = True
+                await response.write(("\r\n".join(part_headers) + "\r\n\r\n").encode())
+                async for chunk in upstream.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    await response.write(chunk)
+                await response.write(b"\r\n")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as img_ex:
+            print(f"ERROR: Failed to stream image '{filename}': {img_ex}")
+            if part_started:
+                # A truncated part would corrupt the body: drop the connection without the closing boundary
+                if request.transport is not None:
+                    request.transport.close()
+                return response
+            # Nothing of the part was sent: skip it, like the JSON mode does
+
+    await response.write(f"--{boundary}--\r\n".encode())
+    await response.write_eof()
+    return response
+
+
+def delete_output_files(image_infos, output_dir=COMFYUI_OUTPUT_DIR):
+    """Delete the ComfyUI output files of image_infos, returning how many were removed"""
+    root = os.path.realpath(output_dir)
+    deleted = 0
+    for image_info in image_infos:
+        if image_info.get('type') != 'output':
+            continue
+        path = os.path.realpath(os.path.join(root, image_info.get('subfolder', ''), image_info['filename']))
+        # Never follow a crafted subfolder/filename out of the output directory
+        if not path.startswith(root + os.sep):
+            continue
+        try:
+            os.unlink(path)
+            deleted += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"WARN: Failed to delete output '{image_info['filename']}': {e}")
+    return deleted
+
+
+def cached_view_info(entry, file_entry):
+    """image_info pointing at a file stored in the result cache"""
+    return {'filename': file_entry['stored_as'], 'subfolder': entry.key, 'type': CACHE_OUTPUT_TYPE}
+
+
+async def cached_image_base64(entry, file_entry):
+    """Read one cached output and encode it for the JSON response"""
+    content = await asyncio.to_thread(entry.path(file_entry).read_bytes)
+    return {
+        "filename": file_entry['filename'],
+        "data_base64": base64.b64encode(content).decode('utf-8'),
+        "type": file_entry['media_type']
+    }
+
+
+async def cached_file_response(entry, file_entry, headers=None):
+    """Serve one cached output from disk.
+
+    The file is opened before the handler returns and the response streams
+    from the open handle: an eviction or purge while it is sent unlinks the
+    file but cannot break the response. Raises FileNotFoundError if the file
+    is already gone.
+    """
+    f = await asyncio.to_thread(open, entry.path(file_entry), 'rb')
+    response = web.Response(body=f, headers=headers or {})
+    response.content_type = file_entry['media_type']
+    response.headers['Content-Disposition'] = f'inline; filename="{file_entry["filename"]}"'
+    return response
+
+
+async def stream_cached_multipart(request, entry, headers=None):
+    """Stream all cached outputs of an entry as a multipart/mixed body.
+
+    All files are opened before the response starts, so an entry evicted or
+    purged meanwhile raises FileNotFoundError while the caller can still fall
+    back, and never truncates the body.
+    """
+    handles = []
+    try:
+        for file_entry in entry.files:
+            handles.append(await asyncio.to_thread(open, entry.path(file_entry), 'rb'))
+
+        boundary = uuid.uuid4().hex
+        response = web.StreamResponse(headers=headers or {})
+        response.headers['Content-Type'] = f'multipart/mixed; boundary={boundary}'
+        await response.prepare(request)
+
+        for file_entry, f in zip(entry.files, handles):
+            part_headers = [
+                f"--{boundary}",
+                f"Content-Type: {file_entry['media_type']}",
+                f'Content-Disposition: attachment; filename="{file_entry["filename"]}"',
+                f"Content-Length: {file_entry['size']}",
+            ]
+            await response.write(("\r\n".join(part_headers) + "\r\n\r\n").encode())
+            while True:
+                chunk = await asyncio.to_thread(f.read, STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await response.write(chunk)
+            await response.write(b"\r\n")
+    finally:
+        for f in handles:
+            f.close()
+
+    await response.write(f"--{boundary}--\r\n".encode())
+    await response.write_eof()
+    return response
+
+
+async def respond_from_cache(request, entry, return_mode, headers, s3_sink=None):
+    """Build the /generate response for a result cache entry in the requested mode"""
+    if return_mode == RETURN_S3:
+        references = await s3_sink.upload_cached(entry, int(time.time()) + URL_TTL_SECONDS)
+        return web.json_response(
+            {"status": "success", "images": references, "prompt_id": entry.prompt_id}, headers=headers)
+
+    if return_mode == RETURN_BINARY:
+        if len(entry.files) == 1:
+            return await cached_file_response(entry, entry.files[0], headers)
+        return await stream_cached_multipart(request, entry, headers)
+
+    if return_mode == RETURN_REFERENCE:
+        references = []
+        for file_entry in entry.files:
+            url, expires = signed_view_url(request, cached_view_info(entry, file_entry))
+            references.append({"filename": file_entry['filename'], "url": url, "expires": expires})
+        return web.json_response(
+            {"status": "success", "images": references, "prompt_id": entry.prompt_id}, headers=headers)
+
+    images = await asyncio.gather(*(cached_image_base64(entry, f) for f in entry.files))
+    return web.json_response(
+        {"status": "success", "images": list(images), "prompt_id": entry.prompt_id}, headers=headers)
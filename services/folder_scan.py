@@ -0,0 +1,156 @@
+"""
+Single-pass, cached scan of the S3 uploader source folder
+
+The folder size, debug and upload endpoints all need the same information:
+the list of files to upload with their sizes. FolderScanner walks the tree
+once with os.scandir (one stat per file), applies the exclusion rules
+compiled up front, and keeps the resulting snapshot for a short TTL. After
+the TTL a snapshot is still reused if no scanned directory changed its
+mtime, i.e. no file was added, removed or renamed. Directory mtimes do not
+change when a file is rewritten in place, so a snapshot is never reused for
+longer than max_age: sizes reported by /foldersize are at most that stale.
+"""
+
+import os
+import threading
+import time
+
+
+class ExclusionRules:
+    """Exclusion rules compiled into a set of relative path prefixes"""
+
+    def __init__(self, exclude_list='', defaults=True):
+        self.exclude_list = exclude_list
+        self.defaults = defaults
+        # Always excluded (unless defaults=False): top-level hidden folders, user/ and output/
+        self.top_level = {'user', 'output'}
+        self.prefixes = set()
+        for exclude_folder in exclude_list.split():
+            parts = tuple(p for p in os.path.normpath(exclude_folder.strip()).split(os.sep) if p not in ('', '.'))
+            if parts:
+                self.prefixes.add(parts)
+        self.max_depth = max((len(prefix) for prefix in self.prefixes), default=0)
+
+    def excludes(self, parts):
+        """True if the relative path given as a tuple of parts is excluded"""
+        if not parts:
+            return False
+        if self.defaults and (parts[0].startswith('.') or parts[0] in self.top_level):
+            return True
+        for depth in range(1, min(len(parts), self.max_depth) + 1):
+            if parts[:depth] in self.prefixes:
+                return True
+        return False
+
+
+class FolderSnapshot:
+    """Result of one scan"""
+
+    def __init__(self, source_folder):
+        self.source_folder = source_folder
+        # (local_path, relative_path, size, mtime_ns)
+        self.files = []
+        self.found_dirs = []
+        self.excluded_dirs = []
+        self.excluded_files = []
+        self.total_size = 0
+        self.dir_mtimes = {}
+        self.created_at = time.monotonic()
+        self.scanned_at = self.created_at
+
+    @property
+    def file_count(self):
+        return len(self.files)
+
+    def is_current(self):
+        """True if none of the scanned directories changed since the scan"""
+        for path, mtime_ns in self.dir_mtimes.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime_ns:
+                    return False
+            except OSError:
+                return False
+        return True
+
+
+def scan_folder(source_folder, rules):
+    """Walk source_folder once, skipping excluded directories entirely"""
+    snapshot = FolderSnapshot(source_folder)
+    if not os.path.isdir(source_folder):
+        return snapshot
+
+    stack = [(source_folder, ())]
+    while stack:
+        directory, dir_parts = stack.pop()
+        try:
+            snapshot.dir_mtimes[directory] = os.stat(directory).st_mtime_ns
+            entries = list(os.scandir(directory))
+        except OSError:
+            # Skip directories that can't be accessed
+            continue
+        snapshot.found_dirs.append('/'.join(dir_parts) or '.')
+
+        for entry in entries:
+            parts = dir_parts + (entry.name,)
+            relative_path = '/'.join(parts)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if rules.excludes(parts):
+                        snapshot.excluded_dirs.append(relative_path)
+                    else:
+                        stack.append((entry.path, parts))
+                    continue
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                # Skip files that can't be read
+                continue
+            if rules.excludes(parts):
+                snapshot.excluded_files.append((relative_path, stat.st_size))
+                continue
+            snapshot.files.append((entry.path, relative_path, stat.st_size, stat.st_mtime_ns))
+            snapshot.total_size += stat.st_size
+    return snapshot
+
+
+class FolderScanner:
+    """Shares one snapshot of a folder between endpoints and upload jobs"""
+
+    def __init__(self, source_folder, ttl, max_age=600):
+        self.source_folder = source_folder
+        self.ttl = ttl
+        self.max_age = max_age
+        self._snapshot = None
+        self._rules = None
+        self._lock = threading.Lock()
+
+    def rules(self):
+        """Exclusion rules, recompiled only when S3UPLOADER_EXCLUDE_UPLOAD changes"""
+        exclude_list = os.getenv('S3UPLOADER_EXCLUDE_UPLOAD', '').strip()
+        if self._rules is None or self._rules.exclude_list != exclude_list:
+            self._rules = ExclusionRules(exclude_list)
+            self._snapshot = None
+        return self._rules
+
+    def snapshot(self, fresh=False):
+        """Return the cached snapshot, rescanning if stale or when fresh is set.
+
+        Concurrent callers wait for a single scan instead of walking the tree
+        in parallel.
+        """
+        with self._lock:
+            rules = self.rules()
+            snapshot = self._snapshot
+            if snapshot is not None and not fresh:
+                now = time.monotonic()
+                if now - snapshot.scanned_at < self.ttl:
+                    return snapshot
+                if now - snapshot.created_at < self.max_age and snapshot.is_current():
+                    snapshot.scanned_at = time.monotonic()
+                    return snapshot
+            self._snapshot = scan_folder(self.source_folder, rules)
+            return self._snapshot
+
+    def invalidate(self):
+        self._snapshot = None
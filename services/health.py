@@ -0,0 +1,160 @@
+"""
+Cached ComfyUI health state shared by the probes
+
+Probes used to call ComfyUI on every request (curl in healthcheck.sh, a
+/system_stats call with a 10s timeout in EzInfer's /health). Under frequent
+probing, and while the GPU is saturated, those calls compete with real
+traffic and time out spuriously. A HealthMonitor refreshes the ComfyUI
+status in the background every HEALTH_REFRESH_INTERVAL seconds, and probes
+only read the cached state:
+
+    starting   the startup complete marker is not written yet, or EzInfer is
+               still warming up models (see warmup.py)
+    ready      ComfyUI answers and its queue is below HEALTH_MAX_QUEUE
+    saturated  ComfyUI answers but its queue (or the caller's own) is full
+    degraded   the latest checks failed, for less than HEALTH_LIVENESS_TIMEOUT
+    down       no successful check for HEALTH_LIVENESS_TIMEOUT seconds, counted
+               from the end of startup at the earliest
+
+Liveness only fails when down, where a restart may help. Readiness only
+passes when ready, so traffic goes elsewhere while the pod is starting,
+saturated or failing. While the shared ComfyUI WebSocket is connected its
+status messages provide the queue length, and no HTTP call is made.
+"""
+
+import asyncio
+import os
+import time
+
+import aiohttp
+
+STARTUP_COMPLETE_MARKER = "/tmp/.startup_complete"
+# Written by start-comfyui-with-nginx.sh when EzInfer warms up models, and by EzInfer once done
+WARMUP_REQUIRED_MARKER = "/tmp/.warmup_required"
+WARMUP_COMPLETE_MARKER = "/tmp/.warmup_complete"
+
+HEALTH_REFRESH_INTERVAL = float(os.getenv('HEALTH_REFRESH_INTERVAL', '5'))
+HEALTH_CHECK_TIMEOUT = float(os.getenv('HEALTH_CHECK_TIMEOUT', '5'))
+HEALTH_LIVENESS_TIMEOUT = float(os.getenv('HEALTH_LIVENESS_TIMEOUT', '120'))
+# Queued prompts at which the pod stops being ready (0 disables). Off by default
+# for workbenches, where an unready pod would cut the user off from the UI
+HEALTH_MAX_QUEUE = int(os.getenv('HEALTH_MAX_QUEUE', '8' if os.getenv('API_MODE') == 'true' else '0'))
+
+STATES = ('starting', 'ready', 'saturated', 'degraded', 'down')
+
+
+class HealthMonitor:
+    """Background ComfyUI checks and the probe state derived from them.
+
+    saturated is an optional callable returning True when the caller itself
+    cannot take more work (e.g. EzInfer's admission queue is full).
+    """
+
+    def __init__(self, client, hub=None, saturated=None, interval=HEALTH_REFRESH_INTERVAL):
+        self.client = client
+        self.hub = hub
+        self.saturated = saturated
+        self.interval = interval
+        self.queue_remaining = None
+        self.last_success = None
+        self.last_error = None
+        self.checked_at = None
+        self._failing_since = None
+        self._started = False
+        self._task = None
+
+    async def start(self):
+        self._failing_since = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.interval)
+
+    async def refresh(self):
+        """Check ComfyUI once and update the cached state"""
+        self.checked_at = time.time()
+        if self.hub is not None and self.hub.connected and self.hub.queue_remaining is not None:
+            self._succeeded(self.hub.queue_remaining)
+            return
+        try:
+            status = await self.client.prompt_status(timeout=HEALTH_CHECK_TIMEOUT)
+            self._succeeded(status.get('exec_info', {}).get('queue_remaining', 0))
+        except aiohttp.ClientResponseError as e:
+            self._failed(f"HTTP {e.status}")
+        except aiohttp.ClientConnectionError:
+            self._failed("Connection refused")
+        except asyncio.TimeoutError:
+            self._failed("Request timeout")
+        except Exception as e:
+            self._failed(str(e))
+
+    def report_failure(self, error):
+        """Record a failure seen by a caller (e.g. a refused connection) without waiting for the next check"""
+        self._failed(error)
+
+    def _succeeded(self, queue_remaining):
+        self.queue_remaining = queue_remaining
+        self.last_success = time.monotonic()
+        self.last_error = None
+        self._failing_since = None
+
+    def _failed(self, error):
+        self.last_error = error
+        if self._failing_since is None:
+            self._failing_since = time.monotonic()
+
+    def _is_started(self):
+        if not self._started:
+            # The markers are never removed while running: stop checking once started
+            self._started = os.path.exists(STARTUP_COMPLETE_MARKER) and (
+                not os.path.exists(WARMUP_REQUIRED_MARKER) or os.path.exists(WARMUP_COMPLETE_MARKER))
+            if self._started and self._failing_since is not None:
+                # A long startup is not a failure: the liveness timeout counts from here
+                self._failing_since = time.monotonic()
+        return self._started
+
+    @property
+    def state(self):
+        if not self._is_started():
+            return 'starting'
+        if self._failing_since is not None:
+            if time.monotonic() - self._failing_since >= HEALTH_LIVENESS_TIMEOUT:
+                return 'down'
+            return 'degraded'
+        if HEALTH_MAX_QUEUE and (self.queue_remaining or 0) >= HEALTH_MAX_QUEUE:
+            return 'saturated'
+        if self.saturated is not None and self.saturated():
+            return 'saturated'
+        return 'ready'
+
+    @property
+    def live(self):
+        return self.state != 'down'
+
+    @property
+    def ready(self):
+        return self.state == 'ready'
+
+    def snapshot(self):
+        """Cached state for probe responses"""
+        state = self.state
+        return {
+            'state': state,
+            'live': state != 'down',
+            'ready': state == 'ready',
+            'comfyui': {
+                'reachable': self._failing_since is None,
+                'queue_remaining': self.queue_remaining,
+                'last_success_seconds_ago': None if self.last_success is None else round(
+                    time.monotonic() - self.last_success, 2),
+                'error': self.last_error,
+            },
+            'checked_at': self.checked_at,
+        }
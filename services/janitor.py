@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+Input/output janitor
+
+Replaces the cleanup loop that ran two `find -mmin` walks of input/ and
+output/ every CLEANUP_INTERVAL_SECONDS. The janitor walks the directories
+once at startup and then keeps an in-memory index of their files (size and
+mtime, plus a heap ordered by mtime) up to date with inotify, falling back
+to a periodic rescan where inotify is not available. Two policies are
+enforced from the index, without walking the filesystem:
+
+- max age: files older than CLEANUP_MAX_AGE_MINUTES are deleted;
+- quota: when the indexed files exceed CLEANUP_MAX_MB, or the volume has
+  less than CLEANUP_MIN_FREE_MB free, the least recently written files are
+  deleted until both limits hold again.
+
+The quota is checked as soon as a new file is closed, so a burst of outputs
+cannot fill the volume between passes. Files written in the last
+CLEANUP_QUOTA_GRACE_SECONDS are never deleted for the quota, so an output
+is not removed before EzInfer or the user had a chance to fetch it. When
+the free space is taken by files outside the index, deleting indexed files
+cannot restore it: the janitor then logs a warning instead of emptying
+input/ and output/ for nothing. Only files are deleted, directories
+are preserved. Deletion counters are written as a Prometheus textfile into
+METRICS_TEXTFILE_DIR (re-exported by EzInfer /metrics).
+"""
+
+import asyncio
+import ctypes
+import heapq
+import os
+import stat
+import struct
+import time
+from collections import defaultdict
+
+CLEANUP_ENABLED = os.getenv('CLEANUP_USER_INPUT_OUTPUT', 'false') == 'true'
+CLEANUP_DIRS = {
+    'input': os.getenv('COMFYUI_INPUT_DIR', '/opt/app-root/src/input'),
+    'output': os.getenv('COMFYUI_OUTPUT_DIR', '/opt/app-root/src/output'),
+}
+MAX_AGE_SECONDS = int(os.getenv('CLEANUP_MAX_AGE_MINUTES', '60')) * 60
+# Byte budget of input/ and output/ together, 0 disables
+MAX_BYTES = int(os.getenv('CLEANUP_MAX_MB', '0')) * 1024 ** 2
+# Free space to keep on the volume, 0 disables
+MIN_FREE_BYTES = int(os.getenv('CLEANUP_MIN_FREE_MB', '0')) * 1024 ** 2
+# Files younger than this are exempt from the quota
+QUOTA_GRACE_SECONDS = int(os.getenv('CLEANUP_QUOTA_GRACE_SECONDS', '300'))
+# Age expiry is checked this often (the quota is checked on every new file)
+CHECK_INTERVAL = int(os.getenv('CLEANUP_INTERVAL_SECONDS', '60'))
+# Full rescan interval, to repair the index (and to follow changes without inotify)
+RESCAN_INTERVAL = int(os.getenv('CLEANUP_RESCAN_SECONDS', '3600'))
+POLL_RESCAN_INTERVAL = 60
+METRICS_TEXTFILE_DIR = os.getenv('METRICS_TEXTFILE_DIR', '/tmp/metrics')
+
+# inotify(7)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class FileIndex:
+    """Files of the cleaned directories by path, with a heap ordered by mtime.
+
+    Heap entries are not removed when a file changes or disappears; stale
+    ones are skipped when popped (the file's current mtime no longer matches).
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.heap = []
+        self.total_bytes = 0
+        self.bytes_by_label = defaultdict(int)
+
+    def add(self, path, size, mtime, label):
+        self.discard(path)
+        self.files[path] = (size, mtime, label)
+        self.total_bytes += size
+        self.bytes_by_label[label] += size
+        heapq.heappush(self.heap, (mtime, path))
+        # Rebuild when stale entries dominate, so the heap stays proportional to the files
+        if len(self.heap) > 2 * len(self.files) + 1024:
+            self.heap = [(mtime, path) for path, (_, mtime, _) in self.files.items()]
+            heapq.heapify(self.heap)
+
+    def discard(self, path):
+        entry = self.files.pop(path, None)
+        if entry is not None:
+            self.total_bytes -= entry[0]
+            self.bytes_by_label[entry[2]] -= entry[0]
+        return entry
+
+    def discard_tree(self, directory):
+        prefix = directory.rstrip('/') + '/'
+        for path in [path for path in self.files if path.startswith(prefix)]:
+            self.discard(path)
+
+    def oldest(self):
+        """(mtime, path) of the least recently written file, or None"""
+        while self.heap:
+            mtime, path = self.heap[0]
+            entry = self.files.get(path)
+            if entry is not None and entry[1] == mtime:
+                return mtime, path
+            heapq.heappop(self.heap)
+        return None
+
+    def pop_oldest(self):
+        oldest = self.oldest()
+        if oldest is None:
+            return None
+        heapq.heappop(self.heap)
+        return oldest[1], self.discard(oldest[1])
+
+
+class Inotify:
+    """Recursive inotify watches over a set of directories (via libc, no extra package)"""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    def watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+        self.watches[wd] = directory
+
+    def read_events(self):
+        """Yield (mask, path) for the pending events"""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                yield mask, None
+                continue
+            directory = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if directory is None:
+                continue
+            yield mask, os.path.join(directory, os.fsdecode(name)) if name else directory
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Janitor:
+    """Keeps the index current and enforces the age and quota policies"""
+
+    def __init__(self, directories, max_age=MAX_AGE_SECONDS, max_bytes=MAX_BYTES, min_free_bytes=MIN_FREE_BYTES,
+                 quota_grace=QUOTA_GRACE_SECONDS):
+        self.directories = directories
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.quota_grace = quota_grace
+        self.quota_warning = None
+        self.index = FileIndex()
+        self.inotify = None
+        self.deleted = {label: {'age': 0, 'quota': 0} for label in directories}
+        self.deleted_bytes = {label: 0 for label in directories}
+        self.last_run = None
+
+    def label_of(self, path):
+        for label, directory in self.directories.items():
+            if path == directory or path.startswith(directory.rstrip('/') + '/'):
+                return label
+        return None
+
+    def index_file(self, path, label=None):
+        try:
+            st = os.stat(path, follow_symlinks=False)
+        except OSError:
+            self.index.discard(path)
+            return
+        if stat.S_ISREG(st.st_mode):
+            self.index.add(path, st.st_size, st.st_mtime, label or self.label_of(path))
+
+    def scan(self, directory, label):
+        """Index (and watch) a directory tree"""
+        for root, dirs, names in os.walk(directory):
+            if self.inotify is not None:
+                try:
+                    self.inotify.watch(root)
+                except OSError as e:
+                    print(f"Warning: cannot watch {root}: {e}")
+            for name in names:
+                self.index_file(os.path.join(root, name), label)
+
+    def rescan(self):
+        """Rebuild the index from scratch"""
+        self.index = FileIndex()
+        if self.inotify is not None:
+            self.inotify.watches.clear()
+        for label, directory in self.directories.items():
+            if os.path.isdir(directory):
+                self.scan(directory, label)
+        print(f"[{time.ctime()}] Indexed {len(self.index.files)} files ({self.index.total_bytes / 1024 ** 2:.1f} MB)")
+
+    def on_events(self):
+        changed = False
+        for mask, path in self.inotify.read_events():
+            if path is None:
+                print("Warning: inotify queue overflow, rescanning")
+                self.rescan()
+                return
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files may have been written before the watch was added
+                    self.scan(path, self.label_of(path))
+                    changed = True
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.index.discard_tree(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.index.discard(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_ATTRIB):
+                self.index_file(path)
+                changed = True
+        if changed:
+            self.enforce_quota()
+
+    def delete(self, path, entry, reason):
+        """Delete an indexed file, returning True if it was removed"""
+        size, _, label = entry
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            print(f"Warning: cannot delete {path}: {e}")
+            return False
+        self.deleted[label][reason] += 1
+        self.deleted_bytes[label] += size
+        return True
+
+    def free_bytes(self):
+        free = None
+        for directory in self.directories.values():
+            try:
+                st = os.statvfs(directory)
+            except OSError:
+                continue
+            available = st.f_bavail * st.f_frsize
+            free = available if free is None else min(free, available)
+        return free
+
+    def enforce_quota(self):
+        """Delete the least recently written files while over a watermark, sparing those within the grace period"""
+        # (kind, message) of a limit that cannot be met, printed when the kind changes
+        warning = None
+        deficit = 0
+        if self.min_free_bytes:
+            free = self.free_bytes()
+            if free is not None and free < self.min_free_bytes:
+                deficit = self.min_free_bytes - free
+        if deficit > self.index.total_bytes:
+            warning = ('other_files', f"free space is {deficit / 1024 ** 2:.0f} MB below CLEANUP_MIN_FREE_MB, more "
+                       f"than input/ and output/ hold: the space is used by other files, not deleting for it")
+            deficit = 0
+
+        cutoff = time.time() - self.quota_grace
+        deleted = 0
+        while deficit > 0 or (self.max_bytes and self.index.total_bytes > self.max_bytes):
+            oldest = self.index.oldest()
+            if oldest is None:
+                break
+            if oldest[0] >= cutoff:
+                warning = warning or ('grace', f"over quota, but the remaining files were written in the last "
+                                               f"{self.quota_grace}s (CLEANUP_QUOTA_GRACE_SECONDS)")
+                break
+            path, entry = self.index.pop_oldest()
+            if self.delete(path, entry, 'quota'):
+                # Tracked from the sizes: one statvfs per pass
+                deficit -= entry[0]
+                deleted += 1
+
+        if warning is not None and (self.quota_warning is None or warning[0] != self.quota_warning[0]):
+            print(f"[{time.ctime()}] Warning: {warning[1]}")
+        self.quota_warning = warning
+        if deleted:
+            print(f"[{time.ctime()}] Quota: deleted {deleted} least recently written files")
+            self.write_metrics()
+
+    def expire(self):
+        """Delete the files older than max_age"""
+        cutoff = time.time() - self.max_age
+        deleted = 0
+        while True:
+            oldest = self.index.oldest()
+            if oldest is None or oldest[0] >= cutoff:
+                break
+            if self.delete(*self.index.pop_oldest(), 'age'):
+                deleted += 1
+        if deleted:
+            print(f"[{time.ctime()}] Deleted {deleted} files older than {self.max_age // 60} minutes")
+
+    def write_metrics(self):
+        self.last_run = time.time()
+        lines = [
+            "# HELP cleanup_deleted_files_total Files deleted by the janitor",
+            "# TYPE cleanup_deleted_files_total counter",
+        ]
+        lines += [f'cleanup_deleted_files_total{{dir="{label}"}} {sum(counts.values())}'
+                  for label, counts in self.deleted.items()]
+        lines += [
+            "# HELP cleanup_deleted_by_reason_total Files deleted by the janitor, by policy (age or quota)",
+            "# TYPE cleanup_deleted_by_reason_total counter",
+        ]
+        lines += [f'cleanup_deleted_by_reason_total{{dir="{label}",reason="{reason}"}} {count}'
+                  for label, counts in self.deleted.items() for reason, count in counts.items()]
+        lines += [
+            "# HELP cleanup_deleted_bytes_total Bytes deleted by the janitor",
+            "# TYPE cleanup_deleted_bytes_total counter",
+        ]
+        lines += [f'cleanup_deleted_bytes_total{{dir="{label}"}} {size}' for label, size in self.deleted_bytes.items()]
+        lines += [
+            "# HELP cleanup_tracked_bytes Bytes currently in the cleaned directories",
+            "# TYPE cleanup_tracked_bytes gauge",
+        ]
+        lines += [f'cleanup_tracked_bytes{{dir="{label}"}} {self.index.bytes_by_label[label]}'
+                  for label in self.directories]
+        lines += [
+            "# HELP cleanup_last_run_timestamp_seconds Time of the last cleanup pass",
+            "# TYPE cleanup_last_run_timestamp_seconds gauge",
+            f"cleanup_last_run_timestamp_seconds {int(self.last_run)}",
+        ]
+        try:
+            os.makedirs(METRICS_TEXTFILE_DIR, exist_ok=True)
+            path = os.path.join(METRICS_TEXTFILE_DIR, 'cleanup.prom')
+            with open(f"{path}.tmp", 'w') as f:
+                f.write("\n".join(lines) + "\n")
+            # Rename so scrapes never read a partially written file
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            print(f"Warning: cannot write metrics: {e}")
+
+    async def run(self):
+        try:
+            self.inotify = Inotify()
+        except (OSError, AttributeError) as e:
+            print(f"Warning: inotify unavailable ({e}), rescanning every {POLL_RESCAN_INTERVAL}s instead")
+        rescan_interval = RESCAN_INTERVAL if self.inotify is not None else POLL_RESCAN_INTERVAL
+
+        self.rescan()
+        loop = asyncio.get_running_loop()
+        if self.inotify is not None:
+            loop.add_reader(self.inotify.fd, self.on_events)
+        last_rescan = time.monotonic()
+        try:
+            while True:
+                if time.monotonic() - last_rescan >= rescan_interval:
+                    self.rescan()
+                    last_rescan = time.monotonic()
+                self.expire()
+                self.enforce_quota()
+                self.write_metrics()
+                await asyncio.sleep(CHECK_INTERVAL)
+        finally:
+            if self.inotify is not None:
+                loop.remove_reader(self.inotify.fd)
+                self.inotify.close()
+
+
+async def main():
+    if not CLEANUP_ENABLED:
+        print("Cleanup disabled. Set CLEANUP_USER_INPUT_OUTPUT=true to enable.")
+        # Stay up so supervisord does not keep restarting the program
+        await asyncio.Event().wait()
+    limits = [f"max age {MAX_AGE_SECONDS // 60} minutes"]
+    if MAX_BYTES:
+        limits.append(f"max {MAX_BYTES // 1024 ** 2} MB")
+    if MIN_FREE_BYTES:
+        limits.append(f"min free {MIN_FREE_BYTES // 1024 ** 2} MB")
+    print(f"Starting janitor for {', '.join(CLEANUP_DIRS.values())} ({', '.join(limits)})")
+    await Janitor(CLEANUP_DIRS).run()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,56 @@
+"""
+Prometheus helpers shared by the Python services
+
+Each service registers its own metrics on the default prometheus_client
+registry and exposes them on a /metrics route. Processes that do not
+host an endpoint (e.g. the janitor) write Prometheus text files into
+METRICS_TEXTFILE_DIR; the TextfileCollector re-exports them, so a scrape
+never has to call ComfyUI or walk the filesystem.
+"""
+
+import glob
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from prometheus_client.core import CounterMetricFamily
+from prometheus_client.parser import text_string_to_metric_families
+
+METRICS_TEXTFILE_DIR = os.getenv('METRICS_TEXTFILE_DIR', '/tmp/metrics')
+
+
+class TextfileCollector:
+    """Collect metrics from *.prom files written by other processes"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def collect(self):
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.prom'))):
+            try:
+                with open(path, 'r') as f:
+                    text = f.read()
+                yield from text_string_to_metric_families(text)
+            except (OSError, ValueError) as e:
+                print(f"WARN: Skipping metrics textfile {path}: {e}")
+
+
+class FunctionCounter:
+    """Counter read from in-memory state at scrape time (exposed as <name>_total)"""
+
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def collect(self):
+        yield CounterMetricFamily(self.name, self.documentation, value=self.function())
+
+
+def register_textfile_collector(registry=REGISTRY):
+    """Expose METRICS_TEXTFILE_DIR/*.prom through the given registry"""
+    registry.register(TextfileCollector(METRICS_TEXTFILE_DIR))
+
+
+def render_metrics(registry=REGISTRY):
+    """Return (body, content_type) for a /metrics response"""
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,213 @@
+"""
+EzInfer result cache
+
+Content-addressed cache of workflow outputs. When seeds are not randomized a
+workflow is deterministic, so its outputs can be keyed by a canonical hash of
+the workflow JSON and replayed without running the graph again on the GPU.
+
+Entries live on local disk (one directory per key, holding the output files
+and a meta.json); an in-memory LRU index tracks their sizes and evicts the
+least recently used entries once the configured byte budget is exceeded.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+
+META_FILE = 'meta.json'
+
+
+def _normalize(value):
+    """Normalize a workflow value so equivalent workflows serialize identically"""
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items() if k != '_meta'}
+    if isinstance(value, list):
+        return [_normalize(v) for v in value]
+    if isinstance(value, float):
+        if value.is_integer():
+            return int(value)
+        return float(repr(value))
+    return value
+
+
+def workflow_cache_key(workflow):
+    """Canonical SHA-256 of a workflow: sorted keys, normalized numbers, no _meta"""
+    canonical = json.dumps(_normalize(workflow), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class CacheEntry:
+    """Outputs of one cached workflow"""
+
+    def __init__(self, key, directory, prompt_id, files):
+        self.key = key
+        self.directory = directory
+        self.prompt_id = prompt_id
+        # Each file: {'filename', 'stored_as', 'media_type', 'size'}
+        self.files = files
+        self.size = sum(f['size'] for f in files)
+
+    def path(self, file_entry):
+        return self.directory / file_entry['stored_as']
+
+    def find(self, stored_as):
+        """Return the file entry stored under the given on-disk name"""
+        for file_entry in self.files:
+            if file_entry['stored_as'] == stored_as:
+                return file_entry
+        return None
+
+
+class ResultCache:
+    """Disk-backed LRU cache of workflow outputs"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._index = OrderedDict()
+        self._locks = weakref.WeakValueDictionary()
+
+    def load(self):
+        """Rebuild the in-memory index from disk, oldest entries first"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for entry_dir in self.directory.iterdir():
+            meta_path = entry_dir / META_FILE
+            try:
+                meta = json.loads(meta_path.read_text())
+                mtime = meta_path.stat().st_mtime
+            except (OSError, ValueError):
+                # Incomplete or corrupted entry (e.g. crash during a write)
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            entries.append((mtime, CacheEntry(entry_dir.name, entry_dir, meta.get('prompt_id'), meta['files'])))
+
+        for _, entry in sorted(entries, key=lambda item: item[0]):
+            self._index[entry.key] = entry
+            self.total_bytes += entry.size
+        for entry_dir in self._evict():
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        print(f"INFO: Result cache loaded: {len(self._index)} entries, {self.total_bytes} bytes")
+
+    def lock(self, key):
+        """Per-key lock so identical concurrent requests run the workflow only once"""
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    def peek(self, key):
+        """Return the entry for a key without touching LRU order or statistics"""
+        return self._index.get(key)
+
+    def get(self, key):
+        """Return the entry for a key (marking it recently used) or None"""
+        entry = self._index.get(key)
+        if entry is not None and not all(entry.path(f).is_file() for f in entry.files):
+            # Removed from disk behind the index (manual cleanup, full volume): a miss
+            self.forget(key, entry)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._index.move_to_end(key)
+        self.hits += 1
+        try:
+            # Persist recency so the LRU order survives restarts
+            os.utime(entry.directory / META_FILE)
+        except OSError:
+            pass
+        return entry
+
+    def forget(self, key, entry):
+        """Drop an entry whose files vanished from the index, if it is still the one indexed"""
+        if self._index.get(key) is entry:
+            self._remove(key)
+
+    async def put(self, key, prompt_id, outputs):
+        """Store outputs, a list of (image_info, media_type, bytes), under key"""
+        tmp_dir, files = await asyncio.to_thread(self._write_files, prompt_id, outputs)
+
+        entry_dir = self.directory / key
+        self._remove(key)
+        await asyncio.to_thread(self._replace_dir, tmp_dir, entry_dir)
+
+        entry = CacheEntry(key, entry_dir, prompt_id, files)
+        self._index[key] = entry
+        self.total_bytes += entry.size
+        await self._delete(self._evict())
+        return entry
+
+    def _write_files(self, prompt_id, outputs):
+        tmp_dir = self.directory / f".tmp-{uuid.uuid4().hex}"
+        tmp_dir.mkdir(parents=True)
+        files = []
+        for index, (image_info, media_type, content) in enumerate(outputs):
+            stored_as = f"{index:03d}-{os.path.basename(image_info['filename'])}"
+            (tmp_dir / stored_as).write_bytes(content)
+            files.append({
+                'filename': image_info['filename'],
+                'stored_as': stored_as,
+                'media_type': media_type,
+                'size': len(content),
+            })
+        (tmp_dir / META_FILE).write_text(json.dumps({
+            'prompt_id': prompt_id,
+            'files': files,
+            'created': time.time(),
+        }))
+        return tmp_dir, files
+
+    @staticmethod
+    def _replace_dir(tmp_dir, entry_dir):
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        tmp_dir.rename(entry_dir)
+
+    def _remove(self, key):
+        """Drop an entry from the index, returning its directory (to delete) or None"""
+        entry = self._index.pop(key, None)
+        if entry is None:
+            return None
+        self.total_bytes -= entry.size
+        return entry.directory
+
+    def _evict(self):
+        """Drop least recently used entries over the budget, returning their directories"""
+        evicted = []
+        while self.total_bytes > self.max_bytes and len(self._index) > 1:
+            oldest_key = next(iter(self._index))
+            evicted.append(self._remove(oldest_key))
+        return evicted
+
+    @staticmethod
+    async def _delete(directories):
+        # Large entries take a while to unlink, keep it off the event loop
+        for entry_dir in directories:
+            await asyncio.to_thread(shutil.rmtree, entry_dir, ignore_errors=True)
+
+    async def purge(self, key=None):
+        """Remove one entry, or all of them when key is None. Returns the number removed"""
+        keys = [key] if key is not None else list(self._index)
+        directories = [d for d in (self._remove(cached_key) for cached_key in keys) if d is not None]
+        await self._delete(directories)
+        return len(directories)
+
+    def stats(self):
+        return {
+            'entries': len(self._index),
+            'total_bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,302 @@
+"""
+Packed archive mode for the S3 uploader
+
+Instead of one PUT per file, the selected tree is written as a single tar
+stream, compressed with zstd and streamed straight into an S3 multipart
+upload: no temporary file, and memory bounded by the frames and parts in
+flight.
+
+The tar stream is cut into independent zstd frames of FRAME_SIZE
+uncompressed bytes, compressed in parallel. Concatenated frames are still a
+regular .tar.zst, so a restore just streams it back through one decompressor.
+An index object stores the frame table and the offset of every file in the
+tar stream, so a single file can be fetched with a ranged GET covering only
+the frames that hold it.
+"""
+
+import json
+import os
+import tarfile
+import threading
+import time
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MB = 1024 ** 2
+FRAME_SIZE = 32 * MB
+PART_SIZE = 32 * MB
+PART_UPLOAD_CONCURRENCY = 4
+COMPRESSION_THREADS = max(1, min(8, os.cpu_count() or 1))
+COMPRESSION_LEVEL = int(os.getenv('S3UPLOADER_ZSTD_LEVEL', '3'))
+INDEX_VERSION = 1
+
+ARCHIVE_NAME = 'workbench.tar.zst'
+INDEX_NAME = 'workbench.index.json'
+
+
+class ArchiveError(Exception):
+    """Archive mode unavailable or archive unusable"""
+
+
+def require_zstandard():
+    if zstandard is None:
+        raise ArchiveError("Archive mode requires the 'zstandard' Python package")
+
+
+def archive_keys(prefix):
+    """(archive key, index key) for a bucket subfolder"""
+    return f"{prefix}/{ARCHIVE_NAME}", f"{prefix}/{INDEX_NAME}"
+
+
+class MultipartWriter:
+    """Buffer bytes into PART_SIZE parts and upload them with bounded concurrency"""
+
+    def __init__(self, s3_client, bucket, key):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        self.parts = []
+        self.size = 0
+        self._buffer = bytearray()
+        self._executor = ThreadPoolExecutor(max_workers=PART_UPLOAD_CONCURRENCY)
+        self._pending = deque()
+        self._slots = threading.BoundedSemaphore(PART_UPLOAD_CONCURRENCY + 1)
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        while len(self._buffer) >= PART_SIZE:
+            part = bytes(self._buffer[:PART_SIZE])
+            del self._buffer[:PART_SIZE]
+            self._submit(part)
+
+    def _submit(self, part):
+        # Blocks when enough parts are in flight, which bounds memory
+        self._slots.acquire()
+        part_number = len(self._pending) + len(self.parts) + 1
+        self._pending.append(self._executor.submit(self._upload_part, part_number, part))
+        while self._pending and self._pending[0].done():
+            self.parts.append(self._pending.popleft().result())
+
+    def _upload_part(self, part_number, data):
+        try:
+            response = self.s3_client.upload_part(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                PartNumber=part_number, Body=data)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            self._slots.release()
+
+    def complete(self):
+        if self._buffer or not (self.parts or self._pending):
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self.parts.append(self._pending.popleft().result())
+        self._executor.shutdown()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        self._executor.shutdown(cancel_futures=True)
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            print(f"Error aborting multipart upload of {self.key}: {str(e)}")
+
+
+class FrameWriter:
+    """File-like sink for tarfile that emits independent zstd frames in order"""
+
+    def __init__(self, sink):
+        self.sink = sink
+        # [uncompressed_offset, compressed_offset, compressed_size] per frame
+        self.frames = []
+        self._position = 0
+        self._compressed = 0
+        self._buffer = bytearray()
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=COMPRESSION_THREADS)
+        self._pending = deque()
+
+    def tell(self):
+        return self._position
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= FRAME_SIZE:
+            frame = bytes(self._buffer[:FRAME_SIZE])
+            del self._buffer[:FRAME_SIZE]
+            self._submit(frame)
+        return len(data)
+
+    def _compress(self, data):
+        compressor = getattr(self._local, 'compressor', None)
+        if compressor is None:
+            compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL)
+            self._local.compressor = compressor
+        return compressor.compress(data)
+
+    def _submit(self, frame):
+        uncompressed_offset = self._position - len(self._buffer) - len(frame)
+        self._pending.append((uncompressed_offset, self._executor.submit(self._compress, frame)))
+        # Keep at most two frames per thread in flight
+        while len(self._pending) > COMPRESSION_THREADS * 2 or (self._pending and self._pending[0][1].done()):
+            self._emit()
+
+    def _emit(self):
+        uncompressed_offset, future = self._pending.popleft()
+        compressed = future.result()
+        self.frames.append([uncompressed_offset, self._compressed, len(compressed)])
+        self._compressed += len(compressed)
+        self.sink.write(compressed)
+
+    def close(self):
+        if self._buffer:
+            frame = bytes(self._buffer)
+            self._buffer.clear()
+            self._submit(frame)
+        while self._pending:
+            self._emit()
+        self._executor.shutdown()
+
+    def abort(self):
+        self._executor.shutdown(cancel_futures=True)
+
+
+def upload_archive(s3_client, bucket, prefix, files, on_file=None, cancelled=None, on_multipart=None):
+    """Stream files as a framed .tar.zst multipart upload plus its index object.
+
+    files is a list of (local_path, relative_path, size, mtime_ns); on_file is
+    called with (relative_path, size) after each file, cancelled() is polled
+    between files and on_multipart(key, upload_id) once the multipart upload
+    is created. Returns the index, or None if cancelled.
+    """
+    require_zstandard()
+    archive_key, index_key = archive_keys(prefix)
+    multipart = MultipartWriter(s3_client, bucket, archive_key)
+    if on_multipart is not None:
+        on_multipart(archive_key, multipart.upload_id)
+    frames = FrameWriter(multipart)
+    index_files = {}
+    try:
+        tar = tarfile.open(fileobj=frames, mode='w', format=tarfile.PAX_FORMAT)
+        for local_path, relative_path, size, mtime_ns in files:
+            if cancelled is not None and cancelled():
+                frames.abort()
+                multipart.abort()
+                return None
+            try:
+                tarinfo = tar.gettarinfo(local_path, arcname=relative_path)
+                f = open(local_path, 'rb') if tarinfo.isreg() else None
+            except OSError as e:
+                # Nothing written yet for this file: skip it
+                print(f"Error archiving {relative_path}: {str(e)}")
+                continue
+            if f is None:
+                tar.addfile(tarinfo)
+            else:
+                # A file shrinking while it is read is fatal: its header is already written
+                with f:
+                    tar.addfile(tarinfo, f)
+                # Data is followed by padding up to the next 512 byte block
+                padded = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                index_files[relative_path] = [tar.offset - padded, tarinfo.size, mtime_ns]
+            if on_file is not None:
+                on_file(relative_path, size)
+        tar.close()
+        frames.close()
+        multipart.complete()
+    except BaseException:
+        frames.abort()
+        multipart.abort()
+        raise
+
+    index = {
+        'version': INDEX_VERSION,
+        'created': time.time(),
+        'archive': archive_key,
+        'uncompressed_size': frames.tell(),
+        'compressed_size': multipart.size,
+        'frames': frames.frames,
+        'files': index_files,
+    }
+    s3_client.put_object(Bucket=bucket, Key=index_key, Body=json.dumps(index).encode('utf-8'),
+                         ContentType='application/json')
+    return index
+
+
+def load_index(s3_client, bucket, prefix):
+    _, index_key = archive_keys(prefix)
+    index = json.loads(s3_client.get_object(Bucket=bucket, Key=index_key)['Body'].read())
+    if index.get('version') != INDEX_VERSION:
+        raise ArchiveError(f"Unsupported archive index version {index.get('version')}")
+    return index
+
+
+def fetch_archived_file(s3_client, bucket, prefix, relative_path, index=None):
+    """Read one file out of an archive with a single ranged GET"""
+    require_zstandard()
+    index = index or load_index(s3_client, bucket, prefix)
+    entry = index['files'].get(relative_path)
+    if entry is None:
+        raise KeyError(relative_path)
+    data_offset, size, _ = entry
+
+    frames = index['frames']
+    starts = [frame[0] for frame in frames]
+    first = bisect_right(starts, data_offset) - 1
+    last = max(first, bisect_right(starts, data_offset + size - 1) - 1)
+    range_start = frames[first][1]
+    range_end = frames[last][1] + frames[last][2] - 1
+
+    body = s3_client.get_object(Bucket=bucket, Key=index['archive'],
+                                Range=f"bytes={range_start}-{range_end}")['Body']
+    reader = zstandard.ZstdDecompressor().stream_reader(body, read_across_frames=True)
+    skip = data_offset - frames[first][0]
+    while skip > 0:
+        skipped = len(reader.read(min(skip, FRAME_SIZE)))
+        if not skipped:
+            raise ArchiveError("Archive ended before the requested file")
+        skip -= skipped
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = reader.read(min(remaining, FRAME_SIZE))
+        if not chunk:
+            raise ArchiveError("Archive ended before the requested file")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def restore_archive(s3_client, bucket, prefix, target_folder, on_file=None, cancelled=None):
+    """Stream an archive back and extract it under target_folder. Returns files restored"""
+    require_zstandard()
+    archive_key, _ = archive_keys(prefix)
+    body = s3_client.get_object(Bucket=bucket, Key=archive_key)['Body']
+    reader = zstandard.ZstdDecompressor().stream_reader(body, read_across_frames=True)
+    restored = 0
+    with tarfile.open(fileobj=reader, mode='r|') as tar:
+        for member in tar:
+            if cancelled is not None and cancelled():
+                break
+            if hasattr(tarfile, 'data_filter'):
+                # Refuse absolute paths, '..' and links pointing outside target_folder
+                tar.extract(member, target_folder, filter='data')
+            else:
+                tar.extract(member, target_folder)
+            if member.isreg():
+                restored += 1
+                if on_file is not None:
+                    on_file(member.name, member.size)
+    return restored
@@ -0,0 +1,78 @@
+"""
+S3 connection settings shared by the S3 services
+
+The uploader, the startup restore and anything else talking to the workbench
+bucket read the same AWS_* environment variables and use the same transfer
+configuration, so that ETags computed locally (see s3sync.py) match the
+objects each of them writes.
+"""
+
+import os
+
+import boto3
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+
+
+def get_s3_config():
+    """Get S3 configuration from environment variables"""
+    config = {
+        'endpoint': os.getenv('AWS_S3_ENDPOINT'),
+        'access_key': os.getenv('AWS_ACCESS_KEY_ID'),
+        'secret_key': os.getenv('AWS_SECRET_ACCESS_KEY'),
+        'bucket': os.getenv('AWS_S3_BUCKET'),
+        'region': os.getenv('AWS_REGION', '')
+    }
+
+    # Check if all required config is present
+    missing = [key for key, value in config.items() if value is None and key != 'region']
+    if missing:
+        return None, f"Missing required environment variables: {', '.join(key.upper() for key in missing)}"
+
+    return config, None
+
+
+def get_optimized_transfer_config():
+    """Get optimized transfer configuration for large files and many files"""
+    # 100 MB multipart threshold for large files
+    MB = 1024 ** 2
+
+    transfer_config = TransferConfig(
+        multipart_threshold=50 * MB,  # Files larger than 50MB use multipart
+        max_concurrency=20,           # Increase concurrent transfers
+        multipart_chunksize=50 * MB,  # 50MB chunks for multipart uploads
+        use_threads=True,             # Enable threading for concurrency
+        max_io_queue=1000,           # Increase I/O queue for many files
+        io_chunksize=1024 * 1024     # 1MB I/O chunks
+    )
+
+    return transfer_config
+
+
+def create_s3_client(max_pool_connections=50):
+    """Create an S3 client; returns (client, bucket, transfer_config, error)"""
+    config, error = get_s3_config()
+
+    if error:
+        return None, None, None, error
+
+    # Configure S3 client with connection pooling
+    s3_config = Config(
+        region_name=config['region'],
+        retries={'max_attempts': 3, 'mode': 'adaptive'},
+        max_pool_connections=max_pool_connections
+    )
+
+    try:
+        client = boto3.client(
+            's3',
+            endpoint_url=config['endpoint'],
+            aws_access_key_id=config['access_key'],
+            aws_secret_access_key=config['secret_key'],
+            config=s3_config
+        )
+
+        transfer_config = get_optimized_transfer_config()
+        return client, config['bucket'], transfer_config, None
+    except Exception as e:
+        return None, None, None, f"Failed to create S3 client: {str(e)}"
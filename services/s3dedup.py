@@ -0,0 +1,126 @@
+"""
+Content-addressed (deduplicated) uploads for the S3 uploader
+
+In dedup mode file contents are stored once per bucket as blobs keyed by
+their SHA-256 under a shared prefix (S3UPLOADER_BLOB_PREFIX, default
+"blobs"), e.g. blobs/sha256/ab/ab12...; the uploaded subfolder only gets a
+snapshot manifest object mapping relative paths to hashes. A checkpoint that
+several users (or snapshots) share is therefore transferred and stored once.
+
+Hashing memory-maps each file and feeds the whole mapping to hashlib, which
+releases the GIL while it hashes, so a thread pool hashes files on all cores
+without the process pool pickling or forking the threaded service. Hashes are
+cached by size/mtime in a local SyncManifest, so unchanged files are not
+hashed again. Existing blobs are found with HEAD requests for small batches
+and with one listing of the blob prefix for large ones.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+BLOB_PREFIX = os.getenv('S3UPLOADER_BLOB_PREFIX', 'blobs').strip('/')
+SNAPSHOT_NAME = 'snapshot.json'
+SNAPSHOT_VERSION = 1
+
+HASH_CONCURRENCY = int(os.getenv('S3UPLOADER_HASH_CONCURRENCY', str(max(1, min(8, os.cpu_count() or 1)))))
+# Above this many blobs to check, one listing is cheaper than a HEAD per blob
+HEAD_CHECK_LIMIT = 256
+HEAD_CONCURRENCY = 16
+
+
+def sha256_file(path):
+    """SHA-256 of a file read through a memory mapping"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            return hashlib.sha256(mapped).hexdigest()
+
+
+def blob_path(sha256):
+    """Blob location relative to the blob prefix"""
+    return f"sha256/{sha256[:2]}/{sha256}"
+
+
+def hash_files(files, cache, cancelled=None):
+    """Return {relative_path: sha256} for files, hashing only those not in the cache.
+
+    files is a list of (local_path, relative_path, size, mtime_ns); cache is a
+    SyncManifest whose content_hash holds the SHA-256. Files that cannot be
+    read are left out.
+    """
+    hashes = {}
+    to_hash = []
+    for local_file in files:
+        _, relative_path, size, mtime_ns = local_file
+        entry = cache.unchanged(relative_path, size, mtime_ns)
+        if entry and entry.get('content_hash'):
+            hashes[relative_path] = entry['content_hash']
+        else:
+            to_hash.append(local_file)
+
+    def hash_one(local_file):
+        if cancelled is not None and cancelled():
+            return local_file, None
+        try:
+            return local_file, sha256_file(local_file[0])
+        except (OSError, ValueError) as e:
+            print(f"Error hashing {local_file[1]}: {str(e)}")
+            return local_file, None
+
+    # Largest first, so one big checkpoint does not end up hashing alone at the end
+    to_hash.sort(key=lambda f: f[2], reverse=True)
+    with ThreadPoolExecutor(max_workers=HASH_CONCURRENCY) as executor:
+        for (_, relative_path, size, mtime_ns), sha256 in executor.map(hash_one, to_hash):
+            if sha256 is not None:
+                cache.record(relative_path, size, mtime_ns, '', sha256)
+                hashes[relative_path] = sha256
+    return hashes
+
+
+def existing_blobs(s3_client, bucket, hashes):
+    """Subset of hashes whose blob is already in the bucket"""
+    hashes = set(hashes)
+    if len(hashes) > HEAD_CHECK_LIMIT:
+        found = set()
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{BLOB_PREFIX}/sha256/"):
+            for obj in page.get('Contents', []):
+                found.add(obj['Key'].rsplit('/', 1)[-1])
+        return hashes & found
+
+    def exists(sha256):
+        try:
+            s3_client.head_object(Bucket=bucket, Key=f"{BLOB_PREFIX}/{blob_path(sha256)}")
+            return sha256
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    with ThreadPoolExecutor(max_workers=HEAD_CONCURRENCY) as executor:
+        return {sha256 for sha256 in executor.map(exists, hashes) if sha256 is not None}
+
+
+def write_snapshot(s3_client, bucket, prefix, files, hashes):
+    """Store the snapshot manifest object mapping relative paths to blobs"""
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'created': time.time(),
+        'blob_prefix': BLOB_PREFIX,
+        'files': {
+            relative_path: {'sha256': hashes[relative_path], 'size': size, 'mtime_ns': mtime_ns}
+            for _, relative_path, size, mtime_ns in files
+        },
+    }
+    s3_client.put_object(Bucket=bucket, Key=f"{prefix}/{SNAPSHOT_NAME}",
+                         Body=json.dumps(snapshot).encode('utf-8'), ContentType='application/json')
+    return snapshot
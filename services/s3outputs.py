@@ -0,0 +1,131 @@
+"""
+EzInfer output offload to S3
+
+In the `s3` return mode (?return=s3), outputs do not travel through the
+EzInfer response: each one is uploaded to the workbench bucket (the AWS_*
+variables and transfer configuration of s3client.py) and the response only
+carries presigned GET URLs. Large outputs (upscales, videos, batches) then
+never sit in EzInfer's memory or on the client connection.
+
+Outputs of a backend with a local output directory (see backends.py) are
+uploaded straight from disk, multipart and in parallel, and deleted from the
+output directory once all outputs of the request are uploaded. Outputs of
+other backends are spooled from ComfyUI /view to a temporary file first.
+Objects are written under EZINFER_S3_PREFIX/<prompt id>/; expire them with a
+bucket lifecycle rule. Result cache entries are uploaded once, under
+EZINFER_S3_PREFIX/cache/<key>/, and later hits only presign them again.
+"""
+
+import asyncio
+import os
+import tempfile
+
+from botocore.exceptions import ClientError
+
+from s3client import create_s3_client
+
+S3_OUTPUTS_ENABLED = os.getenv('EZINFER_S3_OUTPUTS', 'false').lower() == 'true'
+S3_PREFIX = os.getenv('EZINFER_S3_PREFIX', 'ezinfer/outputs').strip('/')
+S3_UPLOAD_CONCURRENCY = int(os.getenv('EZINFER_S3_UPLOAD_CONCURRENCY', '8'))
+
+SPOOL_CHUNK_SIZE = 256 * 1024
+
+
+class S3OutputSink:
+    """Uploads outputs to the bucket and presigns them; the boto3 calls run in threads"""
+
+    def __init__(self, client, bucket, transfer_config, prefix=S3_PREFIX, url_ttl=3600,
+                 concurrency=S3_UPLOAD_CONCURRENCY):
+        self.client = client
+        self.bucket = bucket
+        self.transfer_config = transfer_config
+        self.prefix = prefix
+        self.url_ttl = url_ttl
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    @classmethod
+    def from_env(cls, url_ttl=3600):
+        """Sink for the workbench bucket, or None (with a warning) when S3 is not configured"""
+        client, bucket, transfer_config, error = create_s3_client(max(50, S3_UPLOAD_CONCURRENCY * 10))
+        if error:
+            print(f"WARN: S3 output offload disabled: {error}")
+            return None
+        print(f"INFO: S3 output offload to s3://{bucket}/{S3_PREFIX}/")
+        return cls(client, bucket, transfer_config, url_ttl=url_ttl)
+
+    def object_key(self, *parts):
+        return '/'.join(part.strip('/') for part in (self.prefix, *parts) if part and part.strip('/'))
+
+    def _upload_path(self, path, key, media_type):
+        self.client.upload_file(path, self.bucket, key, ExtraArgs={'ContentType': media_type},
+                                Config=self.transfer_config)
+
+    def _upload_fileobj(self, fileobj, key, media_type):
+        self.client.upload_fileobj(fileobj, self.bucket, key, ExtraArgs={'ContentType': media_type},
+                                   Config=self.transfer_config)
+
+    def _stored_size(self, key):
+        """Size of an object already in the bucket, or None"""
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def _presign(self, key):
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': key}, ExpiresIn=self.url_ttl)
+
+    async def _reference(self, filename, key, size, expires):
+        url = await asyncio.to_thread(self._presign, key)
+        return {"filename": filename, "url": url, "expires": expires, "bucket": self.bucket, "key": key,
+                "size": size}
+
+    async def upload_output(self, pool, prompt_id, image_info, media_type, expires):
+        """Upload one ComfyUI output; returns (reference, local path to delete once the request is done, or None)"""
+        filename = image_info['filename']
+        subfolder = image_info.get('subfolder', '')
+        key = self.object_key(prompt_id, subfolder, filename)
+        output_dir = pool.backend_for(image_info).output_dir
+        path = None
+        if output_dir is not None and image_info.get('type') == 'output':
+            root = os.path.realpath(output_dir)
+            path = os.path.realpath(os.path.join(root, subfolder, filename))
+            # Same guard as delete_output_files: never read outside the output directory
+            if not path.startswith(root + os.sep) or not os.path.isfile(path):
+                path = None
+
+        async with self._semaphore:
+            if path is not None:
+                size = os.path.getsize(path)
+                await asyncio.to_thread(self._upload_path, path, key, media_type)
+            else:
+                size = await self._spool_and_upload(pool, image_info, key, media_type)
+
+        return await self._reference(filename, key, size, expires), path
+
+    async def _spool_and_upload(self, pool, image_info, key, media_type):
+        """Copy an output from ComfyUI /view to a temporary file, then upload it"""
+        with tempfile.TemporaryFile() as spool:
+            async with pool.open_view(image_info) as upstream:
+                upstream.raise_for_status()
+                async for chunk in upstream.content.iter_chunked(SPOOL_CHUNK_SIZE):
+                    await asyncio.to_thread(spool.write, chunk)
+            size = spool.tell()
+            spool.seek(0)
+            await asyncio.to_thread(self._upload_fileobj, spool, key, media_type)
+        return size
+
+    async def upload_cached(self, entry, expires):
+        """Presign the files of a result cache entry (result_cache.py), uploading those not in the bucket yet"""
+        async def upload(file_entry):
+            key = self.object_key('cache', entry.key, file_entry['stored_as'])
+            async with self._semaphore:
+                # Cache keys are content addresses: an object of the right size is this file
+                if await asyncio.to_thread(self._stored_size, key) != file_entry['size']:
+                    await asyncio.to_thread(self._upload_path, str(entry.path(file_entry)), key,
+                                            file_entry['media_type'])
+            return await self._reference(file_entry['filename'], key, file_entry['size'], expires)
+
+        return list(await asyncio.gather(*(upload(file_entry) for file_entry in entry.files)))
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+Restore a saved S3 prefix into the workbench volume
+
+The download direction of the S3 uploader: every object under a bucket
+prefix is fetched into the target folder (by default /opt/app-root/src), so
+a new workbench or serving pod starts with its models and custom nodes in
+place instead of having them copied by hand.
+
+Files already present with the remote size and content are skipped. Content
+is compared with the remote ETag, or taken from the sync manifest for files
+untouched since they were last uploaded or restored. Large objects are
+fetched with parallel ranged GETs, one range per part of the original
+multipart upload, so part MD5s are computed while downloading and checked
+against the multipart ETag. Data is written to a partial file that is only
+renamed into place once verified.
+
+A prefix uploaded in dedup mode (see s3dedup.py) holds a snapshot manifest
+instead of the files: each path is then fetched from its blob and checked
+against the SHA-256 the snapshot records.
+
+Model files referenced by target workflows are fetched first. start-comfyui.sh
+runs this before ComfyUI starts, hence before /tmp/.startup_complete is
+written, when S3UPLOADER_RESTORE_PREFIX is set.
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+from s3archive import ARCHIVE_NAME, INDEX_NAME
+from s3client import create_s3_client
+from s3dedup import BLOB_PREFIX, SNAPSHOT_NAME, SNAPSHOT_VERSION, blob_path, sha256_file
+from s3sync import SyncManifest, file_etag, list_remote, manifest_path, multipart_etag
+
+MB = 1024 ** 2
+TARGET_FOLDER = '/opt/app-root/src/'
+MANIFEST_DIR = os.getenv('S3UPLOADER_MANIFEST_DIR', os.path.join(TARGET_FOLDER, '.s3uploader'))
+
+# Files restored concurrently, and ranged GETs in flight across all large files
+RESTORE_CONCURRENCY = int(os.getenv('S3UPLOADER_RESTORE_CONCURRENCY', '8'))
+RANGE_CONCURRENCY = 16
+READ_SIZE = 1 * MB
+PARTIAL_SUFFIX = '.s3restore-partial'
+
+# Part sizes tried against a multipart ETag after our own: common client defaults
+COMMON_PART_SIZES = (8 * MB, 16 * MB, 5 * MB, 64 * MB, 100 * MB)
+
+# Workflow inputs naming one of these are treated as model references
+MODEL_EXTENSIONS = ('.safetensors', '.ckpt', '.pt', '.pth', '.bin', '.gguf', '.onnx', '.sft')
+
+ETAG_PATTERN = re.compile(r'^[0-9a-f]{32}(-\d+)?$')
+
+
+class RestoreError(Exception):
+    """A file could not be restored intact"""
+
+
+def etag_kind(etag):
+    """'md5', 'multipart', or None when the ETag is not derived from the content (e.g. SSE-KMS)"""
+    match = ETAG_PATTERN.match(etag or '')
+    if match is None:
+        return None
+    return 'multipart' if match.group(1) else 'md5'
+
+
+def candidate_part_sizes(size, etag, transfer_config):
+    """Part sizes consistent with the part count of a multipart ETag, most likely first"""
+    parts = int(etag.rsplit('-', 1)[1])
+    candidates = [transfer_config.multipart_chunksize, *COMMON_PART_SIZES,
+                  # Evenly split uploads, rounded up to a whole MB
+                  math.ceil(size / parts / MB) * MB]
+    matching = []
+    for part_size in candidates:
+        if part_size > 0 and part_size not in matching and math.ceil(size / part_size) == parts:
+            matching.append(part_size)
+    return matching
+
+
+def matches_remote(path, size, etag, transfer_config):
+    """True if the local file has the content of the remote object"""
+    kind = etag_kind(etag)
+    if kind is None:
+        # Nothing to compare the content with: the size has to do
+        return True
+    if kind == 'md5':
+        return file_etag(path) == etag
+    return any(file_etag(path, part_size) == etag
+               for part_size in candidate_part_sizes(size, etag, transfer_config))
+
+
+def workflow_references(paths):
+    """Model file names used by the workflows at paths (workflow or template files, or folders of them)"""
+    references = []
+    for path in paths:
+        if os.path.isdir(path):
+            workflow_files = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.json'))
+        else:
+            workflow_files = [path]
+        for workflow_file in workflow_files:
+            try:
+                with open(workflow_file, 'r') as f:
+                    workflow = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Warning: cannot read workflow {workflow_file}: {e}")
+                continue
+            if not isinstance(workflow, dict):
+                continue
+            # EzInfer templates keep the workflow under 'workflow'
+            workflow = workflow.get('workflow', workflow)
+            for node in workflow.values():
+                if not isinstance(node, dict) or not isinstance(node.get('inputs'), dict):
+                    continue
+                for value in node['inputs'].values():
+                    if isinstance(value, str) and value.lower().endswith(MODEL_EXTENSIONS):
+                        name = value.replace('\\', '/')
+                        if name not in references:
+                            references.append(name)
+    return references
+
+
+def snapshot_remote(s3_client, bucket, prefix, remote):
+    """The objects to restore for a listing: the files of its dedup snapshot, if it has one.
+
+    Snapshot files are returned in the shape of list_remote entries with the
+    blob 'key' and the 'sha256' to check, and no ETag.
+    """
+    if SNAPSHOT_NAME not in remote:
+        return remote
+    body = s3_client.get_object(Bucket=bucket, Key=f"{prefix}/{SNAPSHOT_NAME}")['Body'].read()
+    try:
+        snapshot = json.loads(body)
+    except ValueError as e:
+        raise RestoreError(f"Invalid dedup snapshot {prefix}/{SNAPSHOT_NAME}: {e}")
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        raise RestoreError(f"Unsupported dedup snapshot version {snapshot.get('version')} in {prefix}/{SNAPSHOT_NAME}")
+    blob_prefix = snapshot.get('blob_prefix', BLOB_PREFIX)
+    return {
+        relative_path: {'size': entry['size'], 'etag': '', 'sha256': entry['sha256'],
+                        'key': f"{blob_prefix}/{blob_path(entry['sha256'])}"}
+        for relative_path, entry in snapshot['files'].items()
+    }
+
+
+def restorable(relative_path):
+    """False for folder markers, archive and dedup mode objects and paths escaping the target folder"""
+    if relative_path in (ARCHIVE_NAME, INDEX_NAME, SNAPSHOT_NAME):
+        return False
+    return all(part not in ('', '.', '..') for part in relative_path.split('/'))
+
+
+def restore_order(remote, references=()):
+    """Split the restorable objects of a listing into (referenced by workflows, rest)"""
+    paths = sorted(path for path in remote if restorable(path))
+    first = []
+    for name in references:
+        for relative_path in paths:
+            if (relative_path == name or relative_path.endswith(f"/{name}")) and relative_path not in first:
+                first.append(relative_path)
+    referenced = set(first)
+    return first, [path for path in paths if path not in referenced]
+
+
+class PrefixRestore:
+    """Downloads objects of one prefix; large files share one pool of ranged GETs.
+
+    on_file(relative_path, size, downloaded) is called after each file,
+    on_bytes(count) as data arrives, and cancelled() is polled before each
+    file and range.
+    """
+
+    def __init__(self, s3_client, bucket, prefix, target_folder, transfer_config, manifest,
+                 on_file=None, on_bytes=None, cancelled=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.target_folder = target_folder
+        self.transfer_config = transfer_config
+        self.manifest = manifest
+        self.on_file = on_file
+        self.on_bytes = on_bytes
+        self.cancelled = cancelled
+        self.stats = {'downloaded': 0, 'bytes_downloaded': 0, 'skipped': 0, 'bytes_skipped': 0, 'failed': 0}
+        self._stats_lock = threading.Lock()
+        self._ranges = ThreadPoolExecutor(max_workers=RANGE_CONCURRENCY)
+
+    def run(self, relative_paths, remote):
+        """Restore relative_paths (in order of submission) and wait for all of them"""
+        with ThreadPoolExecutor(max_workers=RESTORE_CONCURRENCY) as pool:
+            futures = {pool.submit(self.restore_file, path, remote[path]): path for path in relative_paths}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error restoring {futures[future]}: {str(e)}")
+                    with self._stats_lock:
+                        self.stats['failed'] += 1
+
+    def close(self):
+        self._ranges.shutdown(cancel_futures=True)
+
+    def _is_cancelled(self):
+        return self.cancelled is not None and self.cancelled()
+
+    def restore_file(self, relative_path, remote_obj):
+        """Download one object unless an identical file is already present. Returns True if downloaded"""
+        if self._is_cancelled():
+            return False
+        path = os.path.join(self.target_folder, *relative_path.split('/'))
+        size, etag, sha256 = remote_obj['size'], remote_obj['etag'], remote_obj.get('sha256')
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+        if stat is not None and stat.st_size == size:
+            entry = self.manifest.unchanged(relative_path, size, stat.st_mtime_ns)
+            if entry and (entry.get('content_hash') == sha256 if sha256 else entry['etag'] == etag):
+                self._file_done(relative_path, size, downloaded=False)
+                return False
+            if self._matches(path, size, etag, sha256):
+                self.manifest.record(relative_path, size, stat.st_mtime_ns, etag, sha256)
+                self._file_done(relative_path, size, downloaded=False)
+                return False
+
+        self.download(relative_path, path, size, etag, remote_obj.get('key'), sha256)
+        self.manifest.record(relative_path, size, os.stat(path).st_mtime_ns, etag, sha256)
+        self._file_done(relative_path, size, downloaded=True)
+        return True
+
+    def _matches(self, path, size, etag, sha256):
+        if sha256:
+            return sha256_file(path) == sha256
+        return matches_remote(path, size, etag, self.transfer_config)
+
+    def _file_done(self, relative_path, size, downloaded):
+        with self._stats_lock:
+            if downloaded:
+                self.stats['downloaded'] += 1
+                self.stats['bytes_downloaded'] += size
+            else:
+                self.stats['skipped'] += 1
+                self.stats['bytes_skipped'] += size
+        if self.on_file is not None:
+            self.on_file(relative_path, size, downloaded)
+
+    def download(self, relative_path, path, size, etag, key=None, sha256=None):
+        """Fetch an object (by default the one at relative_path) into a partial file, verify it, then move it into place"""
+        key = key or f"{self.prefix}/{relative_path}"
+        kind = etag_kind(etag)
+        part_sizes = candidate_part_sizes(size, etag, self.transfer_config) if kind == 'multipart' else []
+        if part_sizes:
+            range_size = part_sizes[0]
+        elif size < self.transfer_config.multipart_threshold:
+            range_size = max(size, 1)
+        else:
+            range_size = self.transfer_config.multipart_chunksize
+        ranges = [(start, min(start + range_size, size) - 1) for start in range(0, size, range_size)]
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_path = f"{path}{PARTIAL_SUFFIX}"
+        try:
+            fd = os.open(partial_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.ftruncate(fd, size)
+                if len(ranges) > 1:
+                    futures = [self._ranges.submit(self._fetch_range, key, etag, fd, start, end)
+                               for start, end in ranges]
+                    # Every range must be finished with fd before it is closed
+                    wait(futures)
+                    digests = [future.result() for future in futures]
+                elif ranges:
+                    digests = [self._fetch_range(key, etag, fd, *ranges[0])]
+                else:
+                    digests = [hashlib.md5().digest()]
+            finally:
+                os.close(fd)
+            self._verify(relative_path, partial_path, size, etag, kind, part_sizes, digests)
+            if sha256 and sha256_file(partial_path) != sha256:
+                raise RestoreError(f"{relative_path}: content does not match SHA-256 {sha256}")
+            os.replace(partial_path, path)
+        except BaseException:
+            try:
+                os.remove(partial_path)
+            except OSError:
+                pass
+            raise
+
+    def _fetch_range(self, key, etag, fd, start, end):
+        """GET bytes start-end into fd at the same offset. Returns their MD5 digest"""
+        if self._is_cancelled():
+            raise RestoreError("Restore cancelled")
+        kwargs = {'IfMatch': f'"{etag}"'} if etag else {}
+        body = self.s3_client.get_object(Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end}", **kwargs)['Body']
+        md5 = hashlib.md5()
+        offset = start
+        for chunk in iter(lambda: body.read(READ_SIZE), b''):
+            md5.update(chunk)
+            view = memoryview(chunk)
+            while view:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+            if self.on_bytes is not None:
+                self.on_bytes(len(chunk))
+        if offset != end + 1:
+            raise RestoreError(f"Short read of {key}: got bytes {start}-{offset - 1} of {start}-{end}")
+        return md5.digest()
+
+    def _verify(self, relative_path, partial_path, size, etag, kind, part_sizes, digests):
+        if os.path.getsize(partial_path) != size:
+            raise RestoreError(f"{relative_path}: size does not match the remote object")
+        if kind == 'multipart':
+            if not part_sizes:
+                print(f"Warning: cannot infer the part size of {relative_path} (ETag {etag}), only its size was checked")
+                return
+            if multipart_etag(digests) == etag:
+                return
+            # Same part count, other part size: hash the file again
+            if any(file_etag(partial_path, part_size) == etag for part_size in part_sizes[1:]):
+                return
+        elif kind == 'md5':
+            content_hash = digests[0].hex() if len(digests) == 1 else file_etag(partial_path)
+            if content_hash == etag:
+                return
+        else:
+            return
+        raise RestoreError(f"{relative_path}: content does not match ETag {etag}")
+
+
+def format_bytes(size_bytes):
+    return f"{size_bytes / 1024 ** 3:.2f} GB" if size_bytes >= 1024 ** 3 else f"{size_bytes / MB:.1f} MB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Restore a saved S3 prefix into the workbench volume")
+    parser.add_argument('--prefix', default=os.getenv('S3UPLOADER_RESTORE_PREFIX', ''),
+                        help="Bucket subfolder to restore (default: S3UPLOADER_RESTORE_PREFIX)")
+    parser.add_argument('--target', default=TARGET_FOLDER, help="Folder to restore into")
+    parser.add_argument('--workflow', action='append',
+                        help="Workflow/template JSON file or folder whose models are fetched first; "
+                             "repeatable (default: S3UPLOADER_RESTORE_WORKFLOW, colon-separated)")
+    parser.add_argument('--priority-only', action='store_true',
+                        help="Only restore the files referenced by the workflows")
+    args = parser.parse_args()
+
+    prefix = args.prefix.strip().strip('/')
+    if not prefix:
+        print("No prefix to restore: set S3UPLOADER_RESTORE_PREFIX or pass --prefix")
+        return 2
+    workflows = args.workflow or [path for path in os.getenv('S3UPLOADER_RESTORE_WORKFLOW', '').split(':') if path]
+
+    s3_client, bucket_name, transfer_config, error = create_s3_client(RESTORE_CONCURRENCY + RANGE_CONCURRENCY)
+    if error:
+        print(f"Error: {error}")
+        return 1
+
+    started = time.monotonic()
+    remote = snapshot_remote(s3_client, bucket_name, prefix, list_remote(s3_client, bucket_name, prefix))
+    first, rest = restore_order(remote, workflow_references(workflows))
+    paths = first if args.priority_only else first + rest
+    print(f"Restoring {len(paths)} files ({format_bytes(sum(remote[path]['size'] for path in paths))}) "
+          f"from s3://{bucket_name}/{prefix}/ into {args.target}, {len(first)} referenced by workflows first")
+
+    manifest = SyncManifest(manifest_path(MANIFEST_DIR, bucket_name, prefix)).load()
+    restore = PrefixRestore(s3_client, bucket_name, prefix, args.target, transfer_config, manifest)
+    try:
+        restore.run(first, remote)
+        if not args.priority_only:
+            restore.run(rest, remote)
+    finally:
+        restore.close()
+        try:
+            manifest.save()
+        except OSError as e:
+            print(f"Warning: cannot save sync manifest {manifest.path}: {e}")
+
+    stats = restore.stats
+    print(f"Restore finished in {time.monotonic() - started:.1f}s: "
+          f"{stats['downloaded']} downloaded ({format_bytes(stats['bytes_downloaded'])}), "
+          f"{stats['skipped']} already present ({format_bytes(stats['bytes_skipped'])}), "
+          f"{stats['failed']} failed")
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
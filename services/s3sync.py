@@ -0,0 +1,190 @@
+"""
+Incremental S3 sync support for the S3 uploader
+
+A manifest stored on the workbench volume remembers, for every uploaded file,
+the size and mtime it had when uploaded, its content hash and the ETag S3
+returned. A sync run lists the target prefix once (ListObjectsV2) and only
+uploads files that are new, changed, or missing/different on the remote side.
+
+Content hashes use the same algorithm as S3 ETags for objects uploaded with
+our TransferConfig (plain MD5, or MD5 of part MD5s plus "-<parts>" for
+multipart uploads), so a file whose mtime changed but whose content did not
+(e.g. after a restore) can be matched against the remote ETag without being
+uploaded again.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+MANIFEST_VERSION = 1
+HASH_READ_SIZE = 8 * 1024 * 1024
+DELETE_BATCH_SIZE = 1000
+
+
+def s3_etag(path, transfer_config):
+    """ETag S3 would compute for this file when uploaded with transfer_config"""
+    size = os.path.getsize(path)
+    if size < transfer_config.multipart_threshold:
+        return file_etag(path)
+    return file_etag(path, transfer_config.multipart_chunksize)
+
+
+def file_etag(path, part_size=None):
+    """Plain MD5 ETag, or the multipart ETag for parts of part_size bytes"""
+    if part_size is None:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_READ_SIZE), b''):
+                md5.update(block)
+        return md5.hexdigest()
+
+    part_digests = []
+    with open(path, 'rb') as f:
+        while True:
+            md5 = hashlib.md5()
+            remaining = part_size
+            while remaining > 0:
+                block = f.read(min(HASH_READ_SIZE, remaining))
+                if not block:
+                    break
+                md5.update(block)
+                remaining -= len(block)
+            if remaining == part_size:
+                break
+            part_digests.append(md5.digest())
+    return multipart_etag(part_digests)
+
+
+def multipart_etag(part_digests):
+    """ETag of a multipart object from the MD5 digests of its parts"""
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+def normalize_etag(etag):
+    return (etag or '').strip('"')
+
+
+def manifest_path(manifest_dir, bucket_name, prefix):
+    """Manifest file for one bucket/prefix target"""
+    target = hashlib.sha1(f"{bucket_name}/{prefix}".encode('utf-8')).hexdigest()[:16]
+    return os.path.join(manifest_dir, f"manifest-{target}.json")
+
+
+class SyncManifest:
+    """Per-target record of uploaded files, persisted as JSON"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        # Upload workers record entries while the manifest is periodically saved
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                self.entries = data.get('files', {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Warning: ignoring unreadable sync manifest {self.path}: {e}")
+        return self
+
+    def save(self):
+        """Write the manifest atomically"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with self._lock:
+            files = dict(self.entries)
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'updated': time.time(), 'files': files}, f)
+        os.replace(tmp_path, self.path)
+
+    def record(self, relative_path, size, mtime_ns, etag, content_hash=None):
+        with self._lock:
+            self.entries[relative_path] = {
+                'size': size,
+                'mtime_ns': mtime_ns,
+                'etag': normalize_etag(etag),
+                'content_hash': content_hash,
+            }
+
+    def unchanged(self, relative_path, size, mtime_ns):
+        """Manifest entry if the file still has the size/mtime it was uploaded with"""
+        entry = self.entries.get(relative_path)
+        if entry and entry['size'] == size and entry['mtime_ns'] == mtime_ns:
+            return entry
+        return None
+
+    def prune(self, relative_paths):
+        """Drop entries for files that no longer exist locally"""
+        for relative_path in set(self.entries) - set(relative_paths):
+            del self.entries[relative_path]
+
+
+def list_remote(s3_client, bucket, prefix):
+    """Return {relative_path: {'size', 'etag'}} for all objects under prefix/"""
+    remote = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}/"):
+        for obj in page.get('Contents', []):
+            relative_path = obj['Key'][len(prefix) + 1:]
+            if relative_path:
+                remote[relative_path] = {'size': obj['Size'], 'etag': normalize_etag(obj.get('ETag'))}
+    return remote
+
+
+def plan_sync(local_files, manifest, remote, transfer_config):
+    """Split local files into (to_upload, skipped).
+
+    local_files is a list of (local_path, relative_path, size, mtime_ns).
+    A file is skipped when the remote object matches what the manifest
+    recorded for it, or when its content hash matches the remote ETag.
+    """
+    to_upload = []
+    skipped = []
+    for local_file in local_files:
+        local_path, relative_path, size, mtime_ns = local_file
+        remote_obj = remote.get(relative_path)
+        if remote_obj is None or remote_obj['size'] != size:
+            to_upload.append(local_file)
+            continue
+
+        entry = manifest.unchanged(relative_path, size, mtime_ns)
+        if entry and entry['etag'] == remote_obj['etag']:
+            skipped.append(local_file)
+            continue
+
+        # Stat changed or no manifest yet: compare content with the remote ETag
+        try:
+            content_hash = s3_etag(local_path, transfer_config)
+        except OSError:
+            to_upload.append(local_file)
+            continue
+        if content_hash == remote_obj['etag']:
+            manifest.record(relative_path, size, mtime_ns, remote_obj['etag'], content_hash)
+            skipped.append(local_file)
+        else:
+            to_upload.append(local_file)
+    return to_upload, skipped
+
+
+def delete_remote(s3_client, bucket, prefix, relative_paths):
+    """Delete objects under prefix/ in DeleteObjects batches. Returns the number deleted"""
+    relative_paths = sorted(relative_paths)
+    deleted = 0
+    for start in range(0, len(relative_paths), DELETE_BATCH_SIZE):
+        batch = relative_paths[start:start + DELETE_BATCH_SIZE]
+        response = s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': f"{prefix}/{path}"} for path in batch], 'Quiet': True}
+        )
+        errors = response.get('Errors', [])
+        for error in errors:
+            print(f"Error deleting {error.get('Key')}: {error.get('Message')}")
+        deleted += len(batch) - len(errors)
+    return deleted
@@ -7,14 +7,26 @@ This service runs behind NGINX and only provides API endpoints.
 """
 
 import os
+import queue
+import sqlite3
 import sys
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, Response
 from flask_cors import CORS
-import boto3
-from botocore.config import Config
-from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from prometheus_client import Counter, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from folder_scan import ExclusionRules, FolderScanner, scan_folder
+from metrics import render_metrics
+from s3client import create_s3_client, get_s3_config
+from s3dedup import BLOB_PREFIX, blob_path, existing_blobs, hash_files, write_snapshot
+from s3restore import PrefixRestore, restore_order, snapshot_remote
+from s3archive import ARCHIVE_NAME, fetch_archived_file, restore_archive, upload_archive
+from s3sync import SyncManifest, delete_remote, list_remote, manifest_path, plan_sync
+from upload_journal import UploadJournal
 
 app = Flask(__name__)
 CORS(app)
@@ -22,17 +34,99 @@ CORS(app)
 # Global variables for upload progress tracking
 upload_progress = {
     'status': 'idle',  # idle, running, completed, error
+    'mode': 'full',  # full, sync, archive, dedup, restore
     'current_file': '',
     'files_processed': 0,
     'total_files': 0,
     'bytes_uploaded': 0,
     'total_bytes': 0,
-    'error_message': ''
+    'files_skipped': 0,
+    'bytes_skipped': 0,
+    'files_deleted': 0,
+    'files_failed': 0,
+    'error_message': '',
+    'started_at': 0
 }
 
+# Prometheus metrics
+UPLOADED_BYTES = Counter('s3uploader_uploaded_bytes_total', 'Bytes uploaded to S3')
+UPLOADED_FILES = Counter('s3uploader_uploaded_files_total', 'Files uploaded to S3')
+FAILED_FILES = Counter('s3uploader_failed_files_total', 'Files that failed to upload')
+SKIPPED_FILES = Counter('s3uploader_skipped_files_total', 'Unchanged files skipped by sync')
+DELETED_OBJECTS = Counter('s3uploader_deleted_objects_total', 'Remote orphans deleted by sync')
+
+UPLOAD_STATUSES = ('idle', 'running', 'completed', 'error', 'cancelled')
+
+
+class UploadProgressCollector:
+    """Export the current upload_progress at scrape time (no I/O involved)"""
+
+    def collect(self):
+        progress = upload_progress.copy()
+
+        status = GaugeMetricFamily('s3uploader_upload_status', 'Current upload status', labels=['status'])
+        for name in UPLOAD_STATUSES:
+            status.add_metric([name], 1 if progress['status'] == name else 0)
+        yield status
+
+        yield GaugeMetricFamily('s3uploader_upload_files_processed', 'Files processed by the current upload',
+                                value=progress['files_processed'])
+        yield GaugeMetricFamily('s3uploader_upload_total_files', 'Files to process in the current upload',
+                                value=progress['total_files'])
+        yield GaugeMetricFamily('s3uploader_upload_bytes_uploaded', 'Bytes uploaded by the current upload',
+                                value=progress['bytes_uploaded'])
+        yield GaugeMetricFamily('s3uploader_upload_total_bytes', 'Bytes to upload in the current upload',
+                                value=progress['total_bytes'])
+
+        rate = 0.0
+        if progress['status'] == 'running' and progress['started_at']:
+            elapsed = time.time() - progress['started_at']
+            if elapsed > 0:
+                rate = progress['bytes_uploaded'] / elapsed
+        yield GaugeMetricFamily('s3uploader_upload_bytes_per_second', 'Average throughput of the running upload',
+                                value=rate)
+
+
+REGISTRY.register(UploadProgressCollector())
+
+# Guards upload_progress counters updated by the upload workers
+progress_lock = threading.Lock()
+
 # Source folder to upload
 SOURCE_FOLDER = '/opt/app-root/src/'
 
+# One cached scan of SOURCE_FOLDER shared by all endpoints and upload jobs
+SCAN_CACHE_TTL = int(os.getenv('S3UPLOADER_SCAN_CACHE_TTL', '60'))
+SCAN_CACHE_MAX_AGE = int(os.getenv('S3UPLOADER_SCAN_CACHE_MAX_AGE', '600'))
+folder_scanner = FolderScanner(SOURCE_FOLDER, SCAN_CACHE_TTL, SCAN_CACHE_MAX_AGE)
+
+# Sync manifests live in a top-level hidden folder, which is never uploaded
+MANIFEST_DIR = os.getenv('S3UPLOADER_MANIFEST_DIR', os.path.join(SOURCE_FOLDER, '.s3uploader'))
+MANIFEST_SAVE_INTERVAL = 30
+
+# File-level upload concurrency: small files, and files above the multipart threshold
+UPLOAD_CONCURRENCY = int(os.getenv('S3UPLOADER_CONCURRENCY', '16'))
+LARGE_FILE_CONCURRENCY = int(os.getenv('S3UPLOADER_LARGE_FILE_CONCURRENCY', '2'))
+UPLOAD_QUEUE_SIZE = 1000
+
+# Concurrent parts per large file (each part is held in memory while it uploads)
+PART_CONCURRENCY = 4
+
+# Upload jobs are journaled on the volume so they survive restarts
+JOURNAL_PATH = os.getenv('S3UPLOADER_JOURNAL', os.path.join(MANIFEST_DIR, 'journal.db'))
+PROCESS_STARTED_AT = time.time()
+
+def open_journal():
+    """Open the upload journal, falling back to /tmp if the volume is not writable"""
+    try:
+        return UploadJournal(JOURNAL_PATH)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Warning: cannot open upload journal {JOURNAL_PATH} ({e}), using /tmp: uploads will not survive a pod restart")
+        return UploadJournal('/tmp/s3uploader/journal.db')
+
+journal = open_journal()
+current_job_id = None
+
 def should_exclude_path(path, source_folder):
     """Check if a path should be excluded from upload and size calculation"""
     relative_path = os.path.relpath(path, source_folder)
@@ -41,132 +135,18 @@ def should_exclude_path(path, source_folder):
     if relative_path == '.':
         return False
     
-    # Exclude only top-level hidden folders (starting with . directly under source_folder)
-    # this is to clone all the custom nodes git informations.
-    path_parts = relative_path.split(os.sep)
-    if len(path_parts) > 0 and path_parts[0].startswith('.'):
-        return True
-    
-    # Exclude the user folder
-    if relative_path.startswith('user' + os.sep) or relative_path == 'user':
-        return True
-    
-    # Exclude the output folder
-    if relative_path.startswith('output' + os.sep) or relative_path == 'output':
-        return True
-    
-    # Exclude folders from environment variable
-    exclude_list = os.getenv('S3UPLOADER_EXCLUDE_UPLOAD', '').strip()
-    if exclude_list:
-        exclude_folders = exclude_list.split()
-        for exclude_folder in exclude_folders:
-            # Prepend source folder path and normalize
-            full_exclude_path = os.path.join(source_folder, exclude_folder.strip())
-            full_exclude_path = os.path.normpath(full_exclude_path)
-            current_path = os.path.normpath(path)
-            
-            # Check if current path is the excluded folder or a subfolder of it
-            if current_path == full_exclude_path or current_path.startswith(full_exclude_path + os.sep):
-                return True
-    
-    return False
-
-def get_s3_config():
-    """Get S3 configuration from environment variables"""
-    config = {
-        'endpoint': os.getenv('AWS_S3_ENDPOINT'),
-        'access_key': os.getenv('AWS_ACCESS_KEY_ID'),
-        'secret_key': os.getenv('AWS_SECRET_ACCESS_KEY'),
-        'bucket': os.getenv('AWS_S3_BUCKET'),
-        'region': os.getenv('AWS_REGION', '')
-    }
-    
-    # Check if all required config is present
-    missing = [key for key, value in config.items() if value is None and key != 'region']
-    if missing:
-        return None, f"Missing required environment variables: {', '.join(key.upper() for key in missing)}"
-    
-    return config, None
-
-def get_optimized_transfer_config():
-    """Get optimized transfer configuration for large files and many files"""
-    # 100 MB multipart threshold for large files
-    MB = 1024 ** 2
-    
-    transfer_config = TransferConfig(
-        multipart_threshold=50 * MB,  # Files larger than 50MB use multipart
-        max_concurrency=20,           # Increase concurrent transfers
-        multipart_chunksize=50 * MB,  # 50MB chunks for multipart uploads
-        use_threads=True,             # Enable threading for concurrency
-        max_io_queue=1000,           # Increase I/O queue for many files
-        io_chunksize=1024 * 1024     # 1MB I/O chunks
-    )
-    
-    return transfer_config
+    # Top-level hidden folders, user/, output/ and S3UPLOADER_EXCLUDE_UPLOAD (see folder_scan.py)
+    return folder_scanner.rules().excludes(tuple(relative_path.split(os.sep)))
 
 def get_s3_client():
     """Create and return S3 client with optimized configuration"""
-    config, error = get_s3_config()
-    
-    if error:
-        return None, None, None, error
-    
-    # Configure S3 client with connection pooling
-    s3_config = Config(
-        region_name=config['region'],
-        retries={'max_attempts': 3, 'mode': 'adaptive'},
-        max_pool_connections=50  # Increase connection pool for concurrent uploads
-    )
-    
-    try:
-        client = boto3.client(
-            's3',
-            endpoint_url=config['endpoint'],
-            aws_access_key_id=config['access_key'],
-            aws_secret_access_key=config['secret_key'],
-            config=s3_config
-        )
-        
-        transfer_config = get_optimized_transfer_config()
-        return client, config['bucket'], transfer_config, None
-    except Exception as e:
-        return None, None, None, f"Failed to create S3 client: {str(e)}"
+    # One connection per small-file worker plus the part threads of each large-file worker
+    return create_s3_client(max(50, UPLOAD_CONCURRENCY + LARGE_FILE_CONCURRENCY * 20))
 
 def calculate_folder_size(folder_path):
     """Calculate total size and file count of a folder, excluding specified folders"""
-    total_size = 0
-    file_count = 0
-    
-    if not os.path.exists(folder_path):
-        return 0, 0
-    
-    try:
-        for root, dirs, files in os.walk(folder_path):
-            # Check if current directory should be excluded
-            if should_exclude_path(root, folder_path):
-                # Clear dirs list to prevent os.walk from descending into subdirectories
-                dirs.clear()
-                continue
-            
-            # Filter out excluded directories from dirs list
-            dirs[:] = [d for d in dirs if not should_exclude_path(os.path.join(root, d), folder_path)]
-            
-            # Count files in current directory
-            for file in files:
-                file_path = os.path.join(root, file)
-                # Double-check that file path is not excluded
-                if not should_exclude_path(file_path, folder_path):
-                    try:
-                        total_size += os.path.getsize(file_path)
-                        file_count += 1
-                    except (OSError, IOError):
-                        # Skip files that can't be read
-                        pass
-    except (OSError, IOError):
-        # Skip directories that can't be accessed
-        pass
-    
-    return total_size, file_count
+    snapshot = folder_scanner.snapshot()
+    return snapshot.total_size, snapshot.file_count
 
 def format_size(size_bytes):
     """Format size in bytes to human readable format"""
@@ -176,108 +156,523 @@ def format_size(size_bytes):
         size_bytes /= 1024.0
     return f"{size_bytes:.2f} PB"
 
-def upload_folder_to_s3(subfolder):
-    """Upload folder contents to S3 with progress tracking"""
-    global upload_progress
+def get_manifest_path(bucket_name, prefix):
+    """Manifest file for one bucket/prefix target"""
+    return manifest_path(MANIFEST_DIR, bucket_name, prefix)
+
+def save_progress(force=True):
+    """Persist upload_progress of the current job to the journal"""
+    with progress_lock:
+        snapshot = upload_progress.copy()
+    if current_job_id is not None:
+        journal.save_progress(current_job_id, snapshot, force)
+
+def begin_job(subfolder, mode, options, resume=None):
+    """Reset upload_progress for a job and record it in the journal (or pick up a journaled one)"""
+    global current_job_id
     
-    try:
-        # Reset progress
+    with progress_lock:
         upload_progress.update({
             'status': 'running',
+            'mode': mode,
             'current_file': '',
             'files_processed': 0,
             'total_files': 0,
             'bytes_uploaded': 0,
             'total_bytes': 0,
-            'error_message': ''
+            'files_skipped': 0,
+            'bytes_skipped': 0,
+            'files_deleted': 0,
+            'files_failed': 0,
+            'error_message': '',
+            'started_at': time.time()
         })
+        if resume is not None:
+            upload_progress['started_at'] = resume['progress'].get('started_at') or resume['created_at']
+    
+    if resume is not None:
+        current_job_id = resume['id']
+        save_progress()
+    else:
+        current_job_id = journal.create_job(subfolder, mode, options, upload_progress.copy())
+    return current_job_id
+
+def fail_job(message):
+    """Mark the current job as failed"""
+    with progress_lock:
+        upload_progress['status'] = 'error'
+        upload_progress['error_message'] = message
+    save_progress()
+
+def abort_multipart(s3_client, bucket_name, record):
+    """Abort a journaled multipart upload and forget it"""
+    try:
+        s3_client.abort_multipart_upload(Bucket=bucket_name, Key=record['s3_key'], UploadId=record['upload_id'])
+    except Exception as e:
+        print(f"Error aborting multipart upload of {record['s3_key']}: {str(e)}")
+    journal.finish_multipart(record['upload_id'])
+
+def upload_large_file(s3_client, bucket_name, transfer_config, s3_key, local_file, on_bytes):
+    """Multipart upload that journals every part, resuming a journaled upload of the same file.
+
+    Returns the ETag of the completed object.
+    """
+    local_file_path, relative_path, file_size, mtime_ns = local_file
+    part_size = transfer_config.multipart_chunksize
+    
+    record = journal.find_multipart(current_job_id, relative_path)
+    if record and (record['s3_key'], record['size'], record['mtime_ns'], record['part_size']) != \
+            (s3_key, file_size, mtime_ns, part_size):
+        # The file changed since the interrupted upload: start over
+        abort_multipart(s3_client, bucket_name, record)
+        record = None
+    
+    if record is None:
+        upload_id = s3_client.create_multipart_upload(Bucket=bucket_name, Key=s3_key)['UploadId']
+        journal.start_multipart(current_job_id, relative_path, s3_key, upload_id, file_size, mtime_ns, part_size)
+        parts = {}
+    else:
+        upload_id = record['upload_id']
+        parts = journal.completed_parts(upload_id)
+        print(f"Resuming {relative_path} from part {len(parts) + 1}")
+    
+    part_count = max(1, -(-file_size // part_size))
+    for part_number in parts:
+        on_bytes(min(part_size, file_size - (part_number - 1) * part_size))
+    
+    def upload_part(part_number):
+        with open(local_file_path, 'rb') as f:
+            f.seek((part_number - 1) * part_size)
+            data = f.read(part_size)
+        response = s3_client.upload_part(Bucket=bucket_name, Key=s3_key, UploadId=upload_id,
+                                         PartNumber=part_number, Body=data)
+        journal.part_completed(upload_id, part_number, response['ETag'])
+        on_bytes(len(data))
+        return part_number, response['ETag']
+    
+    missing = [n for n in range(1, part_count + 1) if n not in parts]
+    try:
+        with ThreadPoolExecutor(max_workers=PART_CONCURRENCY) as executor:
+            for part_number, etag in executor.map(upload_part, missing):
+                parts[part_number] = etag
+    except ClientError as e:
+        if record is None or e.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+            raise
+        # The journaled upload was aborted on the S3 side (e.g. lifecycle rule): start over
+        journal.finish_multipart(upload_id)
+        return upload_large_file(s3_client, bucket_name, transfer_config, s3_key, local_file, on_bytes)
+    
+    response = s3_client.complete_multipart_upload(
+        Bucket=bucket_name, Key=s3_key, UploadId=upload_id,
+        MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': parts[n]} for n in sorted(parts)]}
+    )
+    journal.finish_multipart(upload_id)
+    return response.get('ETag')
+
+def upload_one_file(s3_client, bucket_name, transfer_config, prefix, local_file, manifest):
+    """Upload a single file, reporting transferred bytes to upload_progress as they go"""
+    local_file_path, relative_path, file_size, mtime_ns = local_file
+    s3_key = f"{prefix}/{relative_path}"
+    transferred = 0
+    
+    def progress_callback(bytes_transferred):
+        nonlocal transferred
+        transferred += bytes_transferred
+        with progress_lock:
+            upload_progress['bytes_uploaded'] += bytes_transferred
+        save_progress(force=False)
+    
+    with progress_lock:
+        upload_progress['current_file'] = relative_path
+    try:
+        if file_size >= transfer_config.multipart_threshold:
+            etag = upload_large_file(s3_client, bucket_name, transfer_config, s3_key, local_file,
+                                     progress_callback)
+        else:
+            # A single PUT: no transfer manager overhead, and its response carries the ETag
+            with open(local_file_path, 'rb') as body:
+                etag = s3_client.put_object(Bucket=bucket_name, Key=s3_key, Body=body).get('ETag')
+            progress_callback(file_size)
+        manifest.record(relative_path, file_size, mtime_ns, etag)
         
-        # Get S3 client, bucket, and transfer config
-        s3_client, bucket_name, transfer_config, error = get_s3_client()
+        with progress_lock:
+            # Callbacks may not add up to the file size exactly (e.g. retried parts)
+            upload_progress['bytes_uploaded'] += file_size - transferred
+            upload_progress['files_processed'] += 1
+            snapshot = upload_progress.copy()
+        journal.file_completed(current_job_id, relative_path, file_size, mtime_ns, snapshot)
+        UPLOADED_BYTES.inc(file_size)
+        UPLOADED_FILES.inc()
         
+    except Exception as e:
+        with progress_lock:
+            upload_progress['bytes_uploaded'] -= transferred
+            upload_progress['files_failed'] += 1
+        FAILED_FILES.inc()
+        print(f"Error uploading {relative_path}: {str(e)}")
+
+def run_upload_pipeline(s3_client, bucket_name, transfer_config, prefix, files, manifest):
+    """Upload files with a pool of workers fed through bounded queues.
+
+    Small files go through a lane with UPLOAD_CONCURRENCY workers (one request
+    per file each), files above the multipart threshold through a lane with
+    LARGE_FILE_CONCURRENCY workers, since each of those already uploads its
+    parts concurrently. Cancelling stops the producer and lets the workers
+    finish the files they are uploading.
+    """
+    small_lane = queue.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+    large_lane = queue.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+    
+    def worker(lane):
+        while True:
+            local_file = lane.get()
+            if local_file is None:
+                return
+            if upload_progress['status'] == 'running':
+                upload_one_file(s3_client, bucket_name, transfer_config, prefix, local_file, manifest)
+    
+    workers = [threading.Thread(target=worker, args=(small_lane,), daemon=True)
+               for _ in range(max(1, UPLOAD_CONCURRENCY))]
+    workers += [threading.Thread(target=worker, args=(large_lane,), daemon=True)
+                for _ in range(max(1, LARGE_FILE_CONCURRENCY))]
+    for thread in workers:
+        thread.start()
+    
+    last_save = time.time()
+    for local_file in files:
+        if upload_progress['status'] != 'running':
+            break  # Upload was cancelled
+        lane = large_lane if local_file[2] >= transfer_config.multipart_threshold else small_lane
+        lane.put(local_file)
+        
+        # Persist progress regularly so an interrupted sync does not start over
+        if time.time() - last_save > MANIFEST_SAVE_INTERVAL:
+            manifest.save()
+            last_save = time.time()
+    
+    for _ in range(max(1, UPLOAD_CONCURRENCY)):
+        small_lane.put(None)
+    for _ in range(max(1, LARGE_FILE_CONCURRENCY)):
+        large_lane.put(None)
+    for thread in workers:
+        thread.join()
+
+def scan_included_folders(include):
+    """Files of folders normally excluded (e.g. .local) that were explicitly requested"""
+    files = []
+    for folder in include:
+        folder = folder.strip('/')
+        snapshot = scan_folder(os.path.join(SOURCE_FOLDER, folder), ExclusionRules(defaults=False))
+        files.extend((path, f"{folder}/{relative_path}", size, mtime_ns)
+                     for path, relative_path, size, mtime_ns in snapshot.files)
+    return files
+
+def archive_folder_to_s3(subfolder, include=()):
+    """Upload the folder as a single framed tar.zst archive with progress tracking"""
+    try:
+        begin_job(subfolder, 'archive', {'include': list(include)})
+        
+        s3_client, bucket_name, transfer_config, error = get_s3_client()
         if error:
-            upload_progress['status'] = 'error'
-            upload_progress['error_message'] = error
+            fail_job(error)
             return
         
-        # Calculate total size and file count
-        total_bytes, total_files = calculate_folder_size(SOURCE_FOLDER)
-        upload_progress['total_bytes'] = total_bytes
-        upload_progress['total_files'] = total_files
+        files = folder_scanner.snapshot(fresh=True).files + scan_included_folders(include)
+        upload_progress['total_files'] = len(files)
+        upload_progress['total_bytes'] = sum(f[2] for f in files)
+        
+        def on_file(relative_path, size):
+            upload_progress['current_file'] = relative_path
+            upload_progress['files_processed'] += 1
+            upload_progress['bytes_uploaded'] += size
+            save_progress(force=False)
         
-        if total_files == 0:
+        def on_multipart(s3_key, upload_id):
+            # Journaled only so that a restart can abort it: a tar stream cannot be resumed
+            journal.start_multipart(current_job_id, ARCHIVE_NAME, s3_key, upload_id, 0, 0, 0)
+        
+        try:
+            index = upload_archive(
+                s3_client, bucket_name, subfolder.strip('/'), files, on_file,
+                cancelled=lambda: upload_progress['status'] != 'running',
+                on_multipart=on_multipart
+            )
+        finally:
+            for record in journal.multipart_uploads(current_job_id):
+                journal.finish_multipart(record['upload_id'])
+        if index is not None:
+            UPLOADED_BYTES.inc(index['compressed_size'])
+            UPLOADED_FILES.inc(len(index['files']))
+            print(f"Archive uploaded: {len(index['files'])} files, "
+                  f"{format_size(index['uncompressed_size'])} -> {format_size(index['compressed_size'])}")
             upload_progress['status'] = 'completed'
+        upload_progress['current_file'] = ''
+        save_progress()
+        
+    except Exception as e:
+        fail_job(str(e))
+        print(f"Archive upload error: {str(e)}")
+
+def restore_folder_from_s3(subfolder):
+    """Restore a saved subfolder into the source folder.
+
+    An archive created by archive mode is streamed back and extracted, and
+    the files of a dedup snapshot are fetched from their blobs; otherwise the
+    files under the subfolder are downloaded (see s3restore.py), skipping
+    those already present with the same content.
+    """
+    try:
+        begin_job(subfolder, 'restore', {})
+        
+        s3_client, bucket_name, transfer_config, error = get_s3_client()
+        if error:
+            fail_job(error)
             return
         
-        # Upload files
-        for root, dirs, files in os.walk(SOURCE_FOLDER):
-            # Check if current directory should be excluded
-            if should_exclude_path(root, SOURCE_FOLDER):
-                # Clear dirs list to prevent os.walk from descending into subdirectories
-                dirs.clear()
-                continue
+        prefix = subfolder.strip('/')
+        remote = list_remote(s3_client, bucket_name, prefix)
+        if ARCHIVE_NAME in remote:
+            def on_file(relative_path, size):
+                upload_progress['current_file'] = relative_path
+                upload_progress['files_processed'] += 1
+                upload_progress['bytes_uploaded'] += size
+                save_progress(force=False)
             
-            # Filter out excluded directories from dirs list
-            dirs[:] = [d for d in dirs if not should_exclude_path(os.path.join(root, d), SOURCE_FOLDER)]
+            restored = restore_archive(
+                s3_client, bucket_name, prefix, SOURCE_FOLDER, on_file,
+                cancelled=lambda: upload_progress['status'] != 'running'
+            )
+            print(f"Archive restored: {restored} files")
+        else:
+            remote = snapshot_remote(s3_client, bucket_name, prefix, remote)
+            first, rest = restore_order(remote)
+            paths = first + rest
+            upload_progress['total_files'] = len(paths)
+            upload_progress['total_bytes'] = sum(remote[path]['size'] for path in paths)
             
-            # Upload files in current directory
-            for file in files:
-                if upload_progress['status'] != 'running':
-                    return  # Upload was cancelled
-                
-                local_file_path = os.path.join(root, file)
-                
-                # Skip if file path should be excluded
-                if should_exclude_path(local_file_path, SOURCE_FOLDER):
-                    continue
-                
-                # Calculate relative path from source folder
-                relative_path = os.path.relpath(local_file_path, SOURCE_FOLDER)
-                
-                # Create S3 key with subfolder
-                s3_key = f"{subfolder.strip('/')}/{relative_path}".replace('\\', '/')
-                
-                try:
+            def on_file(relative_path, size, downloaded):
+                with progress_lock:
                     upload_progress['current_file'] = relative_path
-                    file_size = os.path.getsize(local_file_path)
-                    
-                    # Create progress callback for individual file uploads
-                    def progress_callback(bytes_transferred):
-                        # This callback is called during file transfer
-                        # Note: This is for individual file progress, not total progress
-                        pass
-                    
-                    # Upload file with optimized configuration
-                    s3_client.upload_file(
-                        local_file_path, 
-                        bucket_name, 
-                        s3_key,
-                        Config=transfer_config,
-                        Callback=progress_callback
-                    )
-                    
-                    # Update overall progress after successful upload
-                    upload_progress['bytes_uploaded'] += file_size
                     upload_progress['files_processed'] += 1
-                    
-                except Exception as e:
-                    print(f"Error uploading {relative_path}: {str(e)}")
-                    # Continue with next file on error
-                    continue
+                    if not downloaded:
+                        upload_progress['files_skipped'] += 1
+                        upload_progress['bytes_skipped'] += size
+                save_progress(force=False)
+            
+            def on_bytes(count):
+                with progress_lock:
+                    upload_progress['bytes_uploaded'] += count
+            
+            manifest = SyncManifest(get_manifest_path(bucket_name, prefix)).load()
+            restore = PrefixRestore(
+                s3_client, bucket_name, prefix, SOURCE_FOLDER, transfer_config, manifest,
+                on_file, on_bytes, cancelled=lambda: upload_progress['status'] != 'running'
+            )
+            try:
+                restore.run(paths, remote)
+            finally:
+                restore.close()
+                manifest.save()
+            print(f"Files restored: {restore.stats['downloaded']} downloaded, "
+                  f"{restore.stats['skipped']} already present, {restore.stats['failed']} failed")
+            upload_progress['files_failed'] = restore.stats['failed']
+            if restore.stats['failed'] and upload_progress['status'] == 'running':
+                fail_job(f"{restore.stats['failed']} files failed to restore")
         
-        upload_progress['status'] = 'completed'
+        folder_scanner.invalidate()
+        if upload_progress['status'] == 'running':
+            upload_progress['status'] = 'completed'
         upload_progress['current_file'] = ''
+        save_progress()
         
     except Exception as e:
-        upload_progress['status'] = 'error'
-        upload_progress['error_message'] = str(e)
+        fail_job(str(e))
+        print(f"Restore error: {str(e)}")
+
+def upload_folder_to_s3(subfolder, mode='full', delete_orphans=False, resume=None):
+    """Upload folder contents to S3 with progress tracking.
+
+    mode='full' uploads every file; mode='sync' only uploads files that are
+    new or changed according to the sync manifest and the remote listing,
+    and deletes remote orphans when delete_orphans is set; mode='dedup'
+    uploads contents missing from the shared blob store and a snapshot
+    manifest (see s3dedup.py). resume is a journaled job interrupted by a
+    restart: files it completed are skipped.
+    """
+    try:
+        job_id = begin_job(subfolder, mode, {'delete_orphans': delete_orphans}, resume)
+        
+        # Get S3 client, bucket, and transfer config
+        s3_client, bucket_name, transfer_config, error = get_s3_client()
+        
+        if error:
+            fail_job(error)
+            return
+        
+        prefix = subfolder.strip('/')
+        # Always rescan for an upload; the snapshot is then reused by the other endpoints
+        local_files = folder_scanner.snapshot(fresh=True).files
+        manifest = SyncManifest(get_manifest_path(bucket_name, prefix)).load()
+        
+        # Files completed before a restart (and unchanged since) count as done
+        completed = journal.completed_files(job_id) if resume is not None else {}
+        done = [f for f in local_files if completed.get(f[1]) == (f[2], f[3])]
+        pending = [f for f in local_files if completed.get(f[1]) != (f[2], f[3])]
+        if resume is not None:
+            print(f"Resuming upload job {job_id}: {len(done)} files already uploaded")
+        
+        if mode == 'sync':
+            upload_progress['current_file'] = 'Comparing with remote objects...'
+            remote = list_remote(s3_client, bucket_name, prefix)
+            to_upload, skipped = plan_sync(pending, manifest, remote, transfer_config)
+            upload_progress['files_skipped'] = len(skipped)
+            upload_progress['bytes_skipped'] = sum(f[2] for f in skipped)
+            SKIPPED_FILES.inc(len(skipped))
+            print(f"Sync: {len(to_upload)} files to upload, {len(skipped)} unchanged")
+        elif mode == 'dedup':
+            upload_progress['current_file'] = 'Hashing files...'
+            hash_cache = SyncManifest(os.path.join(MANIFEST_DIR, 'sha256-cache.json')).load()
+            hashes = hash_files(local_files, hash_cache, cancelled=lambda: upload_progress['status'] != 'running')
+            hash_cache.prune([f[1] for f in local_files])
+            hash_cache.save()
+            
+            upload_progress['current_file'] = 'Checking for existing blobs...'
+            stored = existing_blobs(s3_client, bucket_name, hashes.values())
+            # One upload per missing content, however many files share it
+            blobs = {}
+            for local_path, relative_path, size, mtime_ns in local_files:
+                sha256 = hashes.get(relative_path)
+                if sha256 is not None and sha256 not in stored and sha256 not in blobs:
+                    blobs[sha256] = (local_path, blob_path(sha256), size, mtime_ns)
+            remote = {}
+            to_upload = list(blobs.values())
+            # Blobs go to the shared prefix and are recorded in their own manifest
+            prefix = BLOB_PREFIX
+            manifest = SyncManifest(get_manifest_path(bucket_name, BLOB_PREFIX)).load()
+            upload_progress['files_skipped'] = len(hashes) - len(to_upload)
+            upload_progress['bytes_skipped'] = (sum(f[2] for f in local_files if f[1] in hashes)
+                                                - sum(f[2] for f in to_upload))
+            SKIPPED_FILES.inc(upload_progress['files_skipped'])
+            print(f"Dedup: {len(to_upload)} new blobs to upload, {upload_progress['files_skipped']} files already stored")
+        else:
+            remote = {}
+            to_upload = pending
+        
+        with progress_lock:
+            upload_progress['files_processed'] = len(done)
+            upload_progress['bytes_uploaded'] = sum(f[2] for f in done)
+            upload_progress['total_files'] = len(done) + len(to_upload)
+            upload_progress['total_bytes'] = upload_progress['bytes_uploaded'] + sum(f[2] for f in to_upload)
+        save_progress()
+        
+        run_upload_pipeline(s3_client, bucket_name, transfer_config, prefix, to_upload, manifest)
+        
+        if upload_progress['status'] == 'running' and mode == 'dedup':
+            # The snapshot is only written once every file it lists has its blob
+            missing = [sha256 for sha256 in blobs if blob_path(sha256) not in manifest.entries]
+            unreadable = len(local_files) - len(hashes)
+            if missing or unreadable:
+                fail_job(f"{len(missing) + unreadable} files could not be stored, snapshot manifest not written")
+            else:
+                write_snapshot(s3_client, bucket_name, subfolder.strip('/'), local_files, hashes)
+                upload_progress['status'] = 'completed'
+        elif upload_progress['status'] == 'running':
+            local_paths = [f[1] for f in local_files]
+            manifest.prune(local_paths)
+            if mode == 'sync' and delete_orphans:
+                # Never delete objects whose local path is excluded (user/, output/, ...)
+                orphans = [
+                    path for path in set(remote) - set(local_paths)
+                    if not should_exclude_path(os.path.join(SOURCE_FOLDER, path), SOURCE_FOLDER)
+                ]
+                if orphans:
+                    upload_progress['current_file'] = f'Deleting {len(orphans)} remote orphans...'
+                    deleted = delete_remote(s3_client, bucket_name, prefix, orphans)
+                    upload_progress['files_deleted'] = deleted
+                    DELETED_OBJECTS.inc(deleted)
+            if upload_progress['files_failed']:
+                # Like dedup: a job that left files behind is not completed, so it gets noticed and re-run
+                fail_job(f"{upload_progress['files_failed']} files failed to upload")
+            else:
+                upload_progress['status'] = 'completed'
+        if upload_progress['status'] != 'completed':
+            # Cancelled or failed: nothing will resume the multipart uploads of this job
+            for record in journal.multipart_uploads(job_id):
+                abort_multipart(s3_client, bucket_name, record)
+        
+        manifest.save()
+        upload_progress['current_file'] = ''
+        save_progress()
+        journal.prune()
+        
+    except Exception as e:
+        fail_job(str(e))
         print(f"Upload error: {str(e)}")
 
+def recover_interrupted_jobs():
+    """Resume or clean up jobs that were running when the service stopped"""
+    s3_client, bucket_name, transfer_config, error = get_s3_client()
+    jobs = journal.running_jobs()
+    running_ids = {job['id'] for job in jobs}
+    
+    # Multipart uploads of jobs that are over can never complete
+    for record in journal.multipart_uploads():
+        if record['job_id'] not in running_ids:
+            if s3_client is not None:
+                abort_multipart(s3_client, bucket_name, record)
+            else:
+                journal.finish_multipart(record['upload_id'])
+    
+    resumed = None
+    for job in jobs:
+        if error or job['mode'] not in ('full', 'sync', 'dedup') or resumed is not None:
+            # Archive streams and restores cannot be resumed, nor anything without S3 config;
+            # and only one upload runs at a time, like the upload endpoint enforces
+            for record in journal.multipart_uploads(job['id']):
+                if s3_client is not None:
+                    abort_multipart(s3_client, bucket_name, record)
+                else:
+                    journal.finish_multipart(record['upload_id'])
+            reason = error or ('Superseded by a resumed job' if resumed else 'Interrupted by a service restart')
+            journal.save_progress(job['id'], dict(job['progress'], status='error', error_message=reason))
+            print(f"Upload job {job['id']} ({job['mode']}) was interrupted and cannot be resumed")
+            continue
+        
+        resumed = job
+        abort_orphaned_multipart_uploads(s3_client, bucket_name, job)
+        print(f"Resuming interrupted upload job {job['id']} to {job['subfolder']}")
+        threading.Thread(
+            target=upload_folder_to_s3,
+            args=(job['subfolder'], job['mode'], job['options'].get('delete_orphans', False), job),
+            daemon=True
+        ).start()
+
+def abort_orphaned_multipart_uploads(s3_client, bucket_name, job):
+    """Abort multipart uploads under the job prefix started before this process and not journaled"""
+    prefix = job['subfolder'].strip('/')
+    journaled = {record['upload_id'] for record in journal.multipart_uploads(job['id'])}
+    try:
+        paginator = s3_client.get_paginator('list_multipart_uploads')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=f"{prefix}/"):
+            for upload in page.get('Uploads', []):
+                if upload['UploadId'] in journaled or upload['Initiated'].timestamp() > PROCESS_STARTED_AT:
+                    continue
+                s3_client.abort_multipart_upload(Bucket=bucket_name, Key=upload['Key'], UploadId=upload['UploadId'])
+                print(f"Aborted stale multipart upload of {upload['Key']}")
+    except Exception as e:
+        print(f"Error listing stale multipart uploads: {str(e)}")
+
 @app.route('/s3uploader/healthz', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({'status': 'healthy'})
 
+@app.route('/s3uploader/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics endpoint"""
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
 @app.route('/s3uploader/s3config', methods=['GET'])
 def get_s3_configuration():
     """Get S3 configuration info"""
@@ -344,6 +739,23 @@ def start_upload():
     try:
         data = request.get_json()
         subfolder = data.get('subfolder', '').strip()
+        mode = data.get('mode', 'full')
+        delete_orphans = bool(data.get('delete_orphans', False))
+        include = data.get('include', [])
+        
+        if mode not in ('full', 'sync', 'archive', 'dedup'):
+            return jsonify({
+                'success': False,
+                'error': 'Mode must be "full", "sync", "archive" or "dedup"'
+            }), 400
+        
+        if not isinstance(include, list) or any(
+                not isinstance(folder, str) or os.path.isabs(folder) or '..' in folder.split('/')
+                for folder in include):
+            return jsonify({
+                'success': False,
+                'error': 'Include must be a list of folders relative to the source folder'
+            }), 400
         
         # Validate subfolder
         if not subfolder or subfolder == '/':
@@ -360,16 +772,60 @@ def start_upload():
             }), 409
         
         # Start upload in background thread
-        upload_thread = threading.Thread(
-            target=upload_folder_to_s3, 
+        if mode == 'archive':
+            upload_thread = threading.Thread(
+                target=archive_folder_to_s3,
+                args=(subfolder, include),
+                daemon=True
+            )
+        else:
+            upload_thread = threading.Thread(
+                target=upload_folder_to_s3, 
+                args=(subfolder, mode, delete_orphans),
+                daemon=True
+            )
+        upload_thread.start()
+        
+        return jsonify({
+            'success': True,
+            'message': 'Upload started'
+        })
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/s3uploader/restore', methods=['POST'])
+def start_restore():
+    """Start restoring a saved subfolder (archive or files) into the source folder"""
+    try:
+        data = request.get_json()
+        subfolder = data.get('subfolder', '').strip()
+        
+        if not subfolder or subfolder == '/':
+            return jsonify({
+                'success': False,
+                'error': 'Subfolder cannot be empty or just "/"'
+            }), 400
+        
+        if upload_progress['status'] == 'running':
+            return jsonify({
+                'success': False,
+                'error': 'Upload is already in progress'
+            }), 409
+        
+        restore_thread = threading.Thread(
+            target=restore_folder_from_s3,
             args=(subfolder,),
             daemon=True
         )
-        upload_thread.start()
+        restore_thread.start()
         
         return jsonify({
             'success': True,
-            'message': 'Upload started'
+            'message': 'Restore started'
         })
         
     except Exception as e:
@@ -378,12 +834,52 @@ def start_upload():
             'error': str(e)
         }), 500
 
+@app.route('/s3uploader/archive/file', methods=['GET'])
+def get_archived_file():
+    """Fetch a single file out of an archive (ranged GET on the archive object)"""
+    subfolder = request.args.get('subfolder', '').strip('/')
+    relative_path = request.args.get('path', '').strip('/')
+    if not subfolder or not relative_path:
+        return jsonify({
+            'success': False,
+            'error': 'Both subfolder and path are required'
+        }), 400
+    
+    s3_client, bucket_name, transfer_config, error = get_s3_client()
+    if error:
+        return jsonify({
+            'success': False,
+            'error': error
+        }), 500
+    
+    try:
+        content = fetch_archived_file(s3_client, bucket_name, subfolder, relative_path)
+    except KeyError:
+        return jsonify({
+            'success': False,
+            'error': f'{relative_path} not found in archive'
+        }), 404
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+    
+    return Response(content, mimetype='application/octet-stream', headers={
+        'Content-Disposition': f'attachment; filename="{os.path.basename(relative_path)}"'
+    })
+
 @app.route('/s3uploader/upload/progress', methods=['GET'])
 def get_upload_progress():
-    """Get current upload progress"""
+    """Get current upload progress (from the journal, so it survives restarts)"""
+    job = journal.latest_job()
+    if job is None:
+        progress = upload_progress.copy()
+    else:
+        progress = dict(job['progress'], status=job['status'], job_id=job['id'], subfolder=job['subfolder'])
     return jsonify({
         'success': True,
-        'progress': upload_progress.copy()
+        'progress': progress
     })
 
 @app.route('/s3uploader/upload/cancel', methods=['POST'])
@@ -392,7 +888,9 @@ def cancel_upload():
     global upload_progress
     
     if upload_progress['status'] == 'running':
-        upload_progress['status'] = 'cancelled'
+        with progress_lock:
+            upload_progress['status'] = 'cancelled'
+        save_progress()
         return jsonify({
             'success': True,
             'message': 'Upload cancelled'
@@ -423,48 +921,19 @@ def debug_folder_scan():
             debug_info['error'] = f"Source folder {SOURCE_FOLDER} does not exist"
             return jsonify(debug_info)
         
-        # Walk through the directory and log everything
-        for root, dirs, files in os.walk(SOURCE_FOLDER):
-            relative_root = os.path.relpath(root, SOURCE_FOLDER)
-            
-            # Check if current directory is excluded
-            is_root_excluded = should_exclude_path(root, SOURCE_FOLDER)
-            
-            if is_root_excluded:
-                debug_info['excluded_dirs'].append({
-                    'path': relative_root,
-                    'full_path': root,
-                    'reason': 'directory excluded'
-                })
-                continue
-            else:
-                debug_info['found_dirs'].append(relative_root)
-            
-            # Check each file
-            for file in files:
-                file_path = os.path.join(root, file)
-                relative_file_path = os.path.relpath(file_path, SOURCE_FOLDER)
-                
-                is_file_excluded = should_exclude_path(file_path, SOURCE_FOLDER)
-                
-                try:
-                    file_size = os.path.getsize(file_path)
-                except (OSError, IOError):
-                    file_size = 0
-                
-                if is_file_excluded:
-                    debug_info['excluded_files'].append({
-                        'path': relative_file_path,
-                        'size': file_size,
-                        'reason': 'file excluded'
-                    })
-                else:
-                    debug_info['found_files'].append({
-                        'path': relative_file_path,
-                        'size': file_size
-                    })
-                    debug_info['total_size'] += file_size
-                    debug_info['file_count'] += 1
+        snapshot = folder_scanner.snapshot()
+        debug_info['found_dirs'] = snapshot.found_dirs
+        debug_info['excluded_dirs'] = [
+            {'path': path, 'full_path': os.path.join(SOURCE_FOLDER, path), 'reason': 'directory excluded'}
+            for path in snapshot.excluded_dirs
+        ]
+        debug_info['found_files'] = [{'path': path, 'size': size} for _, path, size, _ in snapshot.files]
+        debug_info['excluded_files'] = [
+            {'path': path, 'size': size, 'reason': 'file excluded'}
+            for path, size in snapshot.excluded_files
+        ]
+        debug_info['total_size'] = snapshot.total_size
+        debug_info['file_count'] = snapshot.file_count
         
         return jsonify(debug_info)
         
@@ -487,5 +956,8 @@ if __name__ == '__main__':
     else:
         print("S3 configuration validated successfully")
     
+    # Pick up jobs interrupted by a restart
+    recover_interrupted_jobs()
+    
     # Start Flask app
     app.run(host='0.0.0.0', port=5001, debug=False) 
\ No newline at end of file
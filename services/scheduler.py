@@ -0,0 +1,170 @@
+"""
+EzInfer admission control
+
+Bounds the number of workflows EzInfer has in flight on ComfyUI and the
+number of requests allowed to wait for a slot. Requests beyond that are
+rejected immediately with a Retry-After hint computed from measured
+execution times, instead of piling up in ComfyUI's queue behind nginx's
+one hour read timeout.
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+
+class Overloaded(Exception):
+    """Request rejected by admission control"""
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """The caller's deadline expired before the workflow finished"""
+
+
+def workflow_shape_key(workflow):
+    """Hash of a workflow's node ids and class types (input values ignored).
+
+    Workflows with the same graph but different prompts/seeds share one
+    execution time estimate.
+    """
+    shape = sorted(
+        (str(node_id), node.get('class_type', '') if isinstance(node, dict) else '')
+        for node_id, node in workflow.items()
+    )
+    return hashlib.sha1(json.dumps(shape).encode('utf-8')).hexdigest()
+
+
+class AdmissionController:
+    """Bounded in-flight slots plus a bounded FIFO wait queue"""
+
+    def __init__(self, max_in_flight, max_queue, default_estimate=30.0, smoothing=0.3, parallelism=None):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(0, max_queue)
+        self.default_estimate = default_estimate
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.rejected = 0
+        self._waiters = deque()
+        self._estimates = {}
+        self._global_estimate = None
+        # Estimated seconds of work admitted or waiting, each ComfyUI backend runs its share serially
+        self._pending_work = 0.0
+        # Callable returning the number of backends sharing the work (e.g. BackendPool.available_count)
+        self.parallelism = parallelism
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def estimate(self, key):
+        """Expected execution time in seconds for a workflow shape"""
+        if key in self._estimates:
+            return self._estimates[key]
+        if self._global_estimate is not None:
+            return self._global_estimate
+        return self.default_estimate
+
+    def record(self, key, seconds):
+        """Feed a measured execution time into the moving averages"""
+        previous = self._estimates.get(key)
+        self._estimates[key] = seconds if previous is None else (
+            self.smoothing * seconds + (1 - self.smoothing) * previous)
+        self._global_estimate = seconds if self._global_estimate is None else (
+            self.smoothing * seconds + (1 - self.smoothing) * self._global_estimate)
+
+    def _retry_after(self, seconds):
+        return max(1, math.ceil(seconds))
+
+    @property
+    def backlog_seconds(self):
+        """Estimated wall-clock seconds until the work admitted or waiting is done"""
+        backends = self.parallelism() if self.parallelism is not None else 1
+        return self._pending_work / max(1, backends)
+
+    @asynccontextmanager
+    async def admit(self, key, deadline=None):
+        """Hold an in-flight slot for the duration of the block.
+
+        Raises Overloaded when the wait queue is full (429) or the deadline
+        cannot be met given the work already ahead (503), and
+        DeadlineExceeded when the deadline expires while waiting.
+        """
+        estimate = self.estimate(key)
+        busy = self.in_flight + self.waiting
+        backlog = self.backlog_seconds
+
+        # Only the work already ahead counts: our own estimate may be a default guess
+        if deadline is not None and time.monotonic() + backlog > deadline:
+            self.rejected += 1
+            raise Overloaded("Deadline cannot be met with the current backlog", 503,
+                             self._retry_after(backlog))
+
+        if self.in_flight >= self.max_in_flight and self.waiting >= self.max_queue:
+            self.rejected += 1
+            # A queue slot frees up roughly when one of the workflows ahead finishes
+            raise Overloaded("Too many requests in queue", 429,
+                             self._retry_after(backlog / max(1, busy)))
+
+        self._pending_work += estimate
+        try:
+            if self.in_flight < self.max_in_flight:
+                self.in_flight += 1
+            else:
+                await self._wait_for_slot(deadline)
+            try:
+                yield
+            finally:
+                self._release_slot()
+        finally:
+            self._pending_work -= estimate
+
+    async def _wait_for_slot(self, deadline):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            self._abandon(waiter)
+            raise DeadlineExceeded("Deadline exceeded while waiting in queue")
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    def _abandon(self, waiter):
+        if waiter.done() and not waiter.cancelled():
+            # The slot was handed over just before we gave up: pass it on
+            self._release_slot()
+        else:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+
+    def _release_slot(self):
+        # Hand the slot directly to the next live waiter, keeping FIFO order
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'max_in_flight': self.max_in_flight,
+            'max_queue': self.max_queue,
+            'rejected': self.rejected,
+            'estimated_backlog_seconds': round(self.backlog_seconds, 2),
+        }
@@ -0,0 +1,193 @@
+"""
+EzInfer workflow template registry
+
+A workflow is registered once and then executed by id with a small map of
+parameters, instead of posting the whole graph on every request. Validation,
+seed slot discovery and the input paths of named parameters are computed at
+registration and stored next to the workflow on disk, so instantiating a
+template only copies the nodes that actually change.
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+from pathlib import Path
+
+from result_cache import workflow_cache_key
+
+SEED_INPUTS = ('seed', 'noise_seed')
+
+
+class TemplateError(ValueError):
+    """Invalid template or template parameters"""
+
+
+def validate_workflow(workflow):
+    """Check that a workflow looks like a ComfyUI API-format graph"""
+    if not isinstance(workflow, dict) or not workflow:
+        raise TemplateError("workflow must be a non-empty object")
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict) or 'class_type' not in node:
+            raise TemplateError(f"node '{node_id}' has no class_type (API format workflow expected)")
+        if not isinstance(node.get('inputs', {}), dict):
+            raise TemplateError(f"inputs of node '{node_id}' must be an object")
+
+
+def parse_path(workflow, path):
+    """Resolve a "node_id.input" path to a [node_id, input] pair"""
+    node_id, sep, input_name = str(path).partition('.')
+    if not sep or not input_name:
+        raise TemplateError(f"invalid parameter path '{path}', expected 'node_id.input'")
+    if node_id not in workflow:
+        raise TemplateError(f"node '{node_id}' not found in workflow")
+    return [node_id, input_name]
+
+
+class WorkflowTemplate:
+    """A registered workflow with its precompiled seed slots and parameter paths"""
+
+    def __init__(self, template_id, workflow, name=None, parameters=None,
+                 seed_slots=None, control_slots=None, created=None):
+        self.id = template_id
+        self.workflow = workflow
+        self.name = name
+        # Named parameter -> [node_id, input]
+        self.parameters = parameters or {}
+        self.seed_slots = seed_slots or []
+        self.control_slots = control_slots or []
+        self.created = created or time.time()
+
+    @classmethod
+    def compile(cls, workflow, name=None, parameters=None):
+        """Validate a workflow and precompute everything needed per request"""
+        validate_workflow(workflow)
+        if parameters is not None and not isinstance(parameters, dict):
+            raise TemplateError("parameters must map names to 'node_id.input' paths")
+
+        seed_slots = []
+        control_slots = []
+        for node_id, node in workflow.items():
+            inputs = node.get('inputs', {})
+            seed_slots.extend([node_id, key] for key in SEED_INPUTS if key in inputs)
+            if 'control_after_generate' in inputs:
+                control_slots.append(node_id)
+
+        compiled = {param: parse_path(workflow, path) for param, path in (parameters or {}).items()}
+        template_id = workflow_cache_key(workflow)[:16]
+        return cls(template_id, workflow, name, compiled, seed_slots, control_slots)
+
+    def instantiate(self, params, randomize_seeds):
+        """Build the workflow for one request.
+
+        params maps declared parameter names or "node_id.input" paths to
+        values. Only the nodes being changed are copied, the rest is shared
+        with the template.
+        """
+        if not isinstance(params, dict):
+            raise TemplateError("parameters must be an object")
+
+        assignments = []
+        if randomize_seeds:
+            assignments.extend((node_id, key, random.randint(0, 0xFFFFFFFFFFFFFFFF))
+                               for node_id, key in self.seed_slots)
+            assignments.extend((node_id, 'control_after_generate', 'randomize')
+                               for node_id in self.control_slots)
+        # Explicit parameters come last so they win over random seeds
+        for param, value in params.items():
+            path = self.parameters.get(param) or parse_path(self.workflow, param)
+            assignments.append((path[0], path[1], value))
+
+        workflow = dict(self.workflow)
+        copied = set()
+        for node_id, input_name, value in assignments:
+            if node_id not in copied:
+                node = workflow[node_id]
+                workflow[node_id] = dict(node, inputs=dict(node.get('inputs', {})))
+                copied.add(node_id)
+            workflow[node_id]['inputs'][input_name] = value
+        return workflow
+
+    def describe(self):
+        """Summary returned by the API (without the workflow graph)"""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'parameters': {param: '.'.join(path) for param, path in self.parameters.items()},
+            'seed_slots': ['.'.join(slot) for slot in self.seed_slots],
+            'nodes': len(self.workflow),
+            'created': self.created,
+        }
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'workflow': self.workflow,
+            'parameters': self.parameters,
+            'seed_slots': self.seed_slots,
+            'control_slots': self.control_slots,
+            'created': self.created,
+        }
+
+
+class TemplateRegistry:
+    """Templates kept in memory and persisted as one JSON file each"""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self._templates = {}
+
+    def load(self):
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            print(f"WARN: Cannot create template directory {self.directory}: {e}")
+            return
+        for path in self.directory.glob('*.json'):
+            try:
+                data = json.loads(path.read_text())
+                template = WorkflowTemplate(
+                    data['id'], data['workflow'], data.get('name'), data.get('parameters'),
+                    data.get('seed_slots'), data.get('control_slots'), data.get('created'))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"WARN: Skipping invalid template {path}: {e}")
+                continue
+            self._templates[template.id] = template
+        print(f"INFO: Loaded {len(self._templates)} workflow templates from {self.directory}")
+
+    def get(self, template_id):
+        """Look a template up by id, or by name (most recently registered wins)"""
+        template = self._templates.get(template_id)
+        if template is not None:
+            return template
+        named = [t for t in self._templates.values() if t.name == template_id]
+        return max(named, key=lambda t: t.created) if named else None
+
+    def list(self):
+        return [template.describe() for template in self._templates.values()]
+
+    async def register(self, workflow, name=None, parameters=None):
+        """Compile and persist a template; registering the same graph again replaces it"""
+        template = WorkflowTemplate.compile(workflow, name, parameters)
+        await asyncio.to_thread(self._write, template)
+        self._templates[template.id] = template
+        return template
+
+    def _write(self, template):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.directory / f".{template.id}.json.tmp"
+        tmp_path.write_text(json.dumps(template.to_dict()))
+        os.replace(tmp_path, self.directory / f"{template.id}.json")
+
+    def delete(self, template_id):
+        template = self.get(template_id)
+        if template is None:
+            return False
+        del self._templates[template.id]
+        try:
+            (self.directory / f"{template.id}.json").unlink()
+        except FileNotFoundError:
+            pass
+        return True
@@ -0,0 +1,181 @@
+"""
+On-disk journal of S3 uploader jobs
+
+Upload jobs, the files they completed and the parts of their in-flight
+multipart uploads are recorded in a small SQLite database on the workbench
+volume. When the service is restarted (supervisord restart, pod rescheduled)
+a job that was still running is resumed: completed files are skipped, large
+files continue from their last committed part, and multipart uploads that can
+no longer be resumed are aborted instead of being left behind in the bucket.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    subfolder TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    options TEXT NOT NULL DEFAULT '{}',
+    progress TEXT NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS completed_files (
+    job_id INTEGER NOT NULL,
+    relative_path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (job_id, relative_path)
+);
+CREATE TABLE IF NOT EXISTS multipart_uploads (
+    job_id INTEGER NOT NULL,
+    relative_path TEXT NOT NULL,
+    s3_key TEXT NOT NULL,
+    upload_id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    part_size INTEGER NOT NULL,
+    PRIMARY KEY (job_id, relative_path)
+);
+CREATE TABLE IF NOT EXISTS multipart_parts (
+    upload_id TEXT NOT NULL,
+    part_number INTEGER NOT NULL,
+    etag TEXT NOT NULL,
+    PRIMARY KEY (upload_id, part_number)
+);
+"""
+
+# Minimum interval between progress writes that are not tied to a file completion
+PROGRESS_WRITE_INTERVAL = 1.0
+
+# Finished jobs kept for the progress endpoint and debugging
+KEEP_FINISHED_JOBS = 20
+
+
+class UploadJournal:
+    """SQLite-backed record of upload jobs, shared by the worker threads"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._last_progress_write = 0.0
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _transaction(self, statements):
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                for sql, params in statements:
+                    self._db.execute(sql, params)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def create_job(self, subfolder, mode, options, progress):
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO jobs (subfolder, mode, options, progress, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 'running', ?, ?)",
+                (subfolder, mode, json.dumps(options), json.dumps(progress), now, now))
+            return cursor.lastrowid
+
+    def save_progress(self, job_id, progress, force=True):
+        """Persist a copy of the progress dict (throttled unless force is set)"""
+        now = time.time()
+        if not force and now - self._last_progress_write < PROGRESS_WRITE_INTERVAL:
+            return
+        self._last_progress_write = now
+        self._execute("UPDATE jobs SET progress = ?, status = ?, updated_at = ? WHERE id = ?",
+                      (json.dumps(progress), progress['status'], now, job_id))
+
+    def file_completed(self, job_id, relative_path, size, mtime_ns, progress):
+        """Record a finished file together with the job progress, in one transaction"""
+        now = time.time()
+        self._last_progress_write = now
+        self._transaction([
+            ("INSERT OR REPLACE INTO completed_files (job_id, relative_path, size, mtime_ns) VALUES (?, ?, ?, ?)",
+             (job_id, relative_path, size, mtime_ns)),
+            ("UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ?",
+             (json.dumps(progress), now, job_id)),
+        ])
+
+    def completed_files(self, job_id):
+        """{relative_path: (size, mtime_ns)} of files a job already uploaded"""
+        rows = self._execute("SELECT relative_path, size, mtime_ns FROM completed_files WHERE job_id = ?",
+                             (job_id,))
+        return {row['relative_path']: (row['size'], row['mtime_ns']) for row in rows}
+
+    def latest_job(self):
+        rows = self._execute("SELECT * FROM jobs ORDER BY id DESC LIMIT 1")
+        return self._job_dict(rows[0]) if rows else None
+
+    def running_jobs(self):
+        return [self._job_dict(row) for row in self._execute("SELECT * FROM jobs WHERE status = 'running'")]
+
+    @staticmethod
+    def _job_dict(row):
+        job = dict(row)
+        job['options'] = json.loads(job['options'])
+        job['progress'] = json.loads(job['progress'])
+        return job
+
+    # Multipart uploads
+
+    def start_multipart(self, job_id, relative_path, s3_key, upload_id, size, mtime_ns, part_size):
+        self._execute(
+            "INSERT OR REPLACE INTO multipart_uploads "
+            "(job_id, relative_path, s3_key, upload_id, size, mtime_ns, part_size) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, relative_path, s3_key, upload_id, size, mtime_ns, part_size))
+
+    def find_multipart(self, job_id, relative_path):
+        rows = self._execute("SELECT * FROM multipart_uploads WHERE job_id = ? AND relative_path = ?",
+                             (job_id, relative_path))
+        return dict(rows[0]) if rows else None
+
+    def part_completed(self, upload_id, part_number, etag):
+        self._execute("INSERT OR REPLACE INTO multipart_parts (upload_id, part_number, etag) VALUES (?, ?, ?)",
+                      (upload_id, part_number, etag))
+
+    def completed_parts(self, upload_id):
+        """{part_number: etag} of parts already uploaded"""
+        rows = self._execute("SELECT part_number, etag FROM multipart_parts WHERE upload_id = ?", (upload_id,))
+        return {row['part_number']: row['etag'] for row in rows}
+
+    def finish_multipart(self, upload_id):
+        """Forget a multipart upload once completed or aborted"""
+        self._transaction([
+            ("DELETE FROM multipart_parts WHERE upload_id = ?", (upload_id,)),
+            ("DELETE FROM multipart_uploads WHERE upload_id = ?", (upload_id,)),
+        ])
+
+    def multipart_uploads(self, job_id=None):
+        if job_id is None:
+            rows = self._execute("SELECT * FROM multipart_uploads")
+        else:
+            rows = self._execute("SELECT * FROM multipart_uploads WHERE job_id = ?", (job_id,))
+        return [dict(row) for row in rows]
+
+    def prune(self):
+        """Drop finished jobs beyond the most recent KEEP_FINISHED_JOBS"""
+        self._transaction([
+            ("DELETE FROM jobs WHERE status != 'running' AND id NOT IN "
+             "(SELECT id FROM jobs ORDER BY id DESC LIMIT ?)", (KEEP_FINISHED_JOBS,)),
+            ("DELETE FROM completed_files WHERE job_id NOT IN (SELECT id FROM jobs)", ()),
+        ])
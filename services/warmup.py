@@ -0,0 +1,204 @@
+"""
+EzInfer model warm-up
+
+The first generation after a start pays for loading checkpoints, CLIP and
+VAE from the volume. With EZINFER_WARMUP set, EzInfer runs a warm-up stage
+on every ComfyUI backend before the pod reports ready. EZINFER_WARMUP is a
+comma-separated list of:
+
+- registered workflow templates (id or name, see templates.py), run at
+  EZINFER_WARMUP_RESOLUTION with one step, previewing instead of saving;
+- checkpoint files (as CheckpointLoaderSimple names them), loaded through a
+  minimal one-step graph that also loads their CLIP and VAE.
+
+Readiness (health.py, healthcheck.sh) waits for WARMUP_COMPLETE_MARKER when
+start-comfyui-with-nginx.sh has written WARMUP_REQUIRED_MARKER. The marker
+is also written when the warm-up fails or exceeds EZINFER_WARMUP_TIMEOUT, so
+a bad entry delays readiness but never blocks it.
+
+With EZINFER_KEEP_WARM_SECONDS set, the warm-up runs again on any backend
+that has been idle that long, so weights stay resident between bursts.
+
+Warm-up runs go through admission control and a lease of their backend like
+requests do, so the scheduler's backlog and the backend's in-flight count
+include them, and a keep-warm run never starts while a request holds the
+backend. A run exceeding EZINFER_WARMUP_TIMEOUT is cancelled on ComfyUI.
+"""
+
+import asyncio
+import copy
+import os
+import random
+import time
+
+from backends import MODEL_EXTENSIONS, workflow_models
+from health import STARTUP_COMPLETE_MARKER, WARMUP_COMPLETE_MARKER
+
+WARMUP_ITEMS = [item.strip() for item in os.getenv('EZINFER_WARMUP', '').split(',') if item.strip()]
+WARMUP_RESOLUTION = int(os.getenv('EZINFER_WARMUP_RESOLUTION', '64'))
+WARMUP_TIMEOUT = float(os.getenv('EZINFER_WARMUP_TIMEOUT', '900'))
+# Idle seconds after which a backend is warmed up again, 0 disables
+KEEP_WARM_SECONDS = float(os.getenv('EZINFER_KEEP_WARM_SECONDS', '0'))
+
+SEED_INPUTS = ('seed', 'noise_seed')
+# Inputs shrunk to make a warm-up run cheap: (input name, value or None for the resolution)
+SHRINK_INPUTS = {'width': None, 'height': None, 'steps': 1, 'batch_size': 1, 'length': 1}
+
+
+def shrink_workflow(workflow):
+    """Copy of a workflow at the warm-up resolution, one step, random seeds and no saved outputs"""
+    workflow = copy.deepcopy(workflow)
+    for node in workflow.values():
+        inputs = node.setdefault('inputs', {})
+        for name, value in SHRINK_INPUTS.items():
+            # Linked inputs ([node_id, slot]) are left alone
+            if isinstance(inputs.get(name), int):
+                inputs[name] = WARMUP_RESOLUTION if value is None else value
+        for name in SEED_INPUTS:
+            if isinstance(inputs.get(name), int):
+                inputs[name] = random.randint(0, 0xFFFFFFFFFFFFFFFF)
+        # Preview (temp directory) instead of filling the output directory
+        if node.get('class_type', '').startswith('Save') and 'images' in inputs:
+            node['class_type'] = 'PreviewImage'
+            node['inputs'] = {'images': inputs['images']}
+    return workflow
+
+
+def checkpoint_workflow(ckpt_name):
+    """Minimal graph loading a checkpoint's model, CLIP and VAE and running them once"""
+    return {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": ckpt_name}},
+        "2": {"class_type": "CLIPTextEncode", "inputs": {"text": "", "clip": ["1", 1]}},
+        "3": {"class_type": "EmptyLatentImage",
+              "inputs": {"width": WARMUP_RESOLUTION, "height": WARMUP_RESOLUTION, "batch_size": 1}},
+        "4": {"class_type": "KSampler", "inputs": {
+            "model": ["1", 0], "positive": ["2", 0], "negative": ["2", 0], "latent_image": ["3", 0],
+            "seed": random.randint(0, 0xFFFFFFFFFFFFFFFF), "steps": 1, "cfg": 1.0,
+            "sampler_name": "euler", "scheduler": "normal", "denoise": 1.0}},
+        "5": {"class_type": "VAEDecode", "inputs": {"samples": ["4", 0], "vae": ["1", 2]}},
+        "6": {"class_type": "PreviewImage", "inputs": {"images": ["5", 0]}},
+    }
+
+
+class Warmup:
+    """Warm-up stage and keep-warm timer over the backends of a BackendPool.
+
+    scheduler is the AdmissionController runs are admitted through, and
+    cancel an async callable(backend, prompt_id) removing a prompt from
+    ComfyUI (ez_infer.cancel_prompt). on_duration is an optional
+    callback(backend_name, phase, seconds) with phase 'startup' or
+    'keep_warm'.
+    """
+
+    def __init__(self, pool, templates, scheduler, cancel, items=None, on_duration=None):
+        self.pool = pool
+        self.templates = templates
+        self.scheduler = scheduler
+        self.cancel = cancel
+        self.items = WARMUP_ITEMS if items is None else items
+        self.on_duration = on_duration
+        self.state = 'pending' if self.items else 'disabled'
+        self.results = {}
+        self._tasks = []
+
+    async def start(self):
+        if not self.items:
+            return
+        self._tasks.append(asyncio.create_task(self._startup()))
+        if KEEP_WARM_SECONDS > 0:
+            self._tasks.append(asyncio.create_task(self._keep_warm()))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def workflows(self):
+        """(label, workflow) for each warm-up item; fresh seeds every call so ComfyUI does not skip the run"""
+        workflows = []
+        for item in self.items:
+            template = self.templates.get(item)
+            if template is not None:
+                workflows.append((f"template {item}", shrink_workflow(template.workflow)))
+            elif item.lower().endswith(MODEL_EXTENSIONS):
+                workflows.append((f"checkpoint {item}", checkpoint_workflow(item)))
+            else:
+                print(f"WARN: Warm-up item '{item}' is neither a registered template nor a checkpoint file, skipping")
+        return workflows
+
+    async def run_workflow(self, backend, workflow):
+        """Run one warm-up workflow on a backend, cancelling it on ComfyUI on timeout"""
+        key = f"warmup:{backend.name}"
+        async with self.scheduler.admit(key), self.pool.lease(work=self.scheduler.estimate(key), backend=backend):
+            result = await backend.client.submit_prompt(workflow, backend.hub.client_id)
+            prompt_id = result['prompt_id']
+            try:
+                await backend.hub.wait(prompt_id, timeout=WARMUP_TIMEOUT)
+            except asyncio.TimeoutError:
+                await self.cancel(backend, prompt_id)
+                raise
+            except asyncio.CancelledError:
+                # Startup deadline or shutdown: do not leave the prompt on the GPU
+                await asyncio.shield(self.cancel(backend, prompt_id))
+                raise
+        backend.remember_models(workflow_models(workflow))
+
+    async def warm_backend(self, backend, phase):
+        """Run every warm-up workflow on one backend, returning the seconds it took (None if skipped)"""
+        started = time.monotonic()
+        for label, workflow in self.workflows():
+            if phase == 'keep_warm' and backend.in_flight:
+                # A request holds the backend: it keeps the models warm by itself
+                print(f"INFO: Keep-warm of backend {backend.name} skipped, the backend is busy")
+                return None
+            try:
+                await self.run_workflow(backend, workflow)
+            except asyncio.TimeoutError:
+                print(f"WARN: Warm-up of {label} timed out on backend {backend.name} after {WARMUP_TIMEOUT:.0f}s")
+            except Exception as e:
+                print(f"WARN: Warm-up of {label} failed on backend {backend.name}: {e}")
+        seconds = time.monotonic() - started
+        backend.last_used = time.monotonic()
+        self.results[backend.name] = {'phase': phase, 'seconds': round(seconds, 2), 'at': time.time()}
+        if self.on_duration is not None:
+            self.on_duration(backend.name, phase, seconds)
+        print(f"INFO: Warm-up ({phase}) of backend {backend.name} took {seconds:.1f}s")
+        return seconds
+
+    async def _wait_reachable(self, backend):
+        # Health reports 'starting' until the warm-up is done, so wait for reachability only
+        while not (os.path.exists(STARTUP_COMPLETE_MARKER) and backend.health.last_success is not None
+                   and backend.health.last_error is None):
+            await asyncio.sleep(1)
+
+    async def _warm_when_reachable(self, backend):
+        await self._wait_reachable(backend)
+        await self.warm_backend(backend, 'startup')
+
+    async def _startup(self):
+        self.state = 'running'
+        print(f"INFO: Warming up {len(self.pool.backends)} backends with: {', '.join(self.items)}")
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(self._warm_when_reachable(backend) for backend in self.pool.backends)),
+                WARMUP_TIMEOUT)
+            self.state = 'complete'
+        except asyncio.TimeoutError:
+            print(f"WARN: Warm-up did not finish within {WARMUP_TIMEOUT:.0f}s, reporting ready anyway")
+            self.state = 'timed_out'
+        with open(WARMUP_COMPLETE_MARKER, 'w') as f:
+            f.write(self.state)
+
+    async def _keep_warm(self):
+        while True:
+            await asyncio.sleep(min(KEEP_WARM_SECONDS, 60))
+            if self.state not in ('complete', 'timed_out'):
+                continue
+            for backend in self.pool.backends:
+                idle = time.monotonic() - backend.last_used
+                if backend.in_flight == 0 and backend.available and idle >= KEEP_WARM_SECONDS:
+                    await self.warm_backend(backend, 'keep_warm')
+
+    def stats(self):
+        return {'state': self.state, 'items': self.items, 'keep_warm_seconds': KEEP_WARM_SECONDS,
+                'backends': self.results}